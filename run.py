@@ -1,12 +1,11 @@
 from argparse import ArgumentParser
 from pathlib import Path
-import matplotlib.pyplot as plt
 import torch
 
-from vap.modules.VAP import load_model_from_state_dict, step_extraction
-from vap.modules.lightning_module import VAPModule
+from vap.modules.VAP import step_extraction
 from vap.utils.audio import load_waveform
-from vap.utils.plot import plot_stereo
+from vap.utils.output_store import DTYPES, write_output_store
+from vap.utils.profiling import profiler
 from vap.utils.utils import (
     batch_to_device,
     everything_deterministic,
@@ -14,9 +13,6 @@ from vap.utils.utils import (
     write_json,
 )
 
-everything_deterministic()
-torch.manual_seed(0)
-
 
 def get_args():
     parser = ArgumentParser()
@@ -59,11 +55,49 @@ def get_args():
         default=5,
         help="Increment to process in a step. (Uses the last `chunk_time - step_time` as context to predict `step_time` for each relevant clip/chunk)",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Number of chunks processed in a single forward pass",
+    )
     parser.add_argument(
         "--force_no_chunk",
         action="store_true",
         help="Don't use chunking but process the entire audio in one pass.",
     )
+    parser.add_argument(
+        "--max_lookback_time",
+        type=float,
+        default=None,
+        help="Restrict the attention to the last n seconds (banded attention, linear in the duration) and process the entire audio in one pass",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="json",
+        choices=["json", "store"],
+        help="Save as json or as a compact binary store (directory, see vap.utils.output_store)",
+    )
+    parser.add_argument(
+        "--fields",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Output fields to save, e.g. p_now p_future vad (default: all)",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float16",
+        choices=DTYPES,
+        help="Storage dtype of the binary store",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the per-stage latency (encode_audio, ar_channel, ar, ...) of the model forward",
+    )
     parser.add_argument(
         "--plot", action="store_true", help="Visualize output (matplotlib)"
     )
@@ -86,17 +120,14 @@ def get_args():
 
 
 def load_vap_model(args):
-    if args.state_dict:
-        model = load_model_from_state_dict(args.state_dict)
-    elif args.checkpoint:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model = VAPModule.load_model(args.checkpoint, map_location=device)
-    else:
-        raise ValueError("Must provide state_dict or checkpoint")
-    return model
+    from vap.infer import load_vap_model
+
+    return load_vap_model(args.state_dict, args.checkpoint)
 
 
 if __name__ == "__main__":
+    everything_deterministic()
+    torch.manual_seed(0)
     args = get_args()
 
     for k, v in vars(args).items():
@@ -108,6 +139,10 @@ if __name__ == "__main__":
     print("Load Model...")
     model = load_vap_model(args)
     model = model.eval()
+    if args.max_lookback_time is not None:
+        model.transformer.set_max_lookback(
+            int(args.max_lookback_time * model.frame_hz)
+        )
 
     ###########################################################
     # Load the Audio
@@ -124,25 +159,46 @@ if __name__ == "__main__":
     # For consistency with training, we need to ensure that we use the
     # normal context length (default: 20s)
     print("Model Forward...")
+    if args.profile:
+        profiler.enable(cuda_events=model.device.type == "cuda")
     if duration > 20:
         print("Duration > 20: ", duration)
-        if args.force_no_chunk:
+        if args.force_no_chunk or args.max_lookback_time is not None:
             out = model.probs(waveform.to(model.device))
         else:
             out = step_extraction(
-                waveform, model, chunk_time=args.chunk_time, step_time=args.step_time
+                waveform,
+                model,
+                chunk_time=args.chunk_time,
+                step_time=args.step_time,
+                batch_size=args.batch_size,
             )
     else:
         out = model.probs(waveform.to(model.device))
     out = batch_to_device(out, "cpu")  # to cpu for plot/save
+    if args.profile:
+        print(profiler.format_report())
 
     ###########################################################
     # Save Output
     ###########################################################
-    if args.output is None:
-        args.output = "vap_output.json"
-    data = tensor_dict_to_json(out)
-    write_json(data, args.output)
+    if args.format == "store":
+        if args.output is None:
+            args.output = "vap_output"
+        write_output_store(
+            out,
+            args.output,
+            fields=args.fields,
+            dtype=args.dtype,
+            frame_hz=model.frame_hz,
+        )
+    else:
+        if args.output is None:
+            args.output = "vap_output.json"
+        data = out
+        if args.fields is not None:
+            data = {k: v for k, v in out.items() if k in args.fields}
+        write_json(tensor_dict_to_json(data), args.output)
     print("wavefile: ", args.audio)
     print("Saved output -> ", args.output)
 
@@ -150,6 +206,9 @@ if __name__ == "__main__":
     # Plot
     ###########################################################
     if args.plot:
+        import matplotlib.pyplot as plt
+        from vap.utils.plot import plot_stereo
+
         fig, ax = plot_stereo(
             waveform[0].cpu(),
             p_now=out["p_now"][0].cpu(),
@@ -157,7 +216,7 @@ if __name__ == "__main__":
             vad=out["vad"][0].cpu(),
         )
         # Save figure
-        figpath = args.output.replace(".json", ".png")
+        figpath = args.output.replace(".json", "") + ".png"
         fig.savefig(figpath)
         print(f"Saved figure as {figpath}.png")
         print("Close figure to exit")
@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from vap.modules.VAP import VAP
+from vap.modules.compiled import CompiledVAP, get_n_frames
+from vap.modules.encoder import EncoderCPC
+from vap.modules.modules import TransformerStereo
+
+
+@pytest.mark.modules
+def test_compiled_vap_buckets():
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    compiled = CompiledVAP(
+        model, frame_buckets=[50, 100], batch_buckets=[2], backend="aot_eager"
+    )
+    for n_samples in [16_000, 20_123, 32_000]:
+        x = torch.randn(1, 2, n_samples)
+        assert get_n_frames(model.encoder, n_samples) == model(x)["logits"].shape[1]
+
+        target = model.probs(x)
+        out = compiled.probs(x)
+        assert out["p_now"].shape == target["p_now"].shape
+        # the padding is only seen by the last frame (the encoder lookahead)
+        assert torch.allclose(
+            out["p_now"][:, :-1], target["p_now"][:, :-1], atol=1e-5
+        )
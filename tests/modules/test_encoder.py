@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from vap.modules.encoder import EncoderCPC
+
+
+@pytest.mark.modules
+def test_encoder_skip_silence():
+    """Skipping the exactly silent spans (and channels) == the full encoder"""
+    encoder = EncoderCPC().eval()
+    x = torch.randn(3, 1, 16_000 * 3 + 123)
+    x[0] = 0  # a silent channel (e.g. mono `load_waveform`)
+    x[1, :, 8000:30000] = 0  # silent spans (e.g. `mono_to_stereo`)
+    x[1, :, 40000:] = 0
+
+    with torch.inference_mode():
+        assert encoder.encoder.gEncoder.get_silent_frames(x[1:2]).any()
+        encoder.skip_silence = False
+        target = encoder(x)
+        encoder.skip_silence = True
+        out = encoder(x)
+        cached = encoder(x)  # the cached silent channel
+    assert torch.allclose(out, target, atol=1e-5)
+    assert torch.allclose(cached, target, atol=1e-5)
+    assert len(encoder.silence_cache) == 1
+
+
+@pytest.mark.modules
+def test_encoder_skip_silence_speech(monkeypatch):
+    """Input without long silent spans runs the plain encoder (no per row work)"""
+    encoder = EncoderCPC().eval()
+    x = torch.randn(4, 1, 16_000 * 2)
+    x[:, :, 1000:4000] = 0  # shorter than `min_silence_frames`
+
+    def fail(*args, **kwargs):
+        raise AssertionError("forward_skip_silence on non-silent input")
+
+    monkeypatch.setattr(encoder.encoder.gEncoder, "forward_skip_silence", fail)
+    with torch.inference_mode():
+        out = encoder(x)
+        encoder.skip_silence = False
+        target = encoder(x)
+    assert torch.equal(out, target)
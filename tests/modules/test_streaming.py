@@ -0,0 +1,103 @@
+import pytest
+import torch
+
+from vap.modules.VAP import VAP
+from vap.modules.encoder import EncoderCPC
+from vap.modules.modules import TransformerStereo
+from vap.modules.streaming import VAPStreamSession, step_sessions
+
+SAMPLE_RATE = 16_000
+DURATION = 3
+CHUNK_SAMPLES = 320  # 20ms
+
+
+@pytest.fixture(scope="module")
+def model():
+    return VAP(EncoderCPC(), TransformerStereo()).eval()
+
+
+@pytest.mark.modules
+@pytest.mark.parametrize("chunk_samples", [CHUNK_SAMPLES, 37, 777])
+def test_encoder_step(model, chunk_samples):
+    x = torch.randn(1, 1, int(DURATION * SAMPLE_RATE))
+    with torch.inference_mode():
+        z = model.encoder(x)
+        state = model.encoder.init_state()
+        zs = [model.encoder.step(c, state) for c in x.split(chunk_samples, dim=-1)]
+        zs.append(model.encoder.flush(state))
+    zs = torch.cat(zs, dim=1)
+    assert zs.shape == z.shape
+    assert torch.allclose(z, zs, atol=1e-5)
+
+
+@pytest.mark.modules
+@pytest.mark.parametrize("chunk_samples", [CHUNK_SAMPLES, 1234])
+def test_stream_session(model, chunk_samples):
+    x = torch.randn(1, 2, int(DURATION * SAMPLE_RATE))
+    out = model.probs(x)
+
+    session = VAPStreamSession(model)
+    outs = [session.step(c) for c in x.split(chunk_samples, dim=-1)]
+    outs.append(session.flush())
+    assert session.n_frames == out["p_now"].shape[1]
+    for k in ["probs", "vad", "p_now", "p_future"]:
+        streamed = torch.cat([o[k] for o in outs], dim=1)
+        assert torch.allclose(out[k], streamed, atol=1e-4), k
+
+
+@pytest.mark.modules
+def test_stream_session_no_frames(model):
+    """Steps (and a flush) that complete no frame return empty outputs"""
+    session = VAPStreamSession(model)
+    out = session.step(torch.randn(1, 2, 100))  # shorter than a frame
+    assert out["p_now"].shape == (1, 0)
+    session.step(torch.randn(1, 2, 20 * CHUNK_SAMPLES))
+    n_frames = session.n_frames
+    out = session.step(torch.randn(1, 2, 0))
+    assert out["p_now"].shape == (1, 0) and session.n_frames == n_frames
+
+
+@pytest.mark.modules
+def test_stream_session_context_window(model):
+    max_context_frames = 50
+    x = torch.randn(1, 2, int(DURATION * SAMPLE_RATE))
+    unbounded = VAPStreamSession(model)
+    bounded = VAPStreamSession(model, max_context_frames=max_context_frames)
+    a = [unbounded.step(c)["p_now"] for c in x.split(CHUNK_SAMPLES, dim=-1)]
+    b = [bounded.step(c)["p_now"] for c in x.split(CHUNK_SAMPLES, dim=-1)]
+    a, b = torch.cat(a, dim=1), torch.cat(b, dim=1)
+    assert torch.allclose(a[:, :max_context_frames], b[:, :max_context_frames])
+
+    # Constant memory: sinks + window
+    for layer_cache in bounded.cache["ar"]:
+        for channel_cache in layer_cache:
+            c = channel_cache["self"]
+            assert len(c) == c.num_pinned + max_context_frames
+
+
+@pytest.mark.modules
+@pytest.mark.parametrize("max_context_frames", [None, 20])
+def test_step_sessions(model, max_context_frames):
+    """Batched steps of sessions at different positions == separate steps"""
+    x = torch.randn(3, 2, SAMPLE_RATE)
+    separate, batched = [], []
+    for _ in range(3):
+        separate.append(VAPStreamSession(model, max_context_frames=max_context_frames))
+        batched.append(VAPStreamSession(model, max_context_frames=max_context_frames))
+
+    # different stream positions (and cache lengths)
+    for i, n in enumerate([1, 10, 27]):
+        for c in x[i : i + 1, :, : n * CHUNK_SAMPLES].split(CHUNK_SAMPLES, dim=-1):
+            separate[i].step(c)
+            batched[i].step(c)
+
+    for t in range(27, 37):
+        chunks = list(x[..., t * CHUNK_SAMPLES : (t + 1) * CHUNK_SAMPLES].split(1))
+        assert len(set(s.batch_key(c) for s, c in zip(batched, chunks))) == 1
+        outs = step_sessions(batched, chunks)
+        for session, chunk, out in zip(separate, chunks, outs):
+            target = session.step(chunk)
+            for k in ["probs", "vad", "p_now", "p_future", "p"]:
+                assert target[k].shape == out[k].shape, k
+                assert torch.allclose(target[k], out[k], atol=1e-5), k
+    assert [s.n_frames for s in batched] == [s.n_frames for s in separate]
@@ -1,7 +1,7 @@
 import pytest
 import torch
 
-from vap.modules.VAP import VAP, VAPMono
+from vap.modules.VAP import VAP, VAPMono, step_extraction
 from vap.modules.encoder import EncoderCPC
 from vap.modules.modules import TransformerStereo, GPT
 
@@ -25,3 +25,185 @@ def test_vap_mono():
     x = torch.randn(4, 1, int(5 * SAMPLE_RATE))
     vad = torch.randint(0, 2, (4, int(5 * FRAME_HZ), 2)).float()
     out = model(x, vad)
+
+
+@pytest.mark.modules
+def test_step_extraction_batched():
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    x = torch.randn(1, 2, int(9.5 * SAMPLE_RATE))
+    out = step_extraction(x, model, chunk_time=4, step_time=2, pbar=False)
+    out_batched = step_extraction(
+        x, model, chunk_time=4, step_time=2, batch_size=3, pbar=False
+    )
+    assert out["p_now"].shape == (1, int(9.5 * FRAME_HZ))
+    for k, v in out.items():
+        assert torch.allclose(v, out_batched[k], atol=1e-5), k
+
+    # The first chunk is used as is
+    first = model.probs(x[..., : int(4 * SAMPLE_RATE)])
+    n = first["p_now"].shape[1]
+    assert torch.allclose(out["p_now"][:, :n], first["p_now"], atol=1e-5)
+
+
+@pytest.mark.modules
+def test_vap_sdpa():
+    """The fused attention (attention=False) == the explicit attention"""
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    x = torch.randn(2, 2, int(3 * SAMPLE_RATE))
+    with torch.inference_mode():
+        fused = model(x)
+        explicit = model(x, attention=True)
+    for k in ["logits", "vad"]:
+        assert torch.allclose(fused[k], explicit[k], atol=1e-5), k
+
+
+@pytest.mark.modules
+def test_vap_attention_selection():
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    x = torch.randn(2, 2, int(2 * SAMPLE_RATE))
+    with torch.inference_mode():
+        out = model(x)
+        full = model(x, attention=True)
+        # layer 1: the first `ar` layer (after the single `ar_channel` layer)
+        sel = model(x, attention=True, attention_layers=[1], attention_heads=[0, 2])
+    assert "self_attn" not in out and "cross_attn" not in out
+    assert "self_attn" not in sel
+    target = full["cross_attn"][:, :, :1][:, :, :, [0, 2]]
+    assert sel["cross_attn"].shape == target.shape
+    assert torch.allclose(sel["cross_attn"], target, atol=1e-5)
+    assert torch.allclose(sel["logits"], out["logits"], atol=1e-5)
+
+
+@pytest.mark.modules
+def test_alibi_bias_cache():
+    from vap.modules.modules import MultiHeadAttentionAlibi, alibi_bias_cache
+
+    mha = MultiHeadAttentionAlibi(dim=256, num_heads=4, dropout=0.0)
+    other = MultiHeadAttentionAlibi(dim=256, num_heads=4, dropout=0.0)
+    alibi_bias_cache.clear()
+    a = mha.get_attn_bias(100)
+    b = other.get_attn_bias(60)
+    assert len(alibi_bias_cache) == 1
+    assert a.data_ptr() == b.data_ptr()  # views of the same (128, 128) bias
+    assert torch.equal(a, mha.get_alibi_mask(100))
+    assert torch.equal(b, mha.get_alibi_mask(60))
+
+
+@pytest.mark.modules
+def test_convert_sinks():
+    """The legacy sink tokens == the converted sink keys/values (eval)"""
+    model = VAP(EncoderCPC(), TransformerStereo(sink_layout="tokens")).eval()
+    x = torch.randn(2, 2, int(2 * SAMPLE_RATE))
+    with torch.inference_mode():
+        tokens = model(x, attention=True)
+    model.transformer.convert_sinks_to_kv()
+    assert model.transformer.sink_layout == "kv"
+    assert "transformer.attention_sinks" not in model.state_dict()
+    with torch.inference_mode():
+        kv = model(x, attention=True)
+    for k in ["logits", "vad", "self_attn", "cross_attn"]:
+        assert torch.allclose(tokens[k], kv[k], atol=1e-5), k
+
+
+@pytest.mark.modules
+def test_packed_projections_state_dict():
+    """State dicts with the separate query/key/value layers are fused on load"""
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    sd = {}
+    for name, x in model.state_dict().items():
+        if name.endswith("in_proj.weight"):
+            prefix = name[: -len("in_proj.weight")]
+            for m, w in zip(["query", "key", "value"], x.chunk(3)):
+                sd[f"{prefix}{m}.weight"] = w.clone()
+        else:
+            sd[name] = x.clone()
+
+    other = VAP(EncoderCPC(), TransformerStereo()).eval()
+    other.load_state_dict(sd)
+    x = torch.randn(1, 2, SAMPLE_RATE)
+    with torch.inference_mode():
+        assert torch.allclose(model(x)["logits"], other(x)["logits"], atol=1e-6)
+
+
+@pytest.mark.modules
+def test_vap_channel_batched(monkeypatch):
+    """Both channels as one batch == the channels one after the other"""
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    x = torch.randn(2, 2, int(2 * SAMPLE_RATE))
+    with torch.inference_mode():
+        batched = model(x, attention=True)
+        monkeypatch.setattr(VAP, "channel_batched", False)
+        monkeypatch.setattr(TransformerStereo, "channel_batched", False)
+        sequential = model(x, attention=True)
+    for k in ["logits", "vad", "self_attn", "cross_self_attn", "cross_attn"]:
+        assert torch.allclose(batched[k], sequential[k], atol=1e-5), k
+
+
+@pytest.mark.modules
+@pytest.mark.parametrize("max_lookback", [1, 7, 16])
+def test_local_attention(max_lookback):
+    """The blockwise banded attention == the dense attention with the band mask"""
+    from vap.modules.modules import MultiHeadAttentionAlibi
+
+    mha = MultiHeadAttentionAlibi(
+        dim=64, num_heads=4, dropout=0.0, max_lookback=max_lookback
+    ).eval()
+    x = torch.randn(2, 30, 64)
+    src = torch.randn(2, 30, 64)
+    with torch.inference_mode():
+        for K in [x, src]:
+            local, _ = mha(x, K, K, need_weights=False)
+            dense, att = mha(x, K, K, need_weights=True)
+            assert torch.allclose(local, dense, atol=1e-5)
+            # the sinks and the `max_lookback` most recent positions
+            n_attended = (att[0, 0] > 0).sum(-1)
+            assert n_attended.max() == mha.num_sink_tokens + max_lookback
+
+
+@pytest.mark.modules
+def test_vap_precision():
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    x = torch.randn(1, 2, int(2 * SAMPLE_RATE))
+    target = model.probs(x)
+    model.set_precision("bf16")
+    out = model.probs(x)
+    assert out["probs"].dtype == torch.float32
+    assert torch.isfinite(out["H"]).all()
+    for k in ["p_now", "p_future"]:
+        assert (out[k] - target[k]).abs().max() < 0.1, k
+
+
+@pytest.mark.modules
+def test_vap_forward_windows():
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    x = torch.randn(1, 2, int(4 * SAMPLE_RATE))
+    n_frames = 2 * FRAME_HZ
+    with torch.no_grad():
+        # the session encoder (in chunks) is the encoder
+        x1, x2 = model.encode_session(x, chunk_time=0.37)
+        t1, t2 = model.encode_audio(x)
+        assert torch.allclose(x1, t1, atol=1e-5) and torch.allclose(x2, t2, atol=1e-5)
+
+        out = model.forward_windows(x, [0, FRAME_HZ, 3 * FRAME_HZ], n_frames)
+        target = model(x[..., : 2 * SAMPLE_RATE])
+    assert out["logits"].shape == (3, n_frames, model.objective.n_classes)
+    # the first window only differs within the encoder lookahead (last frame)
+    assert torch.allclose(
+        out["logits"][0, :-1], target["logits"][0, :-1], atol=1e-4
+    )
+
+
+@pytest.mark.modules
+def test_load_model_from_state_dict_fast(tmp_path):
+    """The meta-device (assigned) model == the model it was saved from"""
+    from vap.modules.VAP import load_model_from_state_dict
+
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    torch.save(model.state_dict(), tmp_path / "sd.pt")
+    fast = load_model_from_state_dict(tmp_path / "sd.pt", fast=True).eval()
+    x = torch.randn(1, 2, int(2 * SAMPLE_RATE))
+    with torch.inference_mode():
+        out, target = fast(x), model(x)
+    for k in ["logits", "vad"]:
+        assert torch.allclose(out[k], target[k], atol=1e-5), k
+    assert not any(p.requires_grad for p in fast.encoder.encoder.parameters())
@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from vap.export import export_stream_step
+from vap.export_runner import ExportedStreamRunner
+from vap.modules.VAP import VAP
+from vap.modules.encoder import EncoderCPC
+from vap.modules.modules import TransformerStereo
+from vap.modules.streaming import VAPStreamSession
+
+
+@pytest.mark.modules
+def test_export_stream_step(tmp_path):
+    max_context_frames = 20
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    export_stream_step(model, tmp_path, max_context_frames=max_context_frames)
+    runner = ExportedStreamRunner(tmp_path)
+
+    # beyond the window: the sinks, the window and the frame count
+    x = torch.randn(1, 2, 320 * 2 * max_context_frames)
+    session = VAPStreamSession(model, max_context_frames=max_context_frames)
+    for c in x.split(runner.chunk_samples, dim=-1):
+        target = session.step(c)
+        out = runner.step(c)
+        for k in ["p_now", "p_future", "vad"]:
+            assert torch.allclose(out[k], target[k], atol=1e-4), k
+    assert runner.n_frames == session.n_frames
@@ -0,0 +1,31 @@
+import pytest
+import torch
+import torchaudio
+
+from vap.data.feature_store import FeatureStore, extract_features
+from vap.modules.VAP import VAP
+from vap.modules.encoder import EncoderCPC
+from vap.modules.modules import TransformerStereo
+
+
+@pytest.mark.modules
+def test_feature_store(tmp_path):
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    waveform = torch.randn(2, 3 * 16_000) * 0.1
+    audio_path = str(tmp_path / "session.wav")
+    torchaudio.save(audio_path, waveform, 16_000)
+
+    store = FeatureStore.create(tmp_path / "features", model.encoder)
+    assert extract_features(model.encoder, store, [audio_path], chunk_time=1) == 1
+    assert extract_features(model.encoder, store, [audio_path]) == 0
+    store.check_encoder(model.encoder)
+
+    # The features of the entire session are those of the waveform
+    x, _ = torchaudio.load(audio_path)
+    features = store.get(audio_path, 0, 3).unsqueeze(0)
+    assert features.shape == (1, 2, 300, model.encoder.output_dim)
+    with torch.no_grad():
+        target = model(x.unsqueeze(0))
+        out = model(features=features)
+    assert torch.allclose(out["logits"], target["logits"], atol=1e-4)
+    assert store.get(audio_path, 2, 4).shape[1] == 200
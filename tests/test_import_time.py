@@ -0,0 +1,9 @@
+import pytest
+
+from vap.utils.import_time import INFERENCE, check_imports
+
+
+@pytest.mark.modules
+def test_inference_imports():
+    """The inference path does not import the training/plotting dependencies"""
+    assert check_imports(INFERENCE) == {}
@@ -0,0 +1,83 @@
+import pytest
+import torch
+
+from vap.infer import (
+    CorpusInference,
+    get_audio_paths,
+    get_output_path,
+    load_vap_model,
+)
+from vap.modules.VAP import VAP, step_extraction
+from vap.modules.encoder import EncoderCPC
+from vap.modules.modules import TransformerStereo
+from vap.utils.utils import read_json
+
+SAMPLE_RATE = 16_000
+
+
+@pytest.mark.modules
+def test_corpus_inference(tmp_path):
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    waveforms = {
+        "a.wav": torch.randn(2, int(9.5 * SAMPLE_RATE)),
+        "b.wav": torch.randn(2, int(7.1 * SAMPLE_RATE)),
+        "c.wav": torch.randn(2, int(2.0 * SAMPLE_RATE)),
+    }
+
+    inference = CorpusInference(
+        model, str(tmp_path), chunk_time=4, step_time=2, batch_size=3
+    )
+    for audio_path, w in waveforms.items():
+        inference.add(audio_path, w)
+    inference.flush()
+
+    for audio_path, w in waveforms.items():
+        out = read_json(get_output_path(audio_path, str(tmp_path)))
+        target = step_extraction(
+            w.unsqueeze(0), model, chunk_time=4, step_time=2, pbar=False
+        )
+        p_now = torch.tensor(out["p_now"])
+        assert p_now.shape == target["p_now"].shape
+        assert torch.allclose(p_now, target["p_now"], atol=1e-5)
+
+
+@pytest.mark.modules
+def test_corpus_inference_audio_dir(tmp_path):
+    """Files with the same name in different subdirectories do not collide"""
+    import torchaudio
+
+    audio_dir, output_dir = tmp_path / "audio", tmp_path / "out"
+    for sub in ["a", "b"]:
+        (audio_dir / sub).mkdir(parents=True)
+        torchaudio.save(
+            str(audio_dir / sub / "session1.wav"), torch.randn(2, 16_000), 16_000
+        )
+    audio_paths = get_audio_paths(audio_dir=str(audio_dir))
+    assert len(audio_paths) == 2
+
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    inference = CorpusInference(
+        model, str(output_dir), chunk_time=4, step_time=2, audio_dir=str(audio_dir)
+    )
+    for audio_path in audio_paths:
+        inference.add(audio_path, torch.randn(2, SAMPLE_RATE))
+    inference.flush()
+
+    outputs = {
+        get_output_path(p, str(output_dir), audio_dir=str(audio_dir))
+        for p in audio_paths
+    }
+    assert outputs == {output_dir / "a/session1.json", output_dir / "b/session1.json"}
+    assert all(p.exists() for p in outputs)
+
+
+@pytest.mark.modules
+def test_load_vap_model_checkpoint(tmp_path):
+    """A VAPModule checkpoint loads (fast) without the lightning module"""
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    sd = {f"model.{k}": v for k, v in model.state_dict().items()}
+    torch.save({"state_dict": sd}, tmp_path / "checkpoint.ckpt")
+    loaded = load_vap_model(checkpoint=str(tmp_path / "checkpoint.ckpt")).cpu()
+    x = torch.randn(1, 2, SAMPLE_RATE)
+    with torch.inference_mode():
+        assert torch.allclose(loaded.eval()(x)["logits"], model(x)["logits"])
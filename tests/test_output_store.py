@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from vap.utils.output_store import OutputStoreReader, write_output_store
+
+
+def get_output(n_frames: int = 500) -> dict[str, torch.Tensor]:
+    probs = torch.randn(1, n_frames, 256).softmax(-1)
+    return {
+        "probs": probs,
+        "vad": torch.rand(1, n_frames, 2),
+        "H": torch.rand(1, n_frames) * 8,
+        "p_now": torch.rand(1, n_frames),
+        "p_future": torch.rand(1, n_frames),
+        "p": torch.rand(4, 1, n_frames),
+    }
+
+
+@pytest.mark.modules
+@pytest.mark.parametrize(("dtype", "atol"), [("float16", 1e-3), ("uint8", 0.02)])
+def test_output_store(tmp_path, dtype, atol):
+    out = get_output()
+    path = tmp_path / "session"
+    write_output_store(out, path, fields=["p_now", "vad", "H", "p"], dtype=dtype)
+
+    reader = OutputStoreReader(path)
+    assert reader.fields == ["p_now", "vad", "H", "p"]
+    assert reader.n_frames == 500
+    assert reader.duration == 10
+
+    assert torch.allclose(reader["p_now"], out["p_now"][0], atol=atol)
+    assert torch.allclose(reader["vad"], out["vad"][0], atol=atol)
+    assert torch.allclose(reader["p"], out["p"][:, 0].t(), atol=atol)
+    # Entropy is not bounded by 1 (scaled by its range when quantized)
+    assert torch.allclose(reader["H"], out["H"][0], atol=8 * atol)
+
+    # Time slices
+    p_now = reader.get("p_now", start_time=2, end_time=4.5)
+    assert p_now.shape == (125,)
+    assert torch.allclose(p_now, out["p_now"][0, 100:225], atol=atol)
+    vad = reader.get("vad", start_time=9)
+    assert vad.shape == (50, 2)
@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+from vap.modules.VAP import VAP
+from vap.modules.encoder import EncoderCPC
+from vap.modules.modules import TransformerStereo
+from vap.modules.streaming import VAPStreamSession
+from vap.utils.profiling import NULL_SPAN, profiler, span
+
+STAGES = ["encode_audio", "feature_projection", "ar_channel", "ar", "combinator"]
+
+
+@pytest.mark.modules
+def test_profiler():
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    x = torch.randn(1, 2, 16_000)
+
+    assert span("forward") is NULL_SPAN
+    try:
+        profiler.enable()
+        with torch.inference_mode():
+            model(x)
+        for stage in ["forward", "head"] + STAGES:
+            assert stage in profiler.last_call, stage
+        assert profiler.counters["frames"] == 50
+
+        session = VAPStreamSession(model)
+        for chunk in x.split(320, dim=-1):
+            session.step(chunk)
+        assert "stream_step" in profiler.last_call
+        report = profiler.report()
+        assert report["stream_step"]["count"] == 50
+        assert report["forward"]["count"] == 1
+    finally:
+        profiler.disable()
+    assert span("forward") is NULL_SPAN
@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from vap.modules.VAP import VAP
+from vap.modules.encoder import EncoderCPC
+from vap.modules.modules import TransformerStereo
+from vap.modules.streaming import VAPStreamSession
+from vap.quantization import load_quantized_model, quantize_model, save_quantized_model
+
+
+@pytest.mark.modules
+@pytest.mark.parametrize("static_encoder", [False, True])
+def test_quantize_model(static_encoder, tmp_path):
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    x = torch.randn(1, 2, 16_000)
+    target = model.probs(x)
+
+    calibration = [torch.randn(2, 2, 16_000)] if static_encoder else None
+    qmodel = quantize_model(model, calibration)
+    path = tmp_path / "int8.pt"
+    save_quantized_model(qmodel, path)
+    saved = qmodel.probs(x)
+    qmodel = load_quantized_model(path)
+    out = qmodel.probs(x)
+    assert torch.equal(out["p_now"], saved["p_now"])
+    assert (out["p_now"] - target["p_now"]).abs().max() < 0.2
+
+    # the quantized model streams (dynamic activation ranges differ per chunk)
+    session = VAPStreamSession(qmodel)
+    outs = [session.step(c) for c in x.split(320, dim=-1)]
+    outs.append(session.flush())
+    p_now = torch.cat([o["p_now"] for o in outs], dim=1)
+    assert p_now.shape == target["p_now"].shape
+    assert (p_now - target["p_now"]).abs().max() < 0.2
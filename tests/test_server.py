@@ -0,0 +1,43 @@
+import asyncio
+import json
+import pytest
+import torch
+
+from vap.modules.VAP import VAP
+from vap.modules.encoder import EncoderCPC
+from vap.modules.modules import TransformerStereo
+from vap.server import VAPServer
+
+
+async def stream_audio(server: VAPServer, pcm: bytes, chunk_bytes: int) -> list:
+    s = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    port = s.sockets[0].getsockname()[1]
+    async with s:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for i in range(0, len(pcm), chunk_bytes):
+            writer.write(pcm[i : i + chunk_bytes])
+            await writer.drain()
+        writer.write_eof()
+        data = await reader.read()
+        writer.close()
+    return [json.loads(line) for line in data.decode().splitlines()]
+
+
+@pytest.mark.modules
+@pytest.mark.parametrize("decimation", [1, 5])
+def test_server(decimation):
+    model = VAP(EncoderCPC(), TransformerStereo()).eval()
+    server = VAPServer(model, decimation=decimation)
+
+    pcm = (torch.randn(16_000, 2) * 3000).clamp(-32768, 32767).short()
+    waveform = pcm.float().t().unsqueeze(0) / 32768.0
+    target = model.probs(waveform)
+
+    # odd chunk size: samples are split across reads
+    frames = asyncio.run(stream_audio(server, pcm.numpy().tobytes(), 1001))
+    n_frames = target["p_now"].shape[-1]
+    assert [f["frame"] for f in frames] == list(range(0, n_frames, decimation))
+    p_now = torch.tensor([f["p_now"] for f in frames])
+    vad = torch.tensor([f["vad"] for f in frames])
+    assert torch.allclose(p_now, target["p_now"][0, ::decimation], atol=1e-4)
+    assert torch.allclose(vad, target["vad"][0, ::decimation], atol=1e-4)
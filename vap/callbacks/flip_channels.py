@@ -10,6 +10,8 @@ def flip_batch_channels(batch):
         elif k == "waveform":
             if v.shape[1] == 2:  # stereo audio
                 v = v.flip(-2)  # (B, 2, N_SAMPLES)
+        elif k == "features":
+            v = v.flip(1)  # (B, 2, N_FRAMES, D)
         batch[k] = v
     return batch
 
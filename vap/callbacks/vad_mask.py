@@ -50,6 +50,9 @@ class VADMaskCallback(L.Callback):
         self.on_test = on_test
 
     def mask(self, batch):
+        if "waveform" not in batch:
+            # precomputed encoder features, there is no audio to mask
+            return batch
         mask_vad = batch["vad"][:, -self.horizon_frames :, :]
         batch["waveform"] = vad_mask_batch(
             batch["waveform"], mask_vad, scale=self.scale
@@ -0,0 +1,199 @@
+"""
+Guardrails for reduced precision inference (`VAP.set_precision`).
+
+Runs the fp32 and the reduced precision model over a dataset csv (see
+`VAPDataset`) and reports the max/mean absolute deviation of `p_now` and
+`p_future`, the hold/shift accuracy (`VAPMetric`) of both and the time (and
+real time factor) of the forward passes.
+
+python vap/compare_precision.py --state_dict example/checkpoints/VAP_state_dict.pt \\
+    --csv example/data/sliding_dev.csv --precision bf16
+"""
+import json
+import time
+import torch
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from torch import Tensor
+from torch.utils.data import DataLoader
+from typing import Callable, Optional
+
+from vap.events.events import EventConfig
+from vap.metrics import VAPMetric
+from vap.modules.VAP import VAP, PRECISIONS
+
+
+FIELDS = ["p_now", "p_future"]
+
+
+def hold_shift_accuracy(metric: VAPMetric) -> dict[str, float]:
+    """hold, shift and balanced accuracy of the hold/shift (`hs`) events"""
+    score = metric.compute().get("hs")
+    if score is None:
+        return {"hold": float("nan"), "shift": float("nan"), "balanced": float("nan")}
+    hold, shift = score["acc"].tolist()
+    return {"hold": hold, "shift": shift, "balanced": (hold + shift) / 2}
+
+
+@torch.inference_mode()
+def compare_probs(
+    reference: Callable[[Tensor], dict[str, Tensor]],
+    candidate: Callable[[Tensor], dict[str, Tensor]],
+    dloader: DataLoader,
+    names: tuple[str, str] = ("reference", "candidate"),
+    event_config: Optional[EventConfig] = None,
+    max_batches: Optional[int] = None,
+    device: str = "cpu",
+    sample_rate: int = 16_000,
+) -> dict:
+    """
+    Compare the `VAP.probs` like output of `candidate` to `reference`.
+
+    Arguments:
+        reference:      waveform -> probs, e.g. `model.probs`
+        candidate:      waveform -> probs
+        dloader:        batches of `VAPDataset` ("waveform", "vad")
+        names:          the names of reference and candidate in the report
+
+    Return:
+        deviation:      {field: {"max", "mean"}} absolute deviation from reference
+        accuracy:       {*names, "delta"} hold/shift accuracy
+        time:           {*names} total time (seconds)
+        rtf:            {*names} real time factor (time / audio duration)
+    """
+    event_config = event_config if event_config is not None else EventConfig()
+    fns = dict(zip(names, [reference, candidate]))
+    metrics = {name: VAPMetric(event_config) for name in names}
+    times = {name: 0.0 for name in names}
+    dev_max = {f: 0.0 for f in FIELDS}
+    dev_sum = {f: 0.0 for f in FIELDS}
+    n_frames = 0
+    audio_time = 0.0
+
+    for i, batch in enumerate(dloader):
+        if max_batches is not None and i >= max_batches:
+            break
+        waveform = batch["waveform"].to(device)
+        out = {}
+        for name, fn in fns.items():
+            t = time.perf_counter()
+            out[name] = fn(waveform)
+            times[name] += time.perf_counter() - t
+            metrics[name].update_batch(out[name], batch["vad"])
+
+        ref, cand = out[names[0]], out[names[1]]
+        for f in FIELDS:
+            d = (cand[f] - ref[f]).abs()
+            dev_max[f] = max(dev_max[f], d.max().item())
+            dev_sum[f] += d.sum().item()
+        n_frames += ref["p_now"].numel()
+        audio_time += waveform.shape[0] * waveform.shape[-1] / sample_rate
+
+    acc = {name: hold_shift_accuracy(metrics[name]) for name in names}
+    acc["delta"] = {k: acc[names[1]][k] - acc[names[0]][k] for k in acc[names[0]]}
+    return {
+        "names": list(names),
+        "n_frames": n_frames,
+        "deviation": {
+            f: {"max": dev_max[f], "mean": dev_sum[f] / max(n_frames, 1)}
+            for f in FIELDS
+        },
+        "accuracy": acc,
+        "time": times,
+        "rtf": {name: t / max(audio_time, 1e-9) for name, t in times.items()},
+    }
+
+
+def compare_precision(
+    model: VAP,
+    dloader: DataLoader,
+    precision: str = "bf16",
+    event_config: Optional[EventConfig] = None,
+    max_batches: Optional[int] = None,
+) -> dict:
+    """`compare_probs` of the reduced `precision` and fp32 (see `VAP.set_precision`)"""
+    assert precision in PRECISIONS, f"precision must be one of {list(PRECISIONS)}"
+
+    def get_probs(p: str) -> Callable[[Tensor], dict[str, Tensor]]:
+        def fn(waveform: Tensor) -> dict[str, Tensor]:
+            model.set_precision(p)
+            return model.probs(waveform)
+
+        return fn
+
+    model_precision = model.precision
+    try:
+        return compare_probs(
+            get_probs("fp32"),
+            get_probs(precision),
+            dloader,
+            names=("fp32", precision),
+            event_config=event_config,
+            max_batches=max_batches,
+            device=model.device,
+            sample_rate=model.sample_rate,
+        )
+    finally:
+        model.set_precision(model_precision)
+
+
+def format_report(report: dict) -> str:
+    ref, cand = report["names"]
+    s = f"{cand} vs {ref} ({report['n_frames']} frames)"
+    for f, d in report["deviation"].items():
+        s += f"\n{f:<10} max: {d['max']:.5f}  mean: {d['mean']:.6f}"
+    s += f"\n{'hold/shift acc':<16}{'hold':>10}{'shift':>10}{'balanced':>10}"
+    for name in [ref, cand, "delta"]:
+        a = report["accuracy"][name]
+        s += f"\n{name:<16}{a['hold']:>10.4f}{a['shift']:>10.4f}{a['balanced']:>10.4f}"
+    for name in [ref, cand]:
+        t, rtf = report["time"][name], report["rtf"][name]
+        s += f"\n{name:<16}time: {t:.2f}s  rtf: {rtf:.4f}"
+    return s
+
+
+def get_args():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-sd", "--state_dict", type=str, default=None)
+    parser.add_argument("-c", "--checkpoint", type=str, default=None)
+    parser.add_argument(
+        "--csv", type=str, required=True, help="Dataset csv (see VAPDataset)"
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="bf16",
+        choices=[p for p in PRECISIONS if p != "fp32"],
+    )
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--max_batches", type=int, default=None)
+    parser.add_argument(
+        "--output", type=str, default=None, help="Save the report (json)"
+    )
+    args = parser.parse_args()
+    assert (
+        args.state_dict is not None or args.checkpoint is not None
+    ), "Must provide state_dict or checkpoint"
+    return args
+
+
+if __name__ == "__main__":
+    from vap.data.datamodule import VAPDataset
+    from vap.infer import load_vap_model
+
+    args = get_args()
+    model = load_vap_model(args.state_dict, args.checkpoint).eval()
+    dset = VAPDataset(args.csv, sample_rate=model.sample_rate, frame_hz=model.frame_hz)
+    dloader = DataLoader(
+        dset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False
+    )
+    report = compare_precision(
+        model, dloader, precision=args.precision, max_batches=args.max_batches
+    )
+    print(format_report(report))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved report -> {args.output}")
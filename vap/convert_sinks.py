@@ -0,0 +1,49 @@
+"""
+Convert a model with the legacy attention sink tokens (`sink_layout="tokens"`,
+the sinks are processed by the transformer towers on every forward) to the
+precomputed sink keys/values (`sink_layout="kv"`) with identical output (eval).
+
+The converted state dict loads with `load_model_from_state_dict`.
+
+python vap/convert_sinks.py --state_dict example/checkpoints/VAP_state_dict.pt \\
+    --output example/checkpoints/VAP_state_dict_kv.pt
+python vap/convert_sinks.py --checkpoint runs/last.ckpt --output VAP_state_dict_kv.pt
+"""
+import torch
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from vap.modules.VAP import VAP
+
+
+def convert_sinks(model: VAP) -> VAP:
+    """In-place conversion of the sinks of `model.transformer` to `sink_layout="kv"`"""
+    model.transformer.convert_sinks_to_kv()
+    return model
+
+
+def get_args():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-sd", "--state_dict", type=str, default=None)
+    parser.add_argument("-c", "--checkpoint", type=str, default=None)
+    parser.add_argument(
+        "-o", "--output", type=str, required=True, help="Converted state dict (.pt)"
+    )
+    args = parser.parse_args()
+    assert (
+        args.state_dict is not None or args.checkpoint is not None
+    ), "Must provide state_dict or checkpoint"
+    return args
+
+
+if __name__ == "__main__":
+    from vap.infer import load_vap_model
+
+    args = get_args()
+    model = load_vap_model(args.state_dict, args.checkpoint).cpu()
+    layout = model.transformer.sink_layout
+    model = convert_sinks(model)
+    torch.save(model.state_dict(), args.output)
+    print(f"Sinks: {layout} -> {model.transformer.sink_layout}")
+    print(f"Saved state dict -> {args.output}")
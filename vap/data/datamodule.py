@@ -10,6 +10,7 @@ from typing import Optional, Mapping, Any
 import matplotlib.pyplot as plt
 
 
+from vap.data.feature_store import FeatureStore
 from vap.utils.audio import load_waveform, mono_to_stereo
 from vap.utils.utils import vad_list_to_onehot
 from vap.utils.plot import plot_melspectrogram, plot_vad
@@ -76,6 +77,12 @@ def plot_dset_sample(d):
 
 
 class VAPDataset(Dataset):
+    """
+    With a `features_dir` (see `vap.data.feature_store`) the samples hold the
+    precomputed (frozen) encoder "features" (2, n_frames, D) of the window
+    instead of the "waveform".
+    """
+
     def __init__(
         self,
         path: str,
@@ -84,9 +91,14 @@ class VAPDataset(Dataset):
         sample_rate: int = 16_000,
         frame_hz: int = 50,
         mono: bool = False,
+        features_dir: Optional[str] = None,
     ) -> None:
         self.path = path
         self.df = load_df(path)
+        self.features = None
+        if features_dir is not None:
+            assert not mono, "Precomputed features are stereo"
+            self.features = FeatureStore(features_dir)
 
         self.sample_rate = sample_rate
         self.frame_hz = frame_hz
@@ -105,6 +117,19 @@ class VAPDataset(Dataset):
         # so we round it to nearest second
         # TODO: why can this be off, or why bad waveform shapes?
         dur = round(d["end"] - d["start"])
+        vad = vad_list_to_onehot(
+            d["vad_list"], duration=dur + self.horizon, frame_hz=self.frame_hz
+        )
+        if self.features is not None:
+            return {
+                "session": d.get("session", ""),
+                "features": self.features.get(
+                    d["audio_path"], d["start"], d["start"] + self.duration
+                ),
+                "vad": vad,
+                "dataset": d.get("dataset", ""),
+            }
+
         w, _ = load_waveform(
             d["audio_path"],
             start_time=d["start"],
@@ -128,10 +153,6 @@ class VAPDataset(Dataset):
         if not self.mono and w.shape[0] == 1:
             w = mono_to_stereo(w, d["vad_list"], sample_rate=self.sample_rate)
 
-        vad = vad_list_to_onehot(
-            d["vad_list"], duration=dur + self.horizon, frame_hz=self.frame_hz
-        )
-
         return {
             "session": d.get("session", ""),
             "waveform": w,
@@ -140,6 +161,60 @@ class VAPDataset(Dataset):
         }
 
 
+class VAPSessionDataset(Dataset):
+    """
+    The windows of a (sliding window) dataset csv grouped by session (audio
+    path), for evaluation: every session is loaded (and encoded, see
+    `VAP.forward_windows`) once instead of once per (overlapping) window.
+
+    A sample is a session: the entire "waveform" (2, n_samples), the "vad"
+    (n_windows, n_frames + horizon, 2) and the "starts" (frames) of all of
+    its windows, which start at the nearest frame.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        horizon: float = 2,
+        duration: float = 20,
+        sample_rate: int = 16_000,
+        frame_hz: int = 50,
+    ) -> None:
+        self.path = path
+        self.df = load_df(path)
+        self.sessions = [df for _, df in self.df.groupby("audio_path", sort=False)]
+
+        self.sample_rate = sample_rate
+        self.frame_hz = frame_hz
+        self.horizon = horizon
+        self.duration = duration
+        self.n_frames = int(self.duration * self.frame_hz)
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __getitem__(self, idx: int) -> dict[str, Any]:
+        df = self.sessions[idx]
+        d = df.iloc[0]
+        w, _ = load_waveform(d["audio_path"], sample_rate=self.sample_rate)
+        vad = [
+            vad_list_to_onehot(
+                vad_list,
+                duration=round(end - start) + self.horizon,
+                frame_hz=self.frame_hz,
+            )
+            for vad_list, start, end in zip(df["vad_list"], df["start"], df["end"])
+        ]
+        return {
+            "session": d.get("session", ""),
+            "waveform": w,
+            "vad": torch.stack(vad),
+            "starts": [round(start * self.frame_hz) for start in df["start"]],
+            "n_frames": self.n_frames,
+            "dataset": d.get("dataset", ""),
+        }
+
+
 class VAPDataModule(L.LightningDataModule):
     def __init__(
         self,
@@ -154,6 +229,8 @@ class VAPDataModule(L.LightningDataModule):
         num_workers: int = 0,
         pin_memory: bool = True,
         prefetch_factor: int = 2,
+        features_dir: Optional[str] = None,
+        session_eval: bool = False,
         **kwargs,
     ):
         super().__init__()
@@ -168,6 +245,9 @@ class VAPDataModule(L.LightningDataModule):
         self.horizon = horizon
         self.sample_rate = sample_rate
         self.frame_hz = frame_hz
+        self.features_dir = features_dir
+        # validation/test by session, see `VAPSessionDataset`
+        self.session_eval = session_eval
 
         # DataLoder
         self.batch_size = batch_size
@@ -183,6 +263,8 @@ class VAPDataModule(L.LightningDataModule):
         s += f"\n\tHorizon: {self.horizon}"
         s += f"\n\tSample rate: {self.sample_rate}"
         s += f"\n\tFrame Hz: {self.frame_hz}"
+        s += f"\n\tFeatures: {self.features_dir}"
+        s += f"\n\tSession eval: {self.session_eval}"
         s += f"\nData"
         s += f"\n\tbatch_size: {self.batch_size}"
         s += f"\n\tpin_memory: {self.pin_memory}"
@@ -203,6 +285,24 @@ class VAPDataModule(L.LightningDataModule):
             if not isfile(self.test_path):
                 print("WARNING: no TEST data found: ", self.test_path)
 
+    def get_eval_dset(self, path: str) -> Dataset:
+        if self.session_eval:
+            assert not self.mono, "Session evaluation is stereo"
+            return VAPSessionDataset(
+                path,
+                horizon=self.horizon,
+                sample_rate=self.sample_rate,
+                frame_hz=self.frame_hz,
+            )
+        return VAPDataset(
+            path,
+            horizon=self.horizon,
+            sample_rate=self.sample_rate,
+            frame_hz=self.frame_hz,
+            mono=self.mono,
+            features_dir=self.features_dir,
+        )
+
     def setup(self, stage: Optional[str] = "fit"):
         """Loads the datasets"""
 
@@ -217,71 +317,74 @@ class VAPDataModule(L.LightningDataModule):
                 sample_rate=self.sample_rate,
                 frame_hz=self.frame_hz,
                 mono=self.mono,
+                features_dir=self.features_dir,
             )
-            self.val_dset = VAPDataset(
-                self.val_path,
-                horizon=self.horizon,
-                sample_rate=self.sample_rate,
-                frame_hz=self.frame_hz,
-                mono=self.mono,
-            )
+            self.val_dset = self.get_eval_dset(self.val_path)
 
         if stage in (None, "test"):
             assert self.test_path is not None, "TEST path is None"
             assert isfile(self.test_path), f"TEST path not found: {self.test_path}"
-            self.test_dset = VAPDataset(
-                self.test_path,
-                horizon=self.horizon,
-                sample_rate=self.sample_rate,
-                frame_hz=self.frame_hz,
-                mono=self.mono,
-            )
+            self.test_dset = self.get_eval_dset(self.test_path)
 
     def collate_fn(self, batch: list[dict[str, Any]]):
         batch_stacked = {k: [] for k in batch[0].keys()}
 
+        # the input is either the "waveform" or the "features"
+        inp = "features" if "features" in batch_stacked else "waveform"
         for b in batch:
             batch_stacked["session"].append(b["session"])
             batch_stacked["dataset"].append(b["dataset"])
-            batch_stacked["waveform"].append(b["waveform"])
+            batch_stacked[inp].append(b[inp])
             batch_stacked["vad"].append(b["vad"])
 
-        batch_stacked["waveform"] = torch.stack(batch_stacked["waveform"])
+        batch_stacked[inp] = torch.stack(batch_stacked[inp])
         batch_stacked["vad"] = torch.stack(batch_stacked["vad"])
         return batch_stacked
 
-    def train_dataloader(self):
+    def collate_session(self, batch: list[dict[str, Any]]):
+        """A single session (see `VAPSessionDataset`), the windows are the batch"""
+        assert len(batch) == 1, "Session batches hold a single session"
+        d = dict(batch[0])
+        d["waveform"] = d["waveform"].unsqueeze(0)
+        return d
+
+    def get_eval_dataloader(self, dset: Dataset) -> DataLoader:
+        if self.session_eval:
+            return DataLoader(
+                dset,
+                batch_size=1,
+                pin_memory=self.pin_memory,
+                num_workers=self.num_workers,
+                prefetch_factor=self.prefetch_factor,
+                collate_fn=self.collate_session,
+                shuffle=False,
+            )
         return DataLoader(
-            self.train_dset,
+            dset,
             batch_size=self.batch_size,
             pin_memory=self.pin_memory,
             num_workers=self.num_workers,
             prefetch_factor=self.prefetch_factor,
             collate_fn=self.collate_fn,
-            shuffle=True,
+            shuffle=False,
         )
 
-    def val_dataloader(self):
+    def train_dataloader(self):
         return DataLoader(
-            self.val_dset,
+            self.train_dset,
             batch_size=self.batch_size,
             pin_memory=self.pin_memory,
             num_workers=self.num_workers,
             prefetch_factor=self.prefetch_factor,
             collate_fn=self.collate_fn,
-            shuffle=False,
+            shuffle=True,
         )
 
+    def val_dataloader(self):
+        return self.get_eval_dataloader(self.val_dset)
+
     def test_dataloader(self):
-        return DataLoader(
-            self.test_dset,
-            batch_size=self.batch_size,
-            pin_memory=self.pin_memory,
-            num_workers=self.num_workers,
-            prefetch_factor=self.prefetch_factor,
-            collate_fn=self.collate_fn,
-            shuffle=False,
-        )
+        return self.get_eval_dataloader(self.test_dset)
 
 
 if __name__ == "__main__":
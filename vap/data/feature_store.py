@@ -0,0 +1,231 @@
+"""
+Persistent (frozen) encoder features for training without running the encoder.
+
+The frozen CPC features (`EncoderCPC.encode`, `gEncoder` + `gAR` at 100Hz) of
+every session are extracted once (incrementally, `EncoderCPC.encode_step`)
+and saved as a (2, n_frames, D) `.npy` array which is memory-mapped by
+`VAPDataset(features_dir=...)` and sliced per window. The (trainable)
+`downsample` runs in the model, `VAP(features=...)`.
+
+    features_dir/
+        {encoder}-{weights hash}/       one directory per encoder (identity)
+            meta.json                   encoder identity, sample rate, ...
+            {audio path hash}.npy       (2, n_frames, D) per session
+
+The features of a window are sliced from the features of the entire session,
+i.e. the `gAR` (GRU) state at the start of the window holds the preceding
+audio of the session, unlike a window encoded on its own.
+
+python vap/data/feature_store.py --csv data/splits/train_sliding.csv \\
+    data/splits/val_sliding.csv --output data/features
+"""
+import hashlib
+import json
+import numpy as np
+import os
+import torch
+import torch.nn as nn
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import OrderedDict
+from pathlib import Path
+from torch import Tensor
+from typing import Iterable
+
+from vap.utils.audio import load_waveform
+
+
+def weights_hash(module: nn.Module) -> str:
+    """A hash of the parameters (and buffers) of `module`"""
+    h = hashlib.sha1()
+    for name, t in sorted(module.state_dict().items()):
+        h.update(name.encode())
+        h.update(str(t.dtype).encode())
+        t = t.detach().cpu().contiguous().reshape(-1)
+        h.update(t.view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def get_encoder_identity(encoder: nn.Module) -> dict:
+    """The identity of the frozen part of `encoder` (`EncoderCPC.encode`)"""
+    return {
+        "encoder": encoder.__class__.__name__,
+        "weights": weights_hash(encoder.encoder),
+        "sample_rate": encoder.sample_rate,
+        "features_ratio": encoder.features_ratio,
+        "dim": encoder.output_dim,
+    }
+
+
+def audio_path_key(audio_path: str) -> str:
+    return hashlib.sha1(os.path.abspath(audio_path).encode()).hexdigest()[:20]
+
+
+class FeatureStore:
+    """
+    The features of a single encoder (see `create`), memory-mapped on `get`.
+
+    Arguments:
+        path:       the encoder directory, `features_dir/{encoder}-{weights}`
+        max_open:   the number of sessions kept memory-mapped
+    """
+
+    def __init__(self, path: str, max_open: int = 128) -> None:
+        self.path = Path(path)
+        meta_path = self.path / "meta.json"
+        assert meta_path.exists(), f"No feature store (meta.json) found: {self.path}"
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        self.max_open = max_open
+        self.arrays = OrderedDict()
+
+    @classmethod
+    def create(
+        cls, root: str, encoder: nn.Module, dtype: str = "float32"
+    ) -> "FeatureStore":
+        """The (new or existing) store of `encoder` in `root`"""
+        identity = get_encoder_identity(encoder)
+        path = Path(root) / f"{identity['encoder']}-{identity['weights']}"
+        path.mkdir(parents=True, exist_ok=True)
+        meta_path = path / "meta.json"
+        if not meta_path.exists():
+            with open(meta_path, "w") as f:
+                json.dump({**identity, "dtype": dtype}, f, indent=2)
+        return cls(path)
+
+    @property
+    def frame_hz(self) -> float:
+        return self.meta["sample_rate"] / self.meta["features_ratio"]
+
+    def check_encoder(self, encoder: nn.Module, frozen: bool = True) -> None:
+        """Assert that the features are those of the (`frozen`) `encoder`"""
+        identity = get_encoder_identity(encoder)
+        for k, v in identity.items():
+            assert (
+                self.meta[k] == v
+            ), f"Feature store {self.path} was extracted with {k}={self.meta[k]}, the encoder has {v}"
+        if frozen:
+            assert not any(
+                p.requires_grad for p in encoder.encoder.parameters()
+            ), "Precomputed features require a frozen encoder"
+
+    def feature_path(self, audio_path: str) -> Path:
+        return self.path / f"{audio_path_key(audio_path)}.npy"
+
+    def __contains__(self, audio_path: str) -> bool:
+        return self.feature_path(audio_path).exists()
+
+    def write(self, audio_path: str, features: Tensor) -> None:
+        """Save the (2, n_frames, D) features of the session `audio_path`"""
+        path = self.feature_path(audio_path)
+        tmp = path.with_suffix(".tmp.npy")
+        np.save(tmp, features.cpu().float().numpy().astype(self.meta["dtype"]))
+        os.replace(tmp, path)  # never a partially written array
+
+    def load(self, audio_path: str) -> np.ndarray:
+        """The memory-mapped (2, n_frames, D) features of the session"""
+        key = str(audio_path)
+        if key in self.arrays:
+            self.arrays.move_to_end(key)
+            return self.arrays[key]
+        path = self.feature_path(audio_path)
+        assert path.exists(), f"No features for {audio_path} in {self.path}"
+        array = np.load(path, mmap_mode="r")
+        self.arrays[key] = array
+        if len(self.arrays) > self.max_open:
+            self.arrays.popitem(last=False)
+        return array
+
+    def get(self, audio_path: str, start_time: float, end_time: float) -> Tensor:
+        """The (2, n_frames, D) features of the window [start_time, end_time]"""
+        array = self.load(audio_path)
+        start = round(start_time * self.frame_hz)
+        n_frames = round((end_time - start_time) * self.frame_hz)
+        x = torch.from_numpy(np.array(array[:, start : start + n_frames]))
+        if x.shape[1] < n_frames:  # the end of the session, as in the waveform
+            x = torch.cat((x, x.new_zeros((2, n_frames - x.shape[1], x.shape[2]))), 1)
+        return x.float()
+
+
+@torch.inference_mode()
+def encode_session(
+    encoder: nn.Module, audio_path: str, chunk_time: float = 60
+) -> Tensor:
+    """
+    The `EncoderCPC.encode` features, (2, n_frames, D), of the (stereo) session
+    `audio_path`, incrementally over chunks of `chunk_time` seconds.
+    """
+    p = next(encoder.parameters())
+    waveform, _ = load_waveform(audio_path, sample_rate=encoder.sample_rate)
+    waveform = waveform.unsqueeze(1).to(device=p.device, dtype=p.dtype)  # (2, 1, n)
+    state = encoder.init_state(batch_size=2)  # the channels as a batch
+    chunk = int(chunk_time * encoder.sample_rate)
+    z = [encoder.encode_step(w, state) for w in waveform.split(chunk, dim=-1)]
+    z.append(encoder.encode_step(waveform[..., :0], state, flush=True))
+    return torch.cat(z, dim=1)
+
+
+def extract_features(
+    encoder: nn.Module,
+    store: FeatureStore,
+    audio_paths: Iterable[str],
+    chunk_time: float = 60,
+    overwrite: bool = False,
+) -> int:
+    """Extract the features of every (new) session, returns the number extracted"""
+    from tqdm import tqdm
+
+    store.check_encoder(encoder, frozen=False)
+    n = 0
+    for audio_path in tqdm(sorted(set(audio_paths)), desc="Extract features"):
+        if audio_path in store and not overwrite:
+            continue
+        store.write(audio_path, encode_session(encoder, audio_path, chunk_time))
+        n += 1
+    return n
+
+
+def get_args():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--csv", type=str, nargs="+", required=True, help="Dataset csv(s)"
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, required=True, help="Feature store root directory"
+    )
+    parser.add_argument(
+        "-sd",
+        "--state_dict",
+        type=str,
+        default=None,
+        help="The encoder of a VAP model (default: the pretrained CPC encoder)",
+    )
+    parser.add_argument("-c", "--checkpoint", type=str, default=None)
+    parser.add_argument(
+        "--dtype", type=str, default="float32", choices=["float32", "float16"]
+    )
+    parser.add_argument("--chunk_time", type=float, default=60)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--overwrite", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from vap.data.datamodule import load_df
+
+    args = get_args()
+    if args.state_dict is not None or args.checkpoint is not None:
+        from vap.infer import load_vap_model
+
+        encoder = load_vap_model(args.state_dict, args.checkpoint).encoder
+    else:
+        from vap.modules.encoder import EncoderCPC
+
+        encoder = EncoderCPC()
+    encoder = encoder.to(args.device).eval()
+    store = FeatureStore.create(args.output, encoder, dtype=args.dtype)
+    audio_paths = [p for csv in args.csv for p in load_df(csv)["audio_path"]]
+    n = extract_features(encoder, store, audio_paths, args.chunk_time, args.overwrite)
+    print(f"Extracted {n} sessions -> {store.path}")
+    print(f"Train with: datamodule.features_dir={store.path}")
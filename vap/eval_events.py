@@ -11,7 +11,8 @@ import pandas as pd
 from vap.data.dset_event import VAPClassificationDataset
 from vap.utils.utils import write_json
 from vap.utils.plot import plot_melspectrogram, plot_vap_probs, plot_vad
-from vap.modules.lightning_module import VAPModule, VAP, everything_deterministic
+from vap.modules.lightning_module import VAPModule, VAP
+from vap.utils.utils import everything_deterministic
 
 everything_deterministic()
 
@@ -0,0 +1,342 @@
+"""
+Ahead-of-time export of a fixed-chunk streaming step of `VAP`.
+
+`VAPStreamStep` is the step of `VAPStreamSession` (with `max_context_frames`)
+over one frame of audio (320 samples) with all of the state as explicit
+tensors, inputs and outputs of the step:
+
+    p_now, p_future, vad, *state = step(waveform, *state)
+
+    encoder (per channel):  the CPC conv tails, the GRU hidden state and the
+                            downsample `CConv1d` buffer
+    frames:                 (1,) the number of frames processed (int64)
+    key/values:             the `max_context_frames - 1` previous keys/values
+                            (B, heads, W - 1, D) of every attention module, a
+                            fixed size shift register (the sinks are constants)
+
+The first chunk of a stream has other conv tail shapes (the initial padding)
+so it is a separate graph (`first`). The exported artifact (a directory) runs
+with `vap.export_runner.ExportedStreamRunner`, which only depends on torch
+(and not on this repo).
+
+python vap/export.py --state_dict example/checkpoints/VAP_state_dict.pt \\
+    --output exported_step --max_context_frames 1000 --format torchscript
+"""
+import json
+import torch
+import torch.nn as nn
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from pathlib import Path
+from torch import Tensor
+from typing import Optional
+
+from vap.modules.VAP import VAP
+from vap.modules.modules import MultiHeadAttention, TransformerLayer
+
+
+FORMATS = ["torchscript", "export"]
+OUTPUTS = ["p_now", "p_future", "vad"]
+
+
+class VAPStreamStep(nn.Module):
+    """
+    Arguments:
+        model:              the (eval) `VAP` model with an incremental encoder
+        max_context_frames: the attention window (see `VAPStreamSession`)
+    """
+
+    def __init__(self, model: VAP, max_context_frames: int = 1000) -> None:
+        super().__init__()
+        assert (
+            max_context_frames > 1
+        ), f"max_context_frames must be > 1, got {max_context_frames}"
+        self.model = model.eval()
+        self.max_context_frames = max_context_frames
+        self.chunk_samples = model.encoder.downsample_ratio
+        encoder_state = self.flatten_encoder_state(model.encoder.init_state())
+        self.n_encoder_state = len(encoder_state)
+
+        # The attention modules in the order of their state
+        transformer = model.transformer
+        self.attention = []
+        for layer in transformer.ar_channel.layers:
+            self.attention.append(layer.mha)
+        for layer in transformer.ar_channel.layers:
+            self.attention.append(layer.mha)
+        for layer in transformer.ar.layers:
+            self.attention += [layer.mha, layer.mha_cross] * 2
+
+        # The sinks are the same for all inputs (and both channels)
+        with torch.no_grad():
+            cache = transformer.init_cache(1)
+        sinks = []
+        for c in cache["ar_channel"][0]:
+            sinks.append(c["self"])
+        for c in cache["ar_channel"][1]:
+            sinks.append(c["self"])
+        for c in cache["ar"]:
+            sinks += [c[0]["self"], c[0]["cross"], c[1]["self"], c[1]["cross"]]
+        for i, s in enumerate(sinks):
+            self.register_buffer(f"sink_k_{i}", s.k.detach().clone())
+            self.register_buffer(f"sink_v_{i}", s.v.detach().clone())
+
+    @staticmethod
+    def flatten_encoder_state(state: dict) -> list[Tensor]:
+        return [*state["gEncoder"], state["hidden"], *state["downsample"]]
+
+    def unflatten_encoder_state(self, state: list[Tensor]) -> dict:
+        n_conv = len(self.model.encoder.encoder.gEncoder.get_layers())
+        return {
+            "gEncoder": list(state[:n_conv]),
+            "hidden": state[n_conv],
+            "downsample": list(state[n_conv + 1 :]),
+        }
+
+    @torch.no_grad()
+    def init_state(self, batch_size: int = 1) -> list[Tensor]:
+        """The state of a new stream (the input of the `first` step)"""
+        encoder = self.model.encoder
+        gru = encoder.encoder.gAR.baseNet
+        p = next(self.model.parameters())
+        state = []
+        for _ in range(2):
+            s = encoder.init_state(batch_size)
+            s["hidden"] = torch.zeros(
+                (gru.num_layers, batch_size, gru.hidden_size),
+                device=p.device,
+                dtype=p.dtype,
+            )
+            state += self.flatten_encoder_state(s)
+        state.append(torch.zeros(1, dtype=torch.long, device=p.device))
+        for i, mha in enumerate(self.attention):
+            sink_k = getattr(self, f"sink_k_{i}")
+            shape = (batch_size, mha.num_heads, self.max_context_frames - 1)
+            state.append(p.new_zeros((*shape, sink_k.shape[-1])))
+            state.append(p.new_zeros((*shape, sink_k.shape[-1])))
+        return state
+
+    def get_bias(self, mha: MultiHeadAttention, n_sinks: int, frames: Tensor) -> Tensor:
+        """
+        The step mask (see `MultiHeadAttention.get_cache_mask`) of the sinks,
+        the W - 1 previous and the new position, (1, heads, 1, N + W), as in a
+        `KVCache` with `set_window(W)` after `frames` frames.
+        """
+        R = self.max_context_frames - 1
+        device = frames.device
+        # The sinks directly precede the (previous) frames in the cache
+        sink_dist = torch.arange(n_sinks, device=device) - n_sinks
+        sink_dist = sink_dist - torch.clamp(frames, max=R + 1)
+        r = torch.arange(R + 1, device=device)
+        dist = torch.cat((sink_dist, r - R))
+        bias = mha.get_relative_bias(dist, torch.float32)
+        invalid = torch.cat(
+            (
+                torch.zeros(n_sinks, dtype=torch.bool, device=device),
+                r < R - torch.clamp(frames, max=R),
+            )
+        )
+        bias = bias.masked_fill(invalid, float("-inf"))
+        return bias.view(1, -1, 1, n_sinks + R + 1)
+
+    def attention_step(
+        self,
+        i: int,
+        Q: Tensor,
+        K: Tensor,
+        V: Tensor,
+        kv_state: list[Tensor],
+        new_kv_state: list[Tensor],
+        frames: Tensor,
+    ) -> Tensor:
+        mha = self.attention[i]
+        q, k, v = mha.project(Q, K, V)
+        B = q.shape[0]
+        sink_k = getattr(self, f"sink_k_{i}").expand(B, -1, -1, -1)
+        sink_v = getattr(self, f"sink_v_{i}").expand(B, -1, -1, -1)
+        prev_k, prev_v = kv_state[2 * i], kv_state[2 * i + 1]
+        keys = torch.cat((sink_k, prev_k, k), dim=-2)
+        values = torch.cat((sink_v, prev_v, v), dim=-2)
+        bias = self.get_bias(mha, sink_k.shape[-2], frames)
+        y = mha.attend(q, keys, values, bias)
+        new_kv_state[2 * i] = keys[..., -prev_k.shape[-2] :, :]
+        new_kv_state[2 * i + 1] = values[..., -prev_v.shape[-2] :, :]
+        return mha.proj(mha.merge_heads(y))
+
+    def layer_step(
+        self,
+        layer: TransformerLayer,
+        i: int,
+        x: Tensor,
+        src: Optional[Tensor],
+        kv_state: list[Tensor],
+        new_kv_state: list[Tensor],
+        frames: Tensor,
+    ) -> Tensor:
+        """`TransformerLayer.step` (eval) with the attention state `i` (and `i + 1`)"""
+        z = layer.ln_self_attn(x)
+        x = x + self.attention_step(i, z, z, z, kv_state, new_kv_state, frames)
+        if src is not None:
+            z = layer.ln_src_attn(x)
+            x = x + self.attention_step(
+                i + 1, z, src, src, kv_state, new_kv_state, frames
+            )
+        z = layer.ln_ffnetwork(x)
+        return x + layer.ffnetwork(z)
+
+    def forward(self, waveform: Tensor, *state: Tensor) -> tuple[Tensor, ...]:
+        """
+        Arguments:
+            waveform:   (B, 2, 320) the next chunk of audio
+            state:      the state after the previous step (or `init_state`)
+
+        Return:
+            p_now, p_future:    (B, 1)
+            vad:                (B, 1, 2)
+            *state:             the new state
+        """
+        model = self.model
+        n = self.n_encoder_state
+        encoder_states = [
+            self.unflatten_encoder_state(state[:n]),
+            self.unflatten_encoder_state(state[n : 2 * n]),
+        ]
+        frames = state[2 * n]
+        kv_state = list(state[2 * n + 1 :])
+        new_kv_state = list(kv_state)
+
+        # Encoder, the states are updated in-place
+        x1 = model.encoder.step(waveform[:, :1], encoder_states[0])
+        x2 = model.encoder.step(waveform[:, 1:], encoder_states[1])
+        x1 = model.feature_projection(x1)
+        x2 = model.feature_projection(x2)
+
+        # Transformer, the attention modules in the order of `self.attention`
+        transformer = model.transformer
+        i = 0
+        for layer in transformer.ar_channel.layers:
+            x1 = self.layer_step(layer, i, x1, None, kv_state, new_kv_state, frames)
+            i += 1
+        for layer in transformer.ar_channel.layers:
+            x2 = self.layer_step(layer, i, x2, None, kv_state, new_kv_state, frames)
+            i += 1
+        for layer in transformer.ar.layers:
+            z1 = self.layer_step(layer, i, x1, x2, kv_state, new_kv_state, frames)
+            z2 = self.layer_step(layer, i + 2, x2, x1, kv_state, new_kv_state, frames)
+            x1, x2 = z1, z2
+            i += 4
+        x = transformer.ar.combinator(x1, x2)
+
+        # Head, probabilities
+        logits, vad = model.head(x, x1, x2)
+        probs = logits.softmax(dim=-1)
+        p_now = model.objective.probs_next_speaker_aggregate(probs, 0, 1)
+        p_future = model.objective.probs_next_speaker_aggregate(probs, 2, 3)
+
+        new_state = []
+        for s in encoder_states:
+            new_state += self.flatten_encoder_state(s)
+        new_state.append(frames + x.shape[1])
+        return (p_now, p_future, vad.sigmoid(), *new_state, *new_kv_state)
+
+    def first(self, waveform: Tensor, *state: Tensor) -> tuple[Tensor, ...]:
+        """The first step of a stream (the initial conv tail shapes)"""
+        return self.forward(waveform, *state)
+
+
+@torch.no_grad()
+def export_stream_step(
+    model: VAP,
+    path: str,
+    max_context_frames: int = 1000,
+    batch_size: int = 1,
+    format: str = "torchscript",
+) -> None:
+    """
+    Export the `first` and steady state steps of `VAPStreamStep` to the
+    directory `path` (see `vap.export_runner.ExportedStreamRunner`).
+    """
+    assert format in FORMATS, f"format must be one of {FORMATS}"
+    step = VAPStreamStep(model, max_context_frames).eval()
+    p = next(model.parameters())
+    waveform = torch.zeros(
+        (batch_size, 2, step.chunk_samples), device=p.device, dtype=p.dtype
+    )
+    init_state = step.init_state(batch_size)
+    # The steady state shapes: the state after the first step
+    state = step.first(waveform, *init_state)[len(OUTPUTS) :]
+    first_inputs = (waveform, *init_state)
+    inputs = (waveform, *state)
+
+    root = Path(path)
+    root.mkdir(parents=True, exist_ok=True)
+    if format == "torchscript":
+        traced = torch.jit.trace_module(
+            step, {"forward": inputs, "first": first_inputs}, check_trace=False
+        )
+        traced.save(str(root / "step.ts"))
+    else:
+        first = torch.export.export(FirstStep(step), first_inputs)
+        torch.export.save(first, str(root / "first.pt2"))
+        torch.export.save(torch.export.export(step, inputs), str(root / "step.pt2"))
+    torch.save([s.cpu() for s in init_state], root / "init_state.pt")
+    meta = {
+        "format": format,
+        "chunk_samples": step.chunk_samples,
+        "sample_rate": model.sample_rate,
+        "frame_hz": model.frame_hz,
+        "batch_size": batch_size,
+        "max_context_frames": max_context_frames,
+        "outputs": OUTPUTS,
+    }
+    with open(root / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+class FirstStep(nn.Module):
+    """`VAPStreamStep.first` as `forward` (for `torch.export`)"""
+
+    def __init__(self, step: VAPStreamStep) -> None:
+        super().__init__()
+        self.step = step
+
+    def forward(self, waveform: Tensor, *state: Tensor) -> tuple[Tensor, ...]:
+        return self.step.first(waveform, *state)
+
+
+def get_args():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-sd", "--state_dict", type=str, default=None)
+    parser.add_argument("-c", "--checkpoint", type=str, default=None)
+    parser.add_argument(
+        "-o", "--output", type=str, required=True, help="Output directory"
+    )
+    parser.add_argument("--format", type=str, default="torchscript", choices=FORMATS)
+    parser.add_argument(
+        "--max_context_frames",
+        type=int,
+        default=1000,
+        help="Attention window (frames) of the exported step",
+    )
+    parser.add_argument("--batch_size", type=int, default=1)
+    args = parser.parse_args()
+    assert (
+        args.state_dict is not None or args.checkpoint is not None
+    ), "Must provide state_dict or checkpoint"
+    return args
+
+
+if __name__ == "__main__":
+    from vap.infer import load_vap_model
+
+    args = get_args()
+    model = load_vap_model(args.state_dict, args.checkpoint).cpu().eval()
+    export_stream_step(
+        model,
+        args.output,
+        max_context_frames=args.max_context_frames,
+        batch_size=args.batch_size,
+        format=args.format,
+    )
+    print(f"Exported stream step ({args.format}) -> {args.output}")
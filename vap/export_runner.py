@@ -0,0 +1,71 @@
+"""
+Runs the streaming step exported by `vap/export.py` and only depends on torch,
+not on this repo (or its dependencies).
+
+Example:
+    runner = ExportedStreamRunner("exported_step")
+    for chunk in chunks:  # (B, 2, 320) -> 20ms
+        out = runner.step(chunk)
+        out["p_now"]  # (B, 1)
+"""
+import json
+import torch
+from pathlib import Path
+from torch import Tensor
+
+
+class ExportedStreamRunner:
+    """
+    A stream over the exported `VAPStreamStep` (see `vap.export`): the fixed
+    size chunks of `meta["chunk_samples"]` samples produce one frame each, the
+    same as `VAPStreamSession(model, max_context_frames=...)`. The last frames
+    of a stream (`VAPStreamSession.flush`) are not supported.
+    """
+
+    def __init__(self, path: str, device: str = "cpu") -> None:
+        root = Path(path)
+        with open(root / "meta.json") as f:
+            self.meta = json.load(f)
+        self.device = torch.device(device)
+        self.chunk_samples = self.meta["chunk_samples"]
+        self.batch_size = self.meta["batch_size"]
+        if self.meta["format"] == "torchscript":
+            module = torch.jit.load(str(root / "step.ts"), map_location=self.device)
+            self._first, self._step = module.first, module.forward
+        else:
+            self._first = torch.export.load(str(root / "first.pt2")).module()
+            self._step = torch.export.load(str(root / "step.pt2")).module()
+        self.init_state = [
+            s.to(self.device) for s in torch.load(root / "init_state.pt")
+        ]
+        self.reset()
+
+    def reset(self) -> None:
+        """Start a new stream"""
+        self.n_frames = 0
+        self.state = None
+
+    @torch.inference_mode()
+    def step(self, waveform: Tensor) -> dict[str, Tensor]:
+        """
+        Arguments:
+            waveform:   (B, 2, chunk_samples) the next chunk of audio
+
+        Return:
+            p_now, p_future:    (B, 1)
+            vad:                (B, 1, 2)
+        """
+        assert waveform.shape == (
+            self.batch_size,
+            2,
+            self.chunk_samples,
+        ), f"Expected a chunk of {(self.batch_size, 2, self.chunk_samples)} but got {tuple(waveform.shape)}"
+        waveform = waveform.to(self.device)
+        if self.state is None:
+            out = self._first(waveform, *self.init_state)
+        else:
+            out = self._step(waveform, *self.state)
+        n = len(self.meta["outputs"])
+        self.state = list(out[n:])
+        self.n_frames += 1
+        return dict(zip(self.meta["outputs"], out[:n]))
@@ -0,0 +1,338 @@
+"""
+Corpus-scale inference: keeps a single model resident, decodes the audio in a
+worker pool and packs the (step_extraction) chunks of many files into shared
+batches. Every session is written to `<output_dir>/<session>.json` (or the
+binary `<output_dir>/<session>/` store with `--format store`, see
+`vap.utils.output_store`) as soon as all of its chunks are processed, and
+existing outputs are skipped, so an interrupted run is resumed by running the
+same command again. The session is the audio file name (without extension)
+for a `--manifest` and, for `--audio_dir`, its path relative to `--audio_dir`
+(e.g. `<output_dir>/spk1/a.json`).
+
+python vap/infer.py \\
+    --audio_dir /PATH/TO/AUDIO \\
+    --output_dir /PATH/TO/OUTPUT \\
+    --state_dict example/checkpoints/VAP_state_dict.pt \\
+    --batch_size 16 \\
+    --num_workers 4
+"""
+import os
+import torch
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from pathlib import Path
+from torch import Tensor
+from torch.utils.data import Dataset, DataLoader
+from typing import Any, Optional
+
+from vap.modules.VAP import (
+    VAP,
+    empty_probs_output,
+    get_step_chunks,
+    write_probs_output,
+)
+from vap.utils.audio import load_waveform
+from vap.utils.output_store import DTYPES, write_output_store
+from vap.utils.utils import (
+    batch_to_device,
+    everything_deterministic,
+    read_txt,
+    tensor_dict_to_json,
+    write_json,
+)
+
+
+AUDIO_EXTENSIONS = [".wav", ".flac", ".mp3", ".ogg"]
+
+
+def get_audio_paths(
+    manifest: Optional[str] = None, audio_dir: Optional[str] = None
+) -> list[str]:
+    """
+    manifest:   a csv with an `audio_path` column or a txt file with one path per line
+    audio_dir:  all audio files (recursively) in the directory
+    """
+    if manifest is not None:
+        if manifest.endswith(".csv"):
+            import pandas as pd
+
+            return pd.read_csv(manifest)["audio_path"].tolist()
+        return [p for p in read_txt(manifest) if len(p) > 0]
+
+    assert audio_dir is not None, "Must provide manifest or audio_dir"
+    return sorted(
+        str(p)
+        for p in Path(audio_dir).rglob("*")
+        if p.suffix.lower() in AUDIO_EXTENSIONS
+    )
+
+
+def get_output_path(
+    audio_path: str,
+    output_dir: str,
+    format: str = "json",
+    audio_dir: Optional[str] = None,
+) -> Path:
+    """
+    The output of `audio_path` in `output_dir`, named by its stem or, for the
+    (recursive) files of `audio_dir`, by its path relative to `audio_dir` (the
+    subdirectories are kept) so that files with the same name do not collide.
+    """
+    name = Path(audio_path).stem
+    if audio_dir is not None:
+        name = Path(audio_path).relative_to(audio_dir).with_suffix("")
+    if format == "store":
+        return Path(output_dir) / name
+    return Path(output_dir) / f"{name}.json"
+
+
+def write_output(
+    out: dict[str, Any],
+    path: Path,
+    format: str = "json",
+    fields: Optional[list[str]] = None,
+    dtype: str = "float16",
+    frame_hz: int = 50,
+) -> None:
+    """Write to a temporary file first so that a partial file is never 'done'"""
+    if format == "store":
+        write_output_store(out, path, fields=fields, dtype=dtype, frame_hz=frame_hz)
+        return
+    if fields is not None:
+        out = {k: v for k, v in out.items() if k in fields}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    write_json(tensor_dict_to_json(out), tmp)
+    os.replace(tmp, path)
+
+
+class AudioDataset(Dataset):
+    def __init__(self, audio_paths: list[str], sample_rate: int = 16_000) -> None:
+        self.audio_paths = audio_paths
+        self.sample_rate = sample_rate
+
+    def __len__(self) -> int:
+        return len(self.audio_paths)
+
+    def __getitem__(self, idx: int) -> dict[str, Any]:
+        path = self.audio_paths[idx]
+        waveform, _ = load_waveform(path, sample_rate=self.sample_rate, mono=False)
+        return {"audio_path": path, "waveform": waveform}
+
+
+class CorpusInference:
+    """
+    Packs the chunks of many files into shared batches (see
+    `vap.modules.VAP.step_extraction`). Files shorter than `chunk_time` are
+    processed on their own in a single pass.
+    """
+
+    def __init__(
+        self,
+        model: VAP,
+        output_dir: str,
+        chunk_time: float = 20,
+        step_time: float = 5,
+        batch_size: int = 8,
+        format: str = "json",
+        fields: Optional[list[str]] = None,
+        dtype: str = "float16",
+        audio_dir: Optional[str] = None,
+    ) -> None:
+        self.model = model
+        self.output_dir = output_dir
+        self.audio_dir = audio_dir  # the output names, see `get_output_path`
+        self.chunk_time = chunk_time
+        self.step_time = step_time
+        self.batch_size = batch_size
+        self.format = format
+        self.fields = fields
+        self.dtype = dtype
+
+        # Chunks waiting for a batch: (audio_path, chunk, start_frame, end_frame)
+        self.pending = []
+        # audio_path -> [output, number of unprocessed chunks]
+        self.sessions = {}
+
+    def add(self, audio_path: str, waveform: Tensor) -> None:
+        waveform = waveform.unsqueeze(0)  # (1, 2, n_samples)
+        if waveform.shape[-1] <= int(self.chunk_time * self.model.sample_rate):
+            out = self.model.probs(waveform.to(self.model.device))
+            self.write(audio_path, batch_to_device(out, "cpu"))
+            return
+
+        chunks, n_frames = get_step_chunks(
+            waveform, self.model, self.chunk_time, self.step_time
+        )
+        out = empty_probs_output(self.model, 1, n_frames)
+        self.sessions[audio_path] = [out, len(chunks)]
+        for chunk, start, end in chunks:
+            self.pending.append((audio_path, chunk, start, end))
+
+        while len(self.pending) >= self.batch_size:
+            self.run_batch()
+
+    def run_batch(self) -> None:
+        batch = self.pending[: self.batch_size]
+        self.pending = self.pending[self.batch_size :]
+
+        w = torch.cat([chunk for _, chunk, _, _ in batch])
+        o = self.model.probs(w.to(self.model.device))
+        for j, (audio_path, _, start, end) in enumerate(batch):
+            session = self.sessions[audio_path]
+            write_probs_output(session[0], o, j, 1, start, end)
+            session[1] -= 1
+            if session[1] == 0:
+                self.write(audio_path, session[0])
+                del self.sessions[audio_path]
+
+    def flush(self) -> None:
+        while len(self.pending) > 0:
+            self.run_batch()
+
+    def write(self, audio_path: str, out: dict[str, Tensor]) -> None:
+        write_output(
+            out,
+            get_output_path(
+                audio_path, self.output_dir, self.format, self.audio_dir
+            ),
+            format=self.format,
+            fields=self.fields,
+            dtype=self.dtype,
+            frame_hz=self.model.frame_hz,
+        )
+
+
+def load_vap_model(
+    state_dict: Optional[str] = None, checkpoint: Optional[str] = None
+) -> VAP:
+    if state_dict:
+        from vap.modules.VAP import load_model_from_state_dict
+
+        return load_model_from_state_dict(state_dict)
+    elif checkpoint:
+        from vap.modules.VAP import (
+            build_model_from_state_dict,
+            is_vap_state_dict,
+            load_checkpoint_state_dict,
+        )
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        sd = load_checkpoint_state_dict(checkpoint)
+        if is_vap_state_dict(sd):
+            return build_model_from_state_dict(sd).to(device)
+        # other encoders/models: instantiate the lightning module
+        from vap.modules.lightning_module import VAPModule
+
+        return VAPModule.load_model(checkpoint, map_location=device)
+    raise ValueError("Must provide state_dict or checkpoint")
+
+
+def get_args():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="csv (with an 'audio_path' column) or txt (one path per line) of audio files",
+    )
+    parser.add_argument(
+        "--audio_dir", type=str, default=None, help="Directory of audio files"
+    )
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("-sd", "--state_dict", type=str, default=None)
+    parser.add_argument("-c", "--checkpoint", type=str, default=None)
+    parser.add_argument("--chunk_time", type=float, default=20)
+    parser.add_argument("--step_time", type=float, default=5)
+    parser.add_argument(
+        "--batch_size", type=int, default=8, help="Chunks (from any file) per batch"
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=4, help="Audio decoding workers"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="json",
+        choices=["json", "store"],
+        help="json or a compact binary store (see vap.utils.output_store)",
+    )
+    parser.add_argument(
+        "--fields",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Output fields to save, e.g. p_now p_future vad (default: all)",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float16",
+        choices=DTYPES,
+        help="Storage dtype of the binary store",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Process all files (by default existing outputs are skipped)",
+    )
+    args = parser.parse_args()
+
+    assert (
+        args.manifest is not None or args.audio_dir is not None
+    ), "Must provide manifest or audio_dir"
+    assert (
+        args.state_dict is not None or args.checkpoint is not None
+    ), "Must provide state_dict or checkpoint"
+    return args
+
+
+def main(args) -> None:
+    everything_deterministic()
+
+    audio_paths = get_audio_paths(args.manifest, args.audio_dir)
+    # the manifest paths are named by their stem
+    audio_dir = args.audio_dir if args.manifest is None else None
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    if not args.overwrite:
+        n_total = len(audio_paths)
+        audio_paths = [
+            p
+            for p in audio_paths
+            if not get_output_path(
+                p, args.output_dir, args.format, audio_dir
+            ).exists()
+        ]
+        print(f"Skipping {n_total - len(audio_paths)} already processed files")
+
+    print("Load Model...")
+    model = load_vap_model(args.state_dict, args.checkpoint).eval()
+
+    dloader = DataLoader(
+        AudioDataset(audio_paths, sample_rate=model.sample_rate),
+        batch_size=None,
+        num_workers=args.num_workers,
+    )
+    inference = CorpusInference(
+        model,
+        args.output_dir,
+        chunk_time=args.chunk_time,
+        step_time=args.step_time,
+        batch_size=args.batch_size,
+        format=args.format,
+        fields=args.fields,
+        dtype=args.dtype,
+        audio_dir=audio_dir,
+    )
+
+    from tqdm import tqdm
+
+    for d in tqdm(dloader, total=len(audio_paths), desc="Inference"):
+        inference.add(d["audio_path"], d["waveform"])
+    inference.flush()
+    print("Saved output -> ", args.output_dir)
+
+
+if __name__ == "__main__":
+    main(get_args())
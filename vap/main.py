@@ -7,6 +7,8 @@ from omegaconf import DictConfig, OmegaConf
 from lightning import seed_everything
 from lightning.pytorch import Trainer
 
+from vap.utils.utils import everything_deterministic
+
 log: logging.Logger = logging.getLogger(__name__)
 
 torch.set_float32_matmul_precision(precision="medium")
@@ -16,6 +18,7 @@ torch.set_float32_matmul_precision(precision="medium")
 def main(cfg: DictConfig) -> None:
     seed = cfg.get("seed", 0)
     seed_everything(seed, workers=True)
+    everything_deterministic()
     log.info(OmegaConf.to_yaml(cfg))
 
     module = instantiate(cfg.module)
@@ -32,6 +35,11 @@ def main(cfg: DictConfig) -> None:
             print("Added val metrics")
         input("Press enter to continue: ")
 
+    if getattr(datamodule, "features_dir", None) is not None:
+        from vap.data.feature_store import FeatureStore
+
+        FeatureStore(datamodule.features_dir).check_encoder(module.model.encoder)
+
     if getattr(cfg, "debug", False):
         trainer = Trainer(fast_dev_run=True)
     else:
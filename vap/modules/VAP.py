@@ -1,33 +1,56 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from itertools import chain
 from pathlib import Path
 from torch import Tensor
 from typing import Optional
 
 from vap.objective import VAPObjective
 from vap.modules.modules import VACondition
-from vap.utils.utils import (
-    everything_deterministic,
-    vad_fill_silences,
-    vad_omit_spikes,
-)
+from vap.utils.profiling import profiler, span
+from vap.utils.utils import vad_fill_silences, vad_omit_spikes
 
 from vap.modules.modules import ProjectionLayer
 
 OUT = dict[str, Tensor]
 
-everything_deterministic()
+# Inference precision of the encoder and transformer (see `VAP.set_precision`)
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
 
 
-def load_model_from_state_dict(path: str):
+
+def load_state_dict_file(path: str) -> dict:
+    """
+    The (cpu) contents of `path`, memory-mapped where supported so that the
+    tensors are read on first use without any copies.
+    """
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    except (RuntimeError, TypeError):
+        # legacy (not zip) files can't be memory-mapped (nor with torch < 2.1)
+        return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def build_model_from_state_dict(sd: dict, fast: bool = True) -> "VAP":
+    """
+    The `VAP` model of the state dict `sd` with the sizes inferred from it.
+
+    `fast` (cold start) builds the encoder and transformer on the meta device,
+    without loading the pretrained encoder weights (the state dict holds them),
+    and assigns the tensors of `sd` (e.g. memory-mapped, see
+    `load_state_dict_file`) as the parameters without copies. Otherwise the
+    model is initialized (and the pretrained encoder loaded) and `sd` is copied
+    into it.
+    """
     from vap.modules.encoder import EncoderCPC
     from vap.modules.modules import TransformerStereo
 
     def load_encoder(sd):
         encoder = None
         if "encoder.encoder.gEncoder.conv0.weight" in sd:
-            encoder = EncoderCPC()
+            encoder = EncoderCPC(load_pretrained=not fast)
         else:
             raise NotImplementedError("Only EncoderCPC is implemented")
         return encoder
@@ -59,49 +82,120 @@ def load_model_from_state_dict(path: str):
         self_layers = get_transformer_layers(sd, layer_type="self")
         cross_layers = get_transformer_layers(sd, layer_type="cross")
 
+        # legacy sink tokens (see `TransformerStereo.convert_sinks_to_kv`)
+        if "transformer.attention_sinks" in sd:
+            sink_layout = "tokens"
+            num_sink_tokens = sd["transformer.attention_sinks"].shape[1]
+        else:
+            sink_layout = "kv"
+            num_sink_tokens = sd["transformer.ar_channel.layers.0.mha.sink_k"].shape[2]
+
         return TransformerStereo(
             dim=dim,
             self_layers=self_layers,
             cross_layers=cross_layers,
             num_heads=num_heads,
             dff_k=dff_k,
+            num_sink_tokens=num_sink_tokens,
+            sink_layout=sink_layout,
         )
 
+    if not fast:
+        model = VAP(load_encoder(sd), load_transformer(sd))
+        model.load_state_dict(sd)
+        return model
+
+    # Only the encoder and transformer (the bulk of the weights) on the meta
+    # device, `VAP` builds its objective (codebook) from data
+    with torch.device("meta"):
+        encoder, transformer = load_encoder(sd), load_transformer(sd)
+    model = VAP(encoder, transformer)
+    # `assign` replaces the parameters, keep their `requires_grad` (frozen encoder)
+    requires_grad = {name: p.requires_grad for name, p in model.named_parameters()}
+    model.load_state_dict(sd, assign=True)
+    for name, p in model.named_parameters():
+        p.requires_grad_(requires_grad[name])
+    for name, t in chain(model.named_parameters(), model.named_buffers()):
+        assert not t.is_meta, f"{name} is not in the state dict"
+    return model
+
+
+def load_model_from_state_dict(path: str, fast: bool = True) -> "VAP":
+    """The model of the state dict at `path`, see `build_model_from_state_dict`"""
     p = Path(path)
     assert p.exists(), f"Path does not exist: {p}"
+    return build_model_from_state_dict(load_state_dict_file(p), fast=fast)
 
-    sd = torch.load(p)
-    E = load_encoder(sd)
-    T = load_transformer(sd)
-    model = VAP(E, T)
-    model.load_state_dict(sd)
-    return model
 
+def is_vap_state_dict(sd: dict) -> bool:
+    """A `VAP(EncoderCPC(), TransformerStereo())` state dict"""
+    return (
+        "encoder.encoder.gEncoder.conv0.weight" in sd
+        and "transformer.ar_channel.layers.0.ln_self_attn.weight" in sd
+    )
 
-def step_extraction(
-    waveform,
-    model,
-    chunk_time=20,
-    step_time=5,
-    pbar=True,
-    verbose=False,
-):
+
+def load_checkpoint_state_dict(path: str) -> dict:
+    """The (memory-mapped) `VAP` state dict of a (lightning) `VAPModule` checkpoint"""
+    p = Path(path)
+    assert p.exists(), f"Path does not exist: {p}"
+    ckpt = load_state_dict_file(p)
+    return {
+        k[len("model.") :]: v
+        for k, v in ckpt["state_dict"].items()
+        if k.startswith("model.")
+    }
+
+
+def load_model_from_checkpoint(path: str, fast: bool = True) -> "VAP":
     """
-    Takes a waveform, the model, and extracts probability output in chunks with
-    a specific context and step time. Concatenates the output accordingly and returns full waveform output.
+    The `VAP` model of a (lightning) `VAPModule` checkpoint directly from its
+    state dict, without instantiating the module (and its hyperparameters,
+    metrics, ...), see `build_model_from_state_dict`. Only `EncoderCPC` models
+    are supported (`is_vap_state_dict`), others load with `VAPModule.load_model`.
+    """
+    sd = load_checkpoint_state_dict(path)
+    assert is_vap_state_dict(sd), f"Not a VAP(EncoderCPC, TransformerStereo): {path}"
+    return build_model_from_state_dict(sd, fast=fast)
+
+
+# Frame dimension of the `VAP.probs` output (the batch dimension precedes it)
+PROBS_FRAME_DIM = {
+    "probs": 1,
+    "vad": 1,
+    "H": 1,
+    "p_now": 1,
+    "p_future": 1,
+    "p_all": 1,
+    "p": 2,
+}
+
+
+def get_step_chunks(
+    waveform: Tensor,
+    model: "VAP",
+    chunk_time: float = 20,
+    step_time: float = 5,
+    verbose: bool = False,
+) -> tuple[list[tuple[Tensor, int, int]], int]:
+    """
+    Splits a waveform, (B, 2, n_samples) longer than `chunk_time`, into
+    overlapping chunks of `chunk_time` with a step of `step_time`.
+
+    Returns
+        chunks:     list of (chunk, start_frame, end_frame), the frames
+                    [start, end) of the output are the last frames of the
+                    chunk output
+        n_frames:   total number of output frames
     """
-
     n_samples = waveform.shape[-1]
     duration = round(n_samples / model.sample_rate, 2)
-    context_time = chunk_time - step_time
 
     # Samples
-    # context_samples = int(context_time * model.sample_rate)
     step_samples = int(step_time * model.sample_rate)
     chunk_samples = int(chunk_time * model.sample_rate)
 
     # Frames
-    # context_frames = int(context_time * model.frame_hz)
     chunk_frames = int(chunk_time * model.frame_hz)
     step_frames = int(step_time * model.frame_hz)
 
@@ -109,72 +203,108 @@ def step_extraction(
     folds = waveform.unfold(
         dimension=-1, size=chunk_samples, step=step_samples
     ).permute(2, 0, 1, 3)
-    print("folds: ", tuple(folds.shape))
+    if verbose:
+        print("folds: ", tuple(folds.shape))
 
+    n_folds = folds.shape[0]
     expected_frames = round(duration * model.frame_hz)
-    n_folds = int((n_samples - chunk_samples) / step_samples + 1.0)
-    total = (n_folds - 1) * step_samples + chunk_samples
-
-    # First chunk
-    # Use all extracted data. Does not overlap with anything prior.
-    out = model.probs(folds[0].to(model.device))
-    # OUT:
-    # {
-    #   "probs": probs,
-    #   "vad": vad,
-    #   "p_now": p_now,
-    #   "p_future": p_future,
-    #   "H": H,
-    # }
+    processed_frames = chunk_frames + (n_folds - 1) * step_frames
+    n_frames = max(expected_frames, processed_frames)
 
-    if pbar:
-        from tqdm import tqdm
-
-        pbar = tqdm(folds[1:], desc=f"Context: {context_time}s, step: {step_time}")
-    else:
-        pbar = folds[1:]
-    # Iterate over all other folds
-    # and add simply the new processed step
-    for w in pbar:
-        o = model.probs(w.to(model.device))
-        out["vad"] = torch.cat([out["vad"], o["vad"][:, -step_frames:]], dim=1)
-        out["p_now"] = torch.cat([out["p_now"], o["p_now"][:, -step_frames:]], dim=1)
-        out["p_future"] = torch.cat(
-            [out["p_future"], o["p_future"][:, -step_frames:]], dim=1
-        )
-        out["probs"] = torch.cat([out["probs"], o["probs"][:, -step_frames:]], dim=1)
-        out["H"] = torch.cat([out["H"], o["H"][:, -step_frames:]], dim=1)
-        # out["p_zero_shot"] = torch.cat([out["p_zero_shot"], o["p_zero_shot"][:, -step_frames:]], dim=1)
-
-    processed_frames = out["p_now"].shape[1]
+    # The first chunk does not overlap with anything prior so all frames are used.
+    # For the others we simply add the new processed step.
+    chunks = [(folds[0], 0, chunk_frames)]
+    for i in range(1, n_folds):
+        start = chunk_frames + (i - 1) * step_frames
+        chunks.append((folds[i], start, start + step_frames))
 
     ###################################################################
     # Handle LAST SEGMENT (not included in `unfold`)
     ###################################################################
-    if expected_frames != processed_frames:
-        omitted_frames = expected_frames - processed_frames
-
-        omitted_samples = model.sample_rate * omitted_frames / model.frame_hz
-
+    if n_frames > processed_frames:
         if verbose:
+            omitted_frames = n_frames - processed_frames
             print(f"Expected frames {expected_frames} != {processed_frames}")
             print(f"omitted frames: {omitted_frames}")
-            print(f"omitted samples: {omitted_samples}")
             print(f"chunk_samples: {chunk_samples}")
+        chunks.append((waveform[..., -chunk_samples:], processed_frames, n_frames))
+    return chunks, n_frames
+
+
+def empty_probs_output(model: "VAP", batch_size: int, n_frames: int) -> OUT:
+    """Preallocated (cpu) tensors for the output of `VAP.probs`"""
+    return {
+        "probs": torch.zeros((batch_size, n_frames, model.objective.n_classes)),
+        "vad": torch.zeros((batch_size, n_frames, 2)),
+        "H": torch.zeros((batch_size, n_frames)),
+        "p_now": torch.zeros((batch_size, n_frames)),
+        "p_future": torch.zeros((batch_size, n_frames)),
+        "p_all": torch.zeros((batch_size, n_frames)),
+        "p": torch.zeros((model.objective.n_bins, batch_size, n_frames)),
+    }
+
+
+def write_probs_output(
+    out: OUT, o: OUT, index: int, batch_size: int, start: int, end: int
+) -> None:
+    """
+    Copies the last `end - start` frames of the entries
+    [index * batch_size, (index + 1) * batch_size) in the batched `VAP.probs`
+    output `o` to the frames [start, end) of `out`.
+    """
+    n = end - start
+    for name, frame_dim in PROBS_FRAME_DIM.items():
+        x = o[name].narrow(frame_dim - 1, index * batch_size, batch_size)
+        x = x.narrow(frame_dim, x.shape[frame_dim] - n, n)
+        out[name].narrow(frame_dim, start, n).copy_(x)
+
 
-        w = waveform[..., -chunk_samples:]
+def step_extraction(
+    waveform,
+    model,
+    chunk_time=20,
+    step_time=5,
+    batch_size=1,
+    pbar=True,
+    verbose=False,
+):
+    """
+    Takes a waveform, the model, and extracts probability output in chunks with
+    a specific context and step time. Concatenates the output accordingly and returns full waveform output.
+
+    The chunks (folds) are processed `batch_size` at a time and the new frames
+    of each chunk are written directly into the (cpu) output tensors.
+    """
+    if waveform.shape[-1] <= int(chunk_time * model.sample_rate):
+        return model.probs(waveform.to(model.device))
+
+    context_time = chunk_time - step_time
+    chunks, n_frames = get_step_chunks(
+        waveform, model, chunk_time, step_time, verbose=verbose
+    )
+
+    B = waveform.shape[0]
+    out = empty_probs_output(model, B, n_frames)
+
+    batches = range(0, len(chunks), batch_size)
+    if pbar:
+        from tqdm import tqdm
+
+        batches = tqdm(batches, desc=f"Context: {context_time}s, step: {step_time}")
+
+    for b in batches:
+        batch_chunks = chunks[b : b + batch_size]
+        w = torch.cat([c[0] for c in batch_chunks])
         o = model.probs(w.to(model.device))
-        out["vad"] = torch.cat([out["vad"], o["vad"][:, -omitted_frames:]], dim=1)
-        out["p_now"] = torch.cat([out["p_now"], o["p_now"][:, -omitted_frames:]], dim=1)
-        out["p_future"] = torch.cat(
-            [out["p_future"], o["p_future"][:, -omitted_frames:]], dim=1
-        )
-        out["probs"] = torch.cat([out["probs"], o["probs"][:, -omitted_frames:]], dim=1)
-        out["H"] = torch.cat([out["H"], o["H"][:, -omitted_frames:]], dim=1)
+        for j, (_, start, end) in enumerate(batch_chunks):
+            write_probs_output(out, o, j, B, start, end)
     return out
 
 
 class VAP(nn.Module):
+    channel_batched: bool = True
+    precision: str = "fp32"
+
     def __init__(
         self,
         encoder: nn.Module,
@@ -214,6 +344,24 @@ class VAP(nn.Module):
     def device(self) -> torch.device:
         return next(self.parameters()).device
 
+    def set_precision(self, precision: str) -> None:
+        """
+        Reduced precision ("bf16", "fp16") inference: the encoder and the
+        transformer run under `torch.autocast` (also on the cpu) while the
+        head, softmax, entropy and aggregation (`probs`) stay in fp32.
+        See `vap/compare_precision.py` for the deviation from "fp32".
+        """
+        assert precision in PRECISIONS, f"precision must be one of {list(PRECISIONS)}"
+        self.precision = precision
+
+    def autocast(self, device: torch.device):
+        """The `torch.autocast` context of `precision` (disabled for fp32)"""
+        return torch.autocast(
+            device_type=device.type,
+            dtype=PRECISIONS[self.precision],
+            enabled=self.precision != "fp32",
+        )
+
     def extract_labels(self, vad: Tensor) -> Tensor:
         return self.objective.get_labels(vad)
 
@@ -221,13 +369,55 @@ class VAP(nn.Module):
         return F.binary_cross_entropy_with_logits(vad_output, vad)
 
     def encode_audio(self, audio: torch.Tensor) -> tuple[Tensor, Tensor]:
+        """
+        The (shared) encoder over both channels, as a single (2B) batch unless
+        `VAP.channel_batched = False`.
+        """
         assert (
             audio.shape[1] == 2
         ), f"audio VAP ENCODER: {audio.shape} != (B, 2, n_samples)"
+        if self.channel_batched:
+            x = self.encoder(torch.cat((audio[:, :1], audio[:, 1:])))
+            x1, x2 = x.chunk(2)  # speaker 1, speaker 2
+            return x1, x2
         x1 = self.encoder(audio[:, :1])  # speaker 1
         x2 = self.encoder(audio[:, 1:])  # speaker 2
         return x1, x2
 
+    def encode_session(
+        self, waveform: Tensor, chunk_time: float = 60
+    ) -> tuple[Tensor, Tensor]:
+        """
+        `encode_audio` over an entire session, (B, 2, n_samples), incrementally
+        over chunks of `chunk_time` seconds (see `EncoderCPC.step`): the same
+        frames with the memory bounded by the chunk size.
+        """
+        x = torch.cat((waveform[:, :1], waveform[:, 1:]))  # channels as a batch
+        state = self.encoder.init_state(x.shape[0])
+        chunk = int(chunk_time * self.sample_rate)
+        z = [self.encoder.step(w, state) for w in x.split(chunk, dim=-1)]
+        z.append(self.encoder.flush(state))
+        x1, x2 = torch.cat(z, dim=1).chunk(2)
+        return x1, x2
+
+    def encode_features(self, features: Tensor) -> tuple[Tensor, Tensor]:
+        """
+        `encode_audio` from the precomputed (frozen) encoder features,
+        (B, 2, n, D), see `EncoderCPC.encode` and `vap.data.feature_store`.
+        """
+        assert (
+            features.ndim == 4 and features.shape[1] == 2
+        ), f"features VAP ENCODER: {features.shape} != (B, 2, n_frames, D)"
+        if self.channel_batched:
+            x = self.encoder.forward_features(
+                torch.cat((features[:, 0], features[:, 1]))
+            )
+            x1, x2 = x.chunk(2)
+            return x1, x2
+        x1 = self.encoder.forward_features(features[:, 0])
+        x2 = self.encoder.forward_features(features[:, 1])
+        return x1, x2
+
     def head(self, x: Tensor, x1: Tensor, x2: Tensor) -> tuple[Tensor, Tensor]:
         v1 = self.va_classifier(x1)
         v2 = self.va_classifier(x2)
@@ -235,25 +425,109 @@ class VAP(nn.Module):
         logits = self.vap_head(x)
         return logits, vad
 
-    def forward(self, waveform: Tensor, attention: bool = False) -> OUT:
-        x1, x2 = self.encode_audio(waveform)
-        x1 = self.feature_projection(x1)
-        x2 = self.feature_projection(x2)
+    def forward(
+        self,
+        waveform: Optional[Tensor] = None,
+        attention: bool = False,
+        attention_layers: Optional[list[int]] = None,
+        attention_heads: Optional[list[int]] = None,
+        features: Optional[Tensor] = None,
+    ) -> OUT:
+        """
+        The attention weights are only computed if `attention` (for the
+        selected layers/heads, see `TransformerStereo.forward`).
+
+        The input is either the `waveform` (B, 2, n_samples) or the precomputed
+        encoder `features` (B, 2, n_frames, D), see `encode_features`.
+
+        Per-stage timings (encode_audio, feature_projection, ar_channel, ar,
+        combinator, head) are recorded by `vap.utils.profiling.profiler` when
+        enabled.
+        """
+        assert (waveform is None) != (
+            features is None
+        ), "Expects either the waveform or the features"
+        with span("forward"):
+            return self._forward(
+                waveform, attention, attention_layers, attention_heads, features
+            )
+
+    def _forward(
+        self,
+        waveform: Optional[Tensor] = None,
+        attention: bool = False,
+        attention_layers: Optional[list[int]] = None,
+        attention_heads: Optional[list[int]] = None,
+        features: Optional[Tensor] = None,
+    ) -> OUT:
+        device = waveform.device if waveform is not None else features.device
+        with self.autocast(device):
+            with span("encode_audio"):
+                if features is not None:
+                    x1, x2 = self.encode_features(features)
+                else:
+                    x1, x2 = self.encode_audio(waveform)
+            with span("feature_projection"):
+                x1 = self.feature_projection(x1)
+                x2 = self.feature_projection(x2)
+            profiler.count("frames", x1.shape[0] * x1.shape[1])
+
+            # The attention sinks are the initial key/value cache of the transformer
+            out = self.transformer(
+                x1,
+                x2,
+                attention=attention,
+                attention_layers=attention_layers,
+                attention_heads=attention_heads,
+            )
 
-        # Add sink tokens to the input
-        sink_tokens = self.transformer.ar.layers[0].mha.sink_tokens.expand(x1.shape[0], -1, -1) # new
-        x1 = torch.cat([sink_tokens, x1], dim=1) # new
-        x2 = torch.cat([sink_tokens, x2], dim=1) # new
+        # The head (and everything after it) in fp32
+        with span("head"):
+            logits, vad = self.head(
+                out["x"].float(), out["x1"].float(), out["x2"].float()
+            )
+        out["logits"] = logits
+        out["vad"] = vad
+        return out
 
-        out = self.transformer(x1, x2, attention=attention)
+    def forward_windows(
+        self, waveform: Tensor, starts: list[int], n_frames: int, chunk_time: float = 60
+    ) -> OUT:
+        """
+        `forward` over (overlapping) windows of a single session, (1, 2, n_samples),
+        which is only encoded once (`encode_session`). The transformer runs on
+        every window, of `n_frames` frames from the frames `starts`, on its own.
 
-        # Remove sink tokens from the output
-        out['x'] = out['x'][:, self.num_sink_tokens:] # new
-        out['x1'] = out['x1'][:, self.num_sink_tokens:] # new
-        out['x2'] = out['x2'][:, self.num_sink_tokens:] # new
+        The encoder of a window is warmed up by all of the preceding audio of
+        the session (and sees the audio after it within its lookahead) unlike a
+        window encoded on its own. Frames beyond the session are zeros.
 
-    
-        logits, vad = self.head(out["x"], out["x1"], out["x2"])
+        Return:
+            logits: (n_windows, n_frames, n_classes)
+            vad:    (n_windows, n_frames, 2)
+        """
+        assert (
+            waveform.shape[0] == 1
+        ), f"Expects a single session, (1, 2, n_samples), got {tuple(waveform.shape)}"
+        with self.autocast(waveform.device):
+            with span("encode_audio"):
+                x1, x2 = self.encode_session(waveform, chunk_time)
+            with span("feature_projection"):
+                x1 = self.feature_projection(x1)
+                x2 = self.feature_projection(x2)
+
+            # (1, N, D) -> (n_windows, n_frames, D)
+            n_pad = max(max(starts) + n_frames - x1.shape[1], 0)
+            x1 = F.pad(x1, (0, 0, 0, n_pad))[0]
+            x2 = F.pad(x2, (0, 0, 0, n_pad))[0]
+            x1 = torch.stack([x1[s : s + n_frames] for s in starts])
+            x2 = torch.stack([x2[s : s + n_frames] for s in starts])
+            out = self.transformer(x1, x2)
+
+        with span("head"):
+            logits, vad = self.head(
+                out["x"].float(), out["x1"].float(), out["x2"].float()
+            )
         out["logits"] = logits
         out["vad"] = vad
         return out
@@ -270,7 +544,8 @@ class VAP(nn.Module):
         information in the unseen data is to the knowledge encoded in the
         training data.
         """
-        h = -probs * probs.log2()  # Entropy
+        # Entropy, 0 * log(0) = 0
+        h = -torch.special.xlogy(probs.float(), probs.float()) / math.log(2)
         return h.sum(dim=-1).cpu()  # average entropy per frame
 
     def aggregate_probs(
@@ -0,0 +1,157 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from itertools import product
+from torch import Tensor
+from typing import Optional
+
+from vap.modules.VAP import VAP, OUT
+from vap.modules.modules import MultiHeadAttentionAlibi
+
+
+def get_n_frames(encoder: nn.Module, n_samples: int) -> int:
+    """
+    The number of frames `encoder` produces from `n_samples` samples, i.e. the
+    output length of its conv layers in order (e.g. `EncoderCPC`).
+    """
+    n = n_samples
+    for m in encoder.modules():
+        if not isinstance(m, nn.Conv1d):
+            continue
+        pad = 2 * m.padding[0]
+        if hasattr(m, "pad"):  # CConv1d, causal padding
+            pad += sum(m.pad.padding)
+        span = m.dilation[0] * (m.kernel_size[0] - 1) + 1
+        n = (n + pad - span) // m.stride[0] + 1
+    return n
+
+
+def get_bucket(buckets: Optional[list[int]], n: int) -> Optional[int]:
+    """The smallest bucket >= n (n itself without buckets, None if > all)"""
+    if buckets is None:
+        return n
+    return next((b for b in buckets if b >= n), None)
+
+
+class CompiledVAP:
+    """
+    `torch.compile` of `VAP` over a fixed set of shapes (without recompiles).
+
+    The waveform (B, 2, n_samples) is zero padded (right) to the smallest
+    frame bucket (and the batch to the smallest batch bucket) and the output
+    is cropped to the frames (and rows) of the input. The model is causal so
+    the padding only changes the last frame(s), which see the padded zeros
+    instead of the zero padding of the encoder within the CPC lookahead, and
+    the cropped padding does not contribute to a loss (or its gradients).
+    Longer inputs (or larger batches) run eagerly.
+
+    The compiled graph does not depend on any python side state: the aLiBi
+    biases are built in the forward pass (`MultiHeadAttentionAlibi.cache_bias`),
+    the encoder does not skip silence (`EncoderCPC.skip_silence`, data
+    dependent) and the output is a tuple of (logits, vad).
+
+    Example:
+        compiled = CompiledVAP(model.eval(), frame_buckets=[500, 1000], warmup=True)
+        out = compiled.probs(waveform)  # as `model.probs`
+
+    Arguments:
+        model:          the `VAP` model (the parameters are shared)
+        frame_buckets:  the sequence lengths (frames) of the compiled graphs
+        batch_buckets:  the batch sizes of the compiled graphs, None: the
+                        batch is not padded (a graph per batch size)
+        mode:           the `torch.compile` mode, e.g. "reduce-overhead"
+        backend:        the `torch.compile` backend
+        warmup:         compile all buckets (for inference) now, see `warmup`
+    """
+
+    def __init__(
+        self,
+        model: VAP,
+        frame_buckets: list[int] = [250, 500, 1000],
+        batch_buckets: Optional[list[int]] = [1],
+        mode: Optional[str] = None,
+        backend: str = "inductor",
+        warmup: bool = False,
+    ) -> None:
+        self.model = model
+        self.frame_buckets = sorted(frame_buckets)
+        self.batch_buckets = sorted(batch_buckets) if batch_buckets else None
+        self.samples_per_frame = model.sample_rate // model.frame_hz
+        for b in self.frame_buckets:
+            n_frames = get_n_frames(model.encoder, b * self.samples_per_frame)
+            assert (
+                n_frames == b
+            ), f"bucket {b} frames: {b * self.samples_per_frame} samples encode to {n_frames} frames"
+
+        for m in model.modules():
+            if isinstance(m, MultiHeadAttentionAlibi):
+                m.cache_bias = False
+            if hasattr(m, "skip_silence"):
+                m.skip_silence = False
+
+        # A graph for every bucket (in train and eval mode) without evictions
+        n_graphs = 2 * len(self.frame_buckets) * len(self.batch_buckets or [1])
+        config = torch._dynamo.config
+        config.cache_size_limit = max(config.cache_size_limit, n_graphs)
+        self.fn = torch.compile(
+            self._forward, dynamic=False, mode=mode, backend=backend
+        )
+        if warmup:
+            self.warmup()
+
+    def _forward(self, waveform: Tensor) -> tuple[Tensor, Tensor]:
+        out = self.model(waveform)
+        return out["logits"], out["vad"]
+
+    @torch.inference_mode()
+    def warmup(self) -> None:
+        """Compile the graphs of all (inference) buckets ahead of the first input"""
+        p = next(self.model.parameters())
+        for batch_size, n_frames in product(
+            self.batch_buckets or [1], self.frame_buckets
+        ):
+            waveform = torch.zeros(
+                (batch_size, 2, n_frames * self.samples_per_frame),
+                device=p.device,
+                dtype=p.dtype,
+            )
+            self.fn(waveform)
+
+    def __call__(self, waveform: Tensor) -> OUT:
+        return self.forward(waveform)
+
+    def forward(self, waveform: Tensor) -> OUT:
+        """
+        Return:
+            logits: (B, n_frames, n_classes)
+            vad:    (B, n_frames, 2)
+        """
+        B, _, n_samples = waveform.shape
+        frames = get_bucket(self.frame_buckets, -(-n_samples // self.samples_per_frame))
+        batch_size = get_bucket(self.batch_buckets, B)
+        if frames is None or batch_size is None:
+            out = self.model(waveform)
+            return {"logits": out["logits"], "vad": out["vad"]}
+
+        n_frames = get_n_frames(self.model.encoder, n_samples)
+        pad = frames * self.samples_per_frame - n_samples
+        logits, vad = self.fn(F.pad(waveform, (0, pad, 0, 0, 0, batch_size - B)))
+        return {"logits": logits[:B, :n_frames], "vad": vad[:B, :n_frames]}
+
+    @torch.inference_mode()
+    def probs(
+        self,
+        waveform: Tensor,
+        now_lims: list[int] = [0, 1],
+        future_lims: list[int] = [2, 3],
+    ) -> OUT:
+        """`VAP.probs` through the compiled graphs"""
+        out = self(waveform)
+        probs = out["logits"].softmax(dim=-1)
+        ret = {
+            "probs": probs,
+            "vad": out["vad"].sigmoid(),
+            "H": self.model.entropy(probs),
+        }
+        ret.update(self.model.aggregate_probs(probs, now_lims, future_lims))
+        return ret
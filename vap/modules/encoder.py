@@ -1,8 +1,15 @@
+import torch
 from torch import Tensor
 import torch.nn as nn
 import einops
+from collections import OrderedDict
 
-from vap.modules.encoder_components import load_CPC, get_cnn_layer
+from vap.modules.encoder_components import load_CPC, get_cnn_layer, CConv1d
+
+
+def clear_silence_cache(module: nn.Module, incompatible_keys) -> None:
+    """`EncoderCPC.load_state_dict` post hook, the weights have changed"""
+    module.silence_cache.clear()
 
 
 class EncoderCPC(nn.Module):
@@ -14,14 +21,26 @@ class EncoderCPC(nn.Module):
     check paper (branch) version to see other encoders...
     """
 
+    # Skip the `gEncoder` convs over exactly silent (digital zero) spans of at
+    # least `min_silence_frames` (100Hz) frames, e.g. the zero channel of mono
+    # audio, and reuse the `encode` output of entirely silent channels (see
+    # `encode_skip_silence`). Only without gradients through the encoder.
+    skip_silence: bool = True
+    min_silence_frames: int = 50
+    max_silence_cache: int = 8
+
     def __init__(self, load_pretrained=True, freeze=True):
         super().__init__()
         self.sample_rate = 16000
         self.encoder = load_CPC(load_pretrained)
+        # (n_samples, device, dtype, autocast) -> the `encode` output of silence
+        self.silence_cache = OrderedDict()
+        self.register_load_state_dict_post_hook(clear_silence_cache)
         self.output_dim = self.encoder.gEncoder.conv4.out_channels
         self.dim = self.output_dim
 
         self.downsample_ratio = 160
+        self.features_ratio = 160  # samples per `encode` frame (100Hz)
         self.downsample = get_cnn_layer(
             dim=self.output_dim,
             kernel=[5],
@@ -37,17 +56,31 @@ class EncoderCPC(nn.Module):
     def freeze(self) -> None:
         for p in self.encoder.parameters():
             p.requires_grad_(False)
+        self.silence_cache.clear()
         print(f"Froze {self.__class__.__name__}!")
 
     def unfreeze(self) -> None:
         for p in self.encoder.parameters():
             p.requires_grad_(True)
+        self.silence_cache.clear()
         print(f"Trainable {self.__class__.__name__}!")
 
-    def forward(self, waveform: Tensor) -> Tensor:
+    def encode(self, waveform: Tensor) -> Tensor:
+        """
+        The CPC features (`gEncoder` and `gAR`, frozen by default), (B, n, D)
+        at 100Hz, i.e. everything before `downsample`. Precomputed features
+        (see `vap.data.feature_store`) go through `forward_features`.
+        """
         if waveform.ndim < 3:
             waveform = waveform.unsqueeze(1)  # channel dim
 
+        grad = torch.is_grad_enabled() and (
+            waveform.requires_grad
+            or any(p.requires_grad for p in self.encoder.parameters())
+        )
+        if self.skip_silence and not grad:
+            return self.encode_skip_silence(waveform)
+
         # Backwards using only the encoder encounters:
         # ---------------------------------------------------
         # RuntimeError: one of the variables needed for gradient computation
@@ -59,6 +92,180 @@ class EncoderCPC(nn.Module):
         # HOWEVER, if we feed through encoder.gAR we do not encounter that problem...
         z = self.encoder.gEncoder(waveform)
         z = einops.rearrange(z, "b c n -> b n c")
-        z = self.encoder.gAR(z)
-        z = self.downsample(z)
+        return self.encoder.gAR(z)
+
+    def encode_skip_silence(self, waveform: Tensor) -> Tensor:
+        """
+        `encode` without the `gEncoder` convs over exactly silent spans (see
+        `CPCEncoder.forward_skip_silence`), e.g. the zero channel of
+        `load_waveform` or the non-speech regions of `mono_to_stereo`. The `gAR`
+        state goes through the silence, i.e. it runs over all frames, except for
+        entirely silent channels whose output only depends on their length and
+        is cached (see `get_silence`).
+
+        The silent frames are found on the device and fetched with a single
+        device to host sync, input without silent spans of `min_silence_frames`
+        (e.g. ordinary speech batches) runs the plain `encode` after it.
+        """
+        gEncoder, gAR = self.encoder.gEncoder, self.encoder.gAR
+        min_frames = self.min_silence_frames
+        silent = gEncoder.get_silent_frames(waveform)  # (B, n_frames)
+        spans, channels = torch.stack(
+            (
+                gEncoder.has_silent_span(silent, min_frames),
+                ~waveform.flatten(1).any(-1),  # entirely silent channels
+            )
+        ).tolist()
+        if not any(spans) and not any(channels):
+            z = gEncoder(waveform)
+            return gAR(einops.rearrange(z, "b c n -> b n c"))
+        if gAR.keepHidden or not any(channels):
+            z = gEncoder.forward_skip_silence(waveform, min_frames, silent, spans)
+            return gAR(einops.rearrange(z, "b c n -> b n c"))
+
+        out = self.get_silence(waveform).expand(waveform.shape[0], -1, -1).clone()
+        speech = [b for b, c in enumerate(channels) if not c]
+        if speech:
+            z = gEncoder.forward_skip_silence(
+                waveform[speech], min_frames, silent[speech], [spans[b] for b in speech]
+            )
+            out[speech] = gAR(einops.rearrange(z, "b c n -> b n c")).to(out.dtype)
+        return out
+
+    def get_silence(self, waveform: Tensor) -> Tensor:
+        """The (1, n, D) `encode` output of silence of the length of `waveform`"""
+        autocast = torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+        key = (waveform.shape[-1], waveform.device, waveform.dtype, autocast)
+        if key in self.silence_cache:
+            self.silence_cache.move_to_end(key)
+            return self.silence_cache[key]
+
+        # normal tensors (not inference tensors) for any later context
+        with torch.inference_mode(False), torch.no_grad():
+            x = torch.zeros(
+                (1, 1, waveform.shape[-1]), device=waveform.device, dtype=waveform.dtype
+            )
+            z = self.encoder.gEncoder.forward_skip_silence(x, self.min_silence_frames)
+            silence = self.encoder.gAR(einops.rearrange(z, "b c n -> b n c"))
+        self.silence_cache[key] = silence
+        if len(self.silence_cache) > self.max_silence_cache:
+            self.silence_cache.popitem(last=False)
+        return silence
+
+    def forward_features(self, z: Tensor) -> Tensor:
+        """The (trainable) `downsample` of the `encode` features, (B, n, D)"""
+        return self.downsample(z)
+
+    def forward(self, waveform: Tensor) -> Tensor:
+        return self.forward_features(self.encode(waveform))
+
+    def init_state(self, batch_size: int = 1) -> dict:
+        """
+        Streaming state for `step`.
+
+        gEncoder:   the unconsumed input tail of every `gEncoder` conv layer
+        hidden:     the `gAR` hidden state
+        downsample: the `CConv1d` buffers of `self.downsample`
+        """
+        p = next(self.parameters())
+        return {
+            "gEncoder": self.encoder.gEncoder.init_state(
+                batch_size, device=p.device, dtype=p.dtype
+            ),
+            "hidden": None,
+            "downsample": [
+                layer.init_state(batch_size, device=p.device, dtype=p.dtype)
+                for layer in self.downsample
+                if isinstance(layer, CConv1d)
+            ],
+        }
+
+    def encode_step(self, waveform: Tensor, state: dict, flush: bool = False) -> Tensor:
+        """The incremental `encode` (see `step`), the `gEncoder` and `hidden` state"""
+        if waveform.ndim < 3:
+            waveform = waveform.unsqueeze(1)  # channel dim
+
+        z = self.encoder.gEncoder.step(waveform, state["gEncoder"], flush=flush)
+        z = einops.rearrange(z, "b c n -> b n c")
+        if z.shape[1] > 0:
+            # The module level `keepHidden` state is shared by all streams
+            z, state["hidden"] = self.encoder.gAR.step(z, state["hidden"])
+        return z
+
+    def step(self, waveform: Tensor, state: dict, flush: bool = False) -> Tensor:
+        """
+        Incremental forward over the next chunk of the waveform, of any size.
+        Updates the `state` (see `init_state`) in-place and returns the frames,
+        (B, t, D), completed by this chunk.
+
+        The (non-causal) `gEncoder` frame n covers the samples
+        [160n - 153, 160n + 311] so a frame is produced once all of its samples
+        are received. `flush` ends the stream (see `flush`).
+
+        Concatenating the output of all steps (and `flush`) gives the same
+        frames as `forward` over the entire waveform.
+        """
+        z = self.encode_step(waveform, state, flush=flush)
+        n = 0
+        for layer in self.downsample:
+            if isinstance(layer, CConv1d):
+                z, state["downsample"][n] = layer.step(z, state["downsample"][n])
+                n += 1
+            else:
+                z = layer(z)
         return z
+
+    def flush(self, state: dict) -> Tensor:
+        """
+        End the stream: the last frames, which depend on the (right) zero
+        padding of `gEncoder`, as in `forward`.
+        """
+        p = next(self.parameters())
+        batch_size = state["gEncoder"][0].shape[0]
+        empty = torch.zeros((batch_size, 1, 0), device=p.device, dtype=p.dtype)
+        return self.step(empty, state, flush=True)
+
+    @staticmethod
+    def stack_states(states: list[dict]) -> dict:
+        """
+        Batch the `step` states of different streams. The states must have the
+        same shapes, i.e. the streams have received the same number of samples
+        modulo the encoder hop (e.g. fixed size chunks of 320 samples).
+        """
+        hidden = [s["hidden"] for s in states]
+        if all(h is None for h in hidden):
+            hidden = None
+        else:
+            ref = next(h for h in hidden if h is not None)
+            hidden = torch.cat(
+                [torch.zeros_like(ref) if h is None else h for h in hidden], dim=1
+            )
+        return {
+            "gEncoder": [torch.cat(x) for x in zip(*[s["gEncoder"] for s in states])],
+            "hidden": hidden,
+            "downsample": [
+                torch.cat(x) for x in zip(*[s["downsample"] for s in states])
+            ],
+        }
+
+    @staticmethod
+    def split_state(state: dict) -> list[dict]:
+        """The (batch size 1) states of a `stack_states` state"""
+        batch_size = state["gEncoder"][0].shape[0]
+        return [
+            {
+                "gEncoder": [x[i : i + 1] for x in state["gEncoder"]],
+                "hidden": (
+                    state["hidden"][:, i : i + 1].contiguous()
+                    if state["hidden"] is not None
+                    else None
+                ),
+                "downsample": [x[i : i + 1] for x in state["downsample"]],
+            }
+            for i in range(batch_size)
+        ]
+
+    @staticmethod
+    def get_state_signature(state: dict) -> tuple:
+        """States with the same signature can be stacked"""
+        return tuple(x.shape[-1] for x in state["gEncoder"] + state["downsample"])
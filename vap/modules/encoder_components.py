@@ -1,11 +1,12 @@
 import argparse
+import json
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops.layers.torch import Rearrange
 from os.path import exists, join, dirname
 from os import makedirs
-from typing import List
+from typing import List, Optional, Tuple
 
 from vap.utils.utils import repo_root
 
@@ -32,6 +33,39 @@ CHECKPOINTS = {
     "cpc": join(repo_root(), "assets/checkpoints/cpc/60k_epoch4-d0f474de.pt")
 }
 NAMES = list(CHECKPOINTS.keys())
+# The architecture (`checkpoint["config"]`) of the CPC checkpoint
+CPC_CONFIG = join(repo_root(), "assets/checkpoints/cpc/60k_epoch4-d0f474de.json")
+
+
+def conv1d_step(
+    conv: nn.Conv1d, x: torch.Tensor, state: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Incremental (unpadded) forward of `conv`. `state` holds the inputs not yet
+    consumed by a full (strided) kernel window, initially the left padding.
+
+    Returns the new outputs and the new state.
+    """
+    x = torch.cat((state, x), dim=-1)
+    span = conv.dilation[0] * (conv.kernel_size[0] - 1) + 1
+    stride = conv.stride[0]
+    if x.shape[-1] < span:
+        return x.new_zeros((x.shape[0], conv.out_channels, 0)), x
+    n_out = (x.shape[-1] - span) // stride + 1
+    x_valid = x[..., : (n_out - 1) * stride + span]
+    if hasattr(conv, "forward_valid"):
+        # quantized conv (see `vap.quantization.QuantizedConv1d`)
+        y = conv.forward_valid(x_valid)
+    else:
+        y = F.conv1d(
+            x_valid,
+            conv.weight,
+            conv.bias,
+            stride=conv.stride,
+            dilation=conv.dilation,
+            groups=conv.groups,
+        )
+    return y, x[..., n_out * stride :]
 
 
 class ChannelNorm(nn.Module):
@@ -103,6 +137,157 @@ class CPCEncoder(nn.Module):
         x = F.relu(self.batchNorm4(self.conv4(x)))
         return x
 
+    def get_layers(self) -> List[Tuple[nn.Conv1d, nn.Module]]:
+        return [
+            (self.conv0, self.batchNorm0),
+            (self.conv1, self.batchNorm1),
+            (self.conv2, self.batchNorm2),
+            (self.conv3, self.batchNorm3),
+            (self.conv4, self.batchNorm4),
+        ]
+
+    def receptive_field(self) -> Tuple[int, int, int]:
+        """
+        The hop and the (left, right) context of the output frames: frame n
+        covers the samples [hop * n - left, hop * n + right].
+        """
+        hop, start, end = 1, 0, 0
+        for conv, _ in reversed(self.get_layers()):
+            k, s, p = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+            start, end = start * s - p, end * s - p + k - 1
+            hop *= s
+        return hop, -start, end
+
+    def get_n_frames(self, n_samples: int) -> int:
+        for conv, _ in self.get_layers():
+            k, s, p = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+            n_samples = (n_samples + 2 * p - k) // s + 1
+        return n_samples
+
+    def get_silent_frames(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        The (B, n_frames) frames of `x`, (B, 1, n_samples), whose samples are
+        all exactly zero (and within `x`, i.e. not the zero padding). These
+        frames are all the same (the norm is per frame), see `silence_frame`.
+        """
+        hop, left, right = self.receptive_field()
+        n_samples = x.shape[-1]
+        nonzero = F.pad((x[:, 0] != 0).cumsum(-1), (1, 0))
+        start = torch.arange(self.get_n_frames(n_samples), device=x.device) * hop
+        start, end = start - left, start + right + 1
+        count = nonzero[:, end.clamp(max=n_samples)]
+        count = count - nonzero[:, start.clamp(min=0)]
+        return (start >= 0) & (end <= n_samples) & (count == 0)
+
+    def silence_frame(self, x: torch.Tensor) -> torch.Tensor:
+        """The (C,) output frame of (digital) silence"""
+        hop, left, right = self.receptive_field()
+        n = -(-left // hop)  # the first frame without (left) padding
+        return self(x.new_zeros((1, 1, hop * n + right + 1)))[0, :, n]
+
+    @staticmethod
+    def has_silent_span(silent: torch.Tensor, min_frames: int) -> torch.Tensor:
+        """The (B,) rows of `silent` with a run of at least `min_frames` frames"""
+        if silent.shape[-1] < min_frames:
+            return silent.new_zeros(silent.shape[0])
+        return silent.unfold(-1, min_frames, 1).all(-1).any(-1)
+
+    def forward_skip_silence(
+        self,
+        x: torch.Tensor,
+        min_frames: int = 50,
+        silent: Optional[torch.Tensor] = None,
+        rows: Optional[List[bool]] = None,
+    ) -> torch.Tensor:
+        """
+        `forward` without the convs over the exactly silent spans of at least
+        `min_frames` frames (see `get_silent_frames`), which are all set to the
+        `silence_frame`. The frames in between are computed over their samples
+        (and receptive field) only, which gives the same frames as `forward`.
+
+        The `silent` frames and the `rows` with silent spans (`has_silent_span`)
+        are computed if not given.
+        """
+        if silent is None:
+            silent = self.get_silent_frames(x)
+        if rows is None:
+            rows = self.has_silent_span(silent, min_frames).tolist()
+        if not any(rows):
+            return self(x)
+
+        hop, left, right = self.receptive_field()
+        n_left, n_right = -(-left // hop), -(-(right + 1) // hop)
+        n_samples = x.shape[-1]
+        z0 = self.silence_frame(x)
+        z = [None] * x.shape[0]
+        for b, row in enumerate(x.unsqueeze(1)):
+            if not rows[b]:
+                continue
+            values, counts = torch.unique_consecutive(silent[b], return_counts=True)
+            spans, start = [], 0  # (start, end, silent) frames
+            for value, count in zip(values.tolist(), counts.tolist()):
+                if value and count >= min_frames:
+                    spans.append((start, start + count, True))
+                elif spans and not spans[-1][2]:
+                    spans[-1] = (spans[-1][0], start + count, False)
+                else:
+                    spans.append((start, start + count, False))
+                start += count
+
+            frames = []
+            for start, end, is_silent in spans:
+                if is_silent:
+                    frames.append(z0.unsqueeze(-1).expand(-1, end - start))
+                    continue
+                s = max(0, hop * (start - n_left))
+                e = min(n_samples, hop * (end - 1 + n_right))
+                offset = s // hop
+                frames.append(self(row[..., s:e])[0, :, start - offset : end - offset])
+            z[b] = torch.cat(frames, dim=-1)
+
+        others = [b for b, r in enumerate(rows) if not r]
+        if others:
+            for b, zb in zip(others, self(x[others])):
+                z[b] = zb
+        return torch.stack(z)
+
+    def init_state(
+        self,
+        batch_size: int = 1,
+        device: str = "cpu",
+        dtype: torch.dtype = torch.float32,
+    ) -> List[torch.Tensor]:
+        """The (left) zero padding of every conv layer"""
+        return [
+            torch.zeros(
+                (batch_size, conv.in_channels, conv.padding[0]),
+                device=device,
+                dtype=dtype,
+            )
+            for conv, _ in self.get_layers()
+        ]
+
+    def step(
+        self, x: torch.Tensor, state: List[torch.Tensor], flush: bool = False
+    ) -> torch.Tensor:
+        """
+        Incremental forward over a chunk of samples of any size. Each conv layer
+        keeps the tail of its input which is not yet covered by a full kernel
+        window, so every sample is only processed once. The norm is over the
+        channels (per frame) so it does not need any state.
+
+        `flush` adds the right padding of every layer, i.e. ends the stream,
+        which produces the last frames exactly as `forward` over the entire input.
+        `state` is updated in-place.
+        """
+        for n, (conv, norm) in enumerate(self.get_layers()):
+            if flush:
+                pad = x.new_zeros((x.shape[0], x.shape[1], conv.padding[0]))
+                x = torch.cat((x, pad), dim=-1)
+            x, state[n] = conv1d_step(conv, x, state[n])
+            x = F.relu(norm(x))
+        return x
+
 
 class CPCAR(nn.Module):
     """
@@ -143,7 +328,7 @@ class CPCAR(nn.Module):
             x = torch.flip(x, [1])
         try:
             self.baseNet.flatten_parameters()
-        except RuntimeError:
+        except (RuntimeError, AttributeError):  # AttributeError: quantized
             pass
         x, h = self.baseNet(x, self.hidden)
         if self.keepHidden:
@@ -158,6 +343,19 @@ class CPCAR(nn.Module):
             x = torch.flip(x, [1])
         return x
 
+    def step(self, x, hidden=None):
+        """
+        Incremental forward from an explicit `hidden` state (instead of the
+        module level `self.hidden`) so that several streams can share the model.
+        Returns the output and the new hidden state.
+        """
+        assert not self.reverse, "A reversed AR network can't be run incrementally"
+        try:
+            self.baseNet.flatten_parameters()
+        except (RuntimeError, AttributeError):  # AttributeError: quantized
+            pass
+        return self.baseNet(x, hidden)
+
 
 class CPCModel(nn.Module):
     """
@@ -367,17 +565,33 @@ def load_CPC(load_state_dict=True):
     # from cpc.feature_loader import getEncoder, getAR, loadArgs
     # from cpc.feature_loader import loadArgs
 
+    def load_checkpoint():
+        if exists(CHECKPOINTS["cpc"]):
+            checkpoint = torch.load(CHECKPOINTS["cpc"], map_location="cpu")
+        else:
+            checkpoint_url = "https://dl.fbaipublicfiles.com/librilight/CPC_checkpoints/60k_epoch4-d0f474de.pt"
+            checkpoint = torch.hub.load_state_dict_from_url(
+                checkpoint_url, progress=False, map_location="cpu"
+            )
+            makedirs(dirname(CHECKPOINTS["cpc"]), exist_ok=True)
+            torch.save(checkpoint, CHECKPOINTS["cpc"])
+        if not exists(CPC_CONFIG):
+            # the architecture without the checkpoint (`load_state_dict=False`)
+            try:
+                with open(CPC_CONFIG, "w") as f:
+                    json.dump(checkpoint["config"], f)
+            except OSError:  # e.g. a read-only install
+                pass
+        return checkpoint
+
     locArgs = get_default_cpc_config()
-    if exists(CHECKPOINTS["cpc"]):
-        checkpoint = torch.load(CHECKPOINTS["cpc"], map_location="cpu")
+    if load_state_dict or not exists(CPC_CONFIG):
+        checkpoint = load_checkpoint()
+        config = checkpoint["config"]
     else:
-        checkpoint_url = "https://dl.fbaipublicfiles.com/librilight/CPC_checkpoints/60k_epoch4-d0f474de.pt"
-        checkpoint = torch.hub.load_state_dict_from_url(
-            checkpoint_url, progress=False, map_location="cpu"
-        )
-        makedirs(dirname(CHECKPOINTS["cpc"]))
-        torch.save(checkpoint, CHECKPOINTS["cpc"])
-    loadArgs(locArgs, argparse.Namespace(**checkpoint["config"]))
+        with open(CPC_CONFIG) as f:
+            config = json.load(f)
+    loadArgs(locArgs, argparse.Namespace(**config))
     # encoderNet = getEncoder(locArgs)
     encoderNet = CPCEncoder(locArgs.hiddenEncoder, locArgs.normMode)
     # arNet = getAR(locArgs)
@@ -481,6 +695,30 @@ class CConv1d(nn.Conv1d):
     def forward(self, input):
         return super().forward(self.pad(input))
 
+    def init_state(
+        self,
+        batch_size: int = 1,
+        device: str = "cpu",
+        dtype: torch.dtype = torch.float32,
+    ) -> torch.Tensor:
+        """The causal (left) padding is the context of the first input"""
+        return torch.full(
+            (batch_size, self.in_channels, self.pad.padding[0]),
+            self.pad.value,
+            device=device,
+            dtype=dtype,
+        )
+
+    def step(
+        self, input: torch.Tensor, state: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Incremental forward, see `conv1d_step` and `init_state`.
+
+        Returns the new outputs and the new state.
+        """
+        return conv1d_step(self, input, state)
+
 
 def get_cnn_layer(
     dim: int,
@@ -1,10 +1,6 @@
 import torch
 from transformers import Wav2Vec2ForPreTraining
 
-from vap.utils.utils import everything_deterministic
-
-everything_deterministic()
-
 VALID_CHECKPOINTS = ["facebook/mms-1b", "facebook/mms-300m"]
 
 
@@ -5,19 +5,16 @@ from torch.optim.lr_scheduler import _LRScheduler
 from torch.optim.optimizer import Optimizer
 
 import lightning as L
-from typing import Optional, Mapping, Iterable, Callable
+from typing import TYPE_CHECKING, Optional, Mapping, Iterable, Callable
 
-from vap.metrics import VAPMetric
 from vap.modules.VAP import VAP
-from vap.utils.utils import everything_deterministic
+from vap.modules.compiled import CompiledVAP
 
-from vap.modules.encoder import EncoderCPC
-from vap.modules.transformer import VapStereoTower
+if TYPE_CHECKING:  # torchmetrics, only imported by the metrics themselves
+    from vap.metrics import VAPMetric
 
 Batch = Mapping[str, Tensor]
 
-everything_deterministic()
-
 
 class VAPModule(L.LightningModule):
     def __init__(
@@ -25,10 +22,12 @@ class VAPModule(L.LightningModule):
         model: VAP,
         optim_fn: Optional[Callable[Iterable[Parameter], Optimizer]] = None,
         lr_scheduler: Optional[_LRScheduler] = None,
-        train_metric: Optional[VAPMetric] = None,
-        val_metric: Optional[VAPMetric] = None,
-        test_metric: Optional[VAPMetric] = None,
+        train_metric: Optional["VAPMetric"] = None,
+        val_metric: Optional["VAPMetric"] = None,
+        test_metric: Optional["VAPMetric"] = None,
         num_sink_tokens = 2,  # New parameter for attention sinks
+        compile_frame_buckets: Optional[list[int]] = None,
+        compile_batch_buckets: Optional[list[int]] = None,
     ):
         super().__init__()
         self.model = model
@@ -42,9 +41,20 @@ class VAPModule(L.LightningModule):
         self.val_metric = val_metric
         self.test_metric = test_metric
         self.num_sink_tokens = num_sink_tokens # New parameter for attention sinks
+
+        # Shape bucketed `torch.compile` (see `CompiledVAP`), not a submodule
+        self.compiled: Optional[CompiledVAP] = None
+        if compile_frame_buckets is not None:
+            self.compiled = CompiledVAP(
+                model, compile_frame_buckets, batch_buckets=compile_batch_buckets
+            )
         self.save_hyperparameters()  # ignore=["model"])
 
-    def forward(self, waveform: Tensor, *args, **kwargs) -> dict[str, Tensor]:
+    def forward(
+        self, waveform: Optional[Tensor] = None, *args, **kwargs
+    ) -> dict[str, Tensor]:
+        if self.compiled is not None and not args and not kwargs:
+            return self.compiled(waveform)
         return self.model(waveform, *args, **kwargs)
 
     @staticmethod
@@ -85,7 +95,16 @@ class VAPModule(L.LightningModule):
             out:        dict, ['logits', 'vad', 'vap_loss', 'vad_loss']
         """
         labels = self.model.extract_labels(batch["vad"])
-        out = self(batch["waveform"])
+        if "starts" in batch:
+            # the windows of a session, encoded once (see `VAPSessionDataset`)
+            out = self.model.forward_windows(
+                batch["waveform"], batch["starts"], batch["n_frames"]
+            )
+        elif "features" in batch:
+            # precomputed encoder features (see `vap.data.feature_store`)
+            out = self(features=batch["features"])
+        else:
+            out = self(batch["waveform"])
 
         out["vap_loss"] = self.model.objective.loss_vap(
             out["logits"], labels, reduction=reduction
@@ -94,7 +113,7 @@ class VAPModule(L.LightningModule):
         self.metric_update(out["logits"], batch["vad"], split=split)
 
         # Log results
-        batch_size = batch["waveform"].shape[0]
+        batch_size = batch["vad"].shape[0]
         self.log(
             f"{split}_loss", out["vap_loss"], batch_size=batch_size, sync_dist=True
         )
@@ -3,9 +3,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
-from einops.layers.torch import Rearrange
+from functools import lru_cache
 from typing import Dict, Optional, Tuple, Mapping
 
+from vap.utils.profiling import span
+
 
 def ffn_block(
     din: int,
@@ -22,30 +24,249 @@ def ffn_block(
     )
 
 
+SINK_LAYOUTS = ["kv", "tokens"]
+# The rows (in units of dim) of the packed `MultiHeadAttention.in_proj`
+IN_PROJ_ROWS = {"q": (0, 1), "k": (1, 2), "v": (2, 3), "kv": (1, 3)}
+
+
+class KVCache:
+    """
+    Projected keys/values, (B, heads, N, D), of every position an attention
+    module has attended to so far. Used for incremental (streaming) inference
+    where only the newly added positions are projected.
+
+    With a `window` the cache is bounded (StreamingLLM style): the first
+    `num_pinned` positions (the attention sinks) are always kept and after
+    them only the `window` most recent positions.
+
+    Caches of different lengths are batched with `KVCache.stack`: the rows
+    are left padded and `lengths` holds the actual length of every row.
+    """
+
+    def __init__(
+        self,
+        k: Tensor,
+        v: Tensor,
+        num_pinned: int = 0,
+        window: Optional[int] = None,
+        lengths: Optional[list[int]] = None,
+    ) -> None:
+        self.k = k
+        self.v = v
+        self.num_pinned = num_pinned
+        self.window = window
+        self.lengths = lengths
+
+    def __len__(self) -> int:
+        return self.k.shape[-2]
+
+    @staticmethod
+    def cat(caches: list["KVCache"]) -> "KVCache":
+        """Caches of the same length concatenated along the batch dimension"""
+        return KVCache(
+            torch.cat([c.k for c in caches]),
+            torch.cat([c.v for c in caches]),
+            num_pinned=caches[0].num_pinned,
+            window=caches[0].window,
+        )
+
+    def append(self, k: Tensor, v: Tensor) -> Tuple[Tensor, Tensor]:
+        self.k = torch.cat((self.k, k), dim=-2)
+        self.v = torch.cat((self.v, v), dim=-2)
+        if self.lengths is not None:
+            self.lengths = [n + k.shape[-2] for n in self.lengths]
+        return self.k, self.v
+
+    def set_window(self, window: Optional[int]) -> None:
+        """Pin all current positions and keep at most `window` positions after them"""
+        assert window is None or window > 0, f"window must be > 0, got {window}"
+        self.num_pinned = len(self)
+        self.window = window
+
+    def evict(self) -> None:
+        # stacked caches are evicted row by row in `unstack`
+        if self.window is None or self.lengths is not None:
+            return
+        n = len(self) - self.num_pinned - self.window
+        if n > 0:
+            p = self.num_pinned
+            self.k = torch.cat((self.k[..., :p, :], self.k[..., p + n :, :]), dim=-2)
+            self.v = torch.cat((self.v[..., :p, :], self.v[..., p + n :, :]), dim=-2)
+
+    def clone(self) -> "KVCache":
+        lengths = list(self.lengths) if self.lengths is not None else None
+        return KVCache(
+            self.k.clone(), self.v.clone(), self.num_pinned, self.window, lengths
+        )
+
+    @staticmethod
+    def stack(caches: list["KVCache"]) -> "KVCache":
+        """Batch the caches (B=1) of different streams, left padded to the longest"""
+        num_pinned, window = caches[0].num_pinned, caches[0].window
+        for c in caches:
+            assert (
+                c.k.shape[0] == 1
+            ), f"Expects caches with batch size 1, got {c.k.shape[0]}"
+            assert (
+                c.num_pinned == num_pinned and c.window == window
+            ), "All caches must have the same pinned positions and window"
+        lengths = [len(c) for c in caches]
+        n = max(lengths)
+        k = torch.cat([F.pad(c.k, (0, 0, n - len(c), 0)) for c in caches])
+        v = torch.cat([F.pad(c.v, (0, 0, n - len(c), 0)) for c in caches])
+        return KVCache(k, v, num_pinned, window, lengths)
+
+    def unstack(self, caches: list["KVCache"]) -> None:
+        """Write the rows back to the (`stack`ed) `caches` and evict"""
+        assert self.lengths is not None, "Not a stacked cache"
+        n = len(self)
+        for i, (c, length) in enumerate(zip(caches, self.lengths)):
+            c.k = self.k[i : i + 1, :, n - length :]
+            c.v = self.v[i : i + 1, :, n - length :]
+            c.evict()
+
+
+def iter_kv_caches(cache):
+    """All `KVCache`s in a (nested) cache, e.g. `TransformerStereo.init_cache`"""
+    if isinstance(cache, KVCache):
+        yield cache
+    elif isinstance(cache, dict):
+        for c in cache.values():
+            yield from iter_kv_caches(c)
+    elif isinstance(cache, (list, tuple)):
+        for c in cache:
+            yield from iter_kv_caches(c)
+
+
+def stack_kv_caches(caches: list):
+    """`KVCache.stack` over (nested) caches of the same structure"""
+    c = caches[0]
+    if isinstance(c, KVCache):
+        return KVCache.stack(caches)
+    elif isinstance(c, dict):
+        return {k: stack_kv_caches([x[k] for x in caches]) for k in c}
+    return [stack_kv_caches([x[i] for x in caches]) for i in range(len(c))]
+
+
+def unstack_kv_caches(cache, caches: list) -> None:
+    """`KVCache.unstack` over (nested) caches, see `stack_kv_caches`"""
+    rows = zip(*[iter_kv_caches(c) for c in caches])
+    for stacked, row in zip(iter_kv_caches(cache), rows):
+        stacked.unstack(list(row))
+
+
+class AlibiBiasCache:
+    """
+    Process wide cache of aLiBi + causal biases, (1, heads, T, T), shared by all
+    `MultiHeadAttentionAlibi` modules with the same slopes.
+
+    The biases are keyed by (heads, slopes, device, dtype) and built directly
+    on the device. A longer sequence grows the stored bias geometrically (to
+    the next power of 2) and shorter sequences are views of it, so there are
+    no allocations or device transfers once the cache is warm.
+    """
+
+    def __init__(self) -> None:
+        self.biases = {}
+
+    def __len__(self) -> int:
+        return len(self.biases)
+
+    def clear(self) -> None:
+        self.biases = {}
+
+    @staticmethod
+    def build(
+        T: int, slopes: Tuple[float, ...], device, dtype: torch.dtype
+    ) -> Tensor:
+        m = torch.tensor(slopes, device=device, dtype=dtype).view(1, -1, 1, 1)
+        alibi = torch.arange(T, device=device, dtype=dtype).view(1, 1, 1, -1) * m
+        # + 1, the (lower triangle) ones of the causal mask in `get_alibi_mask`
+        alibi = alibi + 1
+        causal = torch.ones((T, T), device=device, dtype=torch.bool).triu_(1)
+        alibi = alibi.masked_fill(causal, float("-inf"))
+        alibi.requires_grad_(False)
+        return alibi
+
+    def get(
+        self,
+        T: int,
+        slopes: Tuple[float, ...],
+        device="cpu",
+        dtype: torch.dtype = torch.float32,
+    ) -> Tensor:
+        key = (len(slopes), slopes, torch.device(device), dtype)
+        bias = self.biases.get(key)
+        if bias is None or bias.shape[-1] < T:
+            n = 1 << max(T - 1, 0).bit_length()
+            bias = AlibiBiasCache.build(n, slopes, device, dtype)
+            self.biases[key] = bias
+        return bias[..., :T, :T]
+
+
+alibi_bias_cache = AlibiBiasCache()
+
+
 class MultiHeadAttention(nn.Module):
     """
     A vanilla multi-head masked self-attention layer with a projection at the end.
     It is possible to use torch.nn.MultiheadAttention here but I am including an
     explicit implementation here to show that there is nothing too scary here.
+
+    Unless the attention weights are requested (`need_weights`) the attention
+    runs through `F.scaled_dot_product_attention` with the mask as an additive
+    bias, which never materializes the (B, heads, T, T) weights in python and
+    uses the fused kernels where available. Set `MultiHeadAttention.sdpa = False`
+    to always use the explicit implementation.
+
+    The query/key/value projections are packed into a single (3 * dim, dim)
+    linear layer, `in_proj` (rows: query, key, value), so self-attention
+    projects with one matrix multiplication and cross-attention with two (the
+    query, and the keys/values of the shared source). State dicts (and pickled
+    modules) with the separate `query`, `key` and `value` layers are fused on
+    load.
+
+    Attention sinks (`num_sink_tokens`) are positions that precede the input
+    and are always attended to, i.e. the initial `KVCache` (see `init_cache`):
+        sink_layout="kv":       learned keys/values, `sink_k`, `sink_v`
+        sink_layout="tokens":   (legacy) learned tokens, `sink_tokens`, that are
+                                projected to keys/values
+
+    `max_lookback` restricts every position to the `max_lookback` most recent
+    positions (itself included) and the cached positions (the sinks). Without
+    the attention weights this runs blockwise (see `attend_local`) with memory
+    and compute linear in the sequence length.
     """
 
+    sdpa: bool = True
+    max_lookback: Optional[int] = None
+    # modules pickled before the layout was configurable use the legacy sinks
+    sink_layout: str = "tokens"
+
     def __init__(
-        self, dim: int, num_heads: int, dropout: float, bias: bool = False, num_sink_tokens: int = 2  # Added num_sink_tokens parameter
+        self,
+        dim: int,
+        num_heads: int,
+        dropout: float,
+        bias: bool = False,
+        num_sink_tokens: int = 2,
+        sink_layout: str = "tokens",
+        max_lookback: Optional[int] = None,
     ) -> None:
         super().__init__()
         assert dim % num_heads == 0
+        assert sink_layout in SINK_LAYOUTS, f"sink_layout must be one of {SINK_LAYOUTS}"
+        assert (
+            max_lookback is None or max_lookback > 0
+        ), f"max_lookback must be > 0, got {max_lookback}"
         self.num_heads = num_heads
         self.dim = dim
-        self.num_sink_tokens = num_sink_tokens  # Added this line
-
-        # key, query, value projections for all heads
-        self.key = nn.Linear(dim, dim, bias=bias)
-        self.query = nn.Linear(dim, dim, bias=bias)
-        self.value = nn.Linear(dim, dim, bias=bias)
+        self.num_sink_tokens = num_sink_tokens
+        self.sink_layout = sink_layout
+        self.max_lookback = max_lookback
 
-        # head re-shapers
-        self.unstack_heads = Rearrange("b t (h d) -> b h t d", h=self.num_heads)
-        self.stack_heads = Rearrange("b h t d -> b t (h d)")
+        # packed query, key, value projections for all heads
+        self.in_proj = nn.Linear(dim, 3 * dim, bias=bias)
 
         # regularization
         self.attn_drop = nn.Dropout(dropout)
@@ -55,8 +276,109 @@ class MultiHeadAttention(nn.Module):
         self.proj = nn.Linear(dim, dim, bias=bias)
         self.scale = 1.0 / math.sqrt(dim)
 
-        # add parameter for sink tokens
-        self.sink_tokens = nn.Parameter(torch.randn(1, num_sink_tokens, dim))  # Added this line
+        if sink_layout == "kv":
+            # the scale of N(0, 1) tokens projected by the N(0, 0.02) init (see GPT)
+            std = 0.02 * math.sqrt(dim)
+            shape = (1, num_heads, num_sink_tokens, dim // num_heads)
+            self.sink_k = nn.Parameter(torch.randn(shape) * std)
+            self.sink_v = nn.Parameter(torch.randn(shape) * std)
+        else:
+            self.sink_tokens = nn.Parameter(torch.randn(1, num_sink_tokens, dim))
+
+    def __setstate__(self, state: dict) -> None:
+        super().__setstate__(state)
+        # modules pickled with the separate projections
+        if "query" in self._modules:
+            self.fuse_projections()
+
+    def fuse_projections(self) -> None:
+        """Replace the separate `query`, `key`, `value` layers by `in_proj`"""
+        layers = [self._modules.pop(name) for name in ["query", "key", "value"]]
+        for name in ["unstack_heads", "stack_heads"]:
+            self._modules.pop(name, None)
+        bias = layers[0].bias is not None
+        in_proj = nn.Linear(self.dim, 3 * self.dim, bias=bias)
+        in_proj.to(device=layers[0].weight.device, dtype=layers[0].weight.dtype)
+        with torch.no_grad():
+            in_proj.weight.copy_(torch.cat([m.weight for m in layers]))
+            if bias:
+                in_proj.bias.copy_(torch.cat([m.bias for m in layers]))
+        self.in_proj = in_proj
+
+    def _load_from_state_dict(self, state_dict: dict, prefix: str, *args, **kwargs):
+        # fuse the weights of the separate projections into `in_proj`
+        for param in ["weight", "bias"]:
+            names = [f"{prefix}{m}.{param}" for m in ["query", "key", "value"]]
+            if all(name in state_dict for name in names):
+                state_dict[f"{prefix}in_proj.{param}"] = torch.cat(
+                    [state_dict.pop(name) for name in names]
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def split_heads(self, x: Tensor) -> Tensor:
+        """(B, T, heads * D) -> (B, heads, T, D)"""
+        B, T, _ = x.shape
+        # the explicit head size, -1 is ambiguous without frames (T = 0)
+        D = self.dim // self.num_heads
+        return x.view(B, T, self.num_heads, D).transpose(1, 2)
+
+    def merge_heads(self, x: Tensor) -> Tensor:
+        """(B, heads, T, D) -> (B, T, heads * D)"""
+        B, _, T, _ = x.shape
+        return x.transpose(1, 2).reshape(B, T, self.dim)
+
+    def in_linear(self, x: Tensor, rows: str) -> Tensor:
+        """
+        `x` projected by the `rows` ("q", "k", "v" or "kv", see `IN_PROJ_ROWS`)
+        of `in_proj`. Quantized modules (see `vap.quantization`), whose weights
+        can't be sliced, hold the rows as separate layers in `in_proj_rows`.
+        """
+        if "in_proj_rows" in self._modules:
+            return self.in_proj_rows[rows](x)
+        start, end = (i * self.dim for i in IN_PROJ_ROWS[rows])
+        b = self.in_proj.bias
+        return F.linear(
+            x, self.in_proj.weight[start:end], None if b is None else b[start:end]
+        )
+
+    def project(
+        self, Q: Tensor, K: Tensor, V: Tensor
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        The (B, heads, T, D) queries, keys and values. A single projection if
+        `Q`, `K` and `V` are the same tensor (self-attention) and a single
+        key/value projection if `K` and `V` are (cross-attention).
+        """
+        if Q is K and K is V:
+            B, T, _ = Q.shape
+            D = self.dim // self.num_heads
+            qkv = self.in_proj(Q).view(B, T, 3, self.num_heads, D)
+            q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+            return q, k, v
+        q = self.split_heads(self.in_linear(Q, "q"))
+        k, v = self.project_kv(K, V)
+        return q, k, v
+
+    def project_kv(self, K: Tensor, V: Tensor) -> Tuple[Tensor, Tensor]:
+        """The (B, heads, T, D) keys and values, a single projection if `K is V`"""
+        if K is V:
+            B, T, _ = K.shape
+            D = self.dim // self.num_heads
+            kv = self.in_linear(K, "kv").view(B, T, 2, self.num_heads, D)
+            k, v = kv.permute(2, 0, 3, 1, 4).unbind(0)
+            return k, v
+        k = self.split_heads(self.in_linear(K, "k"))
+        v = self.split_heads(self.in_linear(V, "v"))
+        return k, v
+
+    def set_sinks(self, k: Tensor, v: Tensor) -> None:
+        """Replace the sinks by the keys/values (1, heads, N, D), `sink_layout="kv"`"""
+        if self.sink_layout == "tokens":
+            del self.sink_tokens
+        self.sink_layout = "kv"
+        self.num_sink_tokens = k.shape[-2]
+        self.sink_k = nn.Parameter(k.detach().clone())
+        self.sink_v = nn.Parameter(v.detach().clone())
 
     def get_scores(self, q: Tensor, k: Tensor) -> Tensor:
         """
@@ -88,59 +410,321 @@ class MultiHeadAttention(nn.Module):
         qk = qk.masked_fill(mask == 0, float("-inf"))
         return qk
 
+    def get_attn_bias(
+        self, T: int, device: str = "cpu", dtype: torch.dtype = torch.float32
+    ) -> Tensor:
+        """The additive equivalent of `mask_scores` (without a mask): (1, 1, T, T)"""
+        mask = MultiHeadAttention.prepare_causal_mask(T, device=device, dtype=dtype)
+        return torch.zeros_like(mask).masked_fill_(mask == 0, float("-inf"))
+
+    def attend(self, q: Tensor, k: Tensor, v: Tensor, bias: Tensor) -> Tensor:
+        """
+        softmax(q k^T * scale + bias) v, with dropout, through the fused
+        `F.scaled_dot_product_attention`
+
+        Arguments:
+            q:      (B, heads, t, D)
+            k, v:   (B, heads, n, D)
+            bias:   (1 or B, 1 or heads, t, n)
+        """
+        return F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=bias.to(device=q.device, dtype=q.dtype),
+            dropout_p=self.attn_drop.p if self.training else 0.0,
+            scale=self.scale,
+        )
+
+    def get_relative_bias(self, dist: Tensor, dtype: torch.dtype) -> Tensor:
+        """
+        The bias of the key - query distances `dist` (no causal mask), in the
+        (relative) form of `get_step_mask`.
+
+        Return:
+            bias:   (1 or heads, *dist.shape)
+        """
+        return torch.zeros((1, *dist.shape), device=dist.device, dtype=dtype)
+
+    def get_lookback_mask(self, T: int, N: int, device: str = "cpu") -> Tensor:
+        """(T, N + T), True for the new positions beyond `max_lookback`"""
+        i = torch.arange(T, device=device).unsqueeze(-1)
+        j = torch.arange(-N, T, device=device)
+        return (j - i <= -self.max_lookback) & (j >= 0)
+
+    def attend_local(self, q: Tensor, k: Tensor, v: Tensor, N: int) -> Tensor:
+        """
+        Banded (causal) attention over the last `max_lookback` positions and
+        the `N` prefix (cached) positions, equal to `attend` with the dense
+        bias of `forward`.
+
+        The queries are split into blocks of `max_lookback` positions, each
+        attending to the prefix, the `max_lookback - 1` positions before the
+        block and the block itself, so the memory and compute are linear in T.
+
+        Arguments:
+            q:      (B, heads, T, D)
+            k, v:   (B, heads, N + T, D), the prefix positions first
+
+        Return:
+            y:      (B, heads, T, D)
+        """
+        B, H, T, D = q.shape
+        L = self.max_lookback
+        n_blocks = -(-T // L)
+        pad = n_blocks * L - T
+        W = 2 * L - 1  # keys of a block (after the prefix)
+
+        def get_blocks(x: Tensor) -> Tensor:
+            # (B, H, N + T, D) -> (B, H, n_blocks, N + W, D)
+            band = F.pad(x[..., N:, :], (0, 0, L - 1, pad))
+            band = band.unfold(2, W, L).transpose(-1, -2)
+            prefix = x[..., :N, :].unsqueeze(2).expand(-1, -1, n_blocks, -1, -1)
+            return torch.cat((prefix, band), dim=-2)
+
+        k, v = get_blocks(k), get_blocks(v)
+        q = F.pad(q, (0, 0, 0, pad)).reshape(B, H, n_blocks, L, D)
+
+        # query i = n * L + r, prefix key p, band key j = n * L - (L - 1) + w
+        device = q.device
+        r = torch.arange(L, device=device).view(1, L, 1)
+        i = torch.arange(n_blocks, device=device).view(-1, 1, 1) * L + r
+        w = torch.arange(W, device=device).view(1, 1, W)
+        dist = w - (L - 1) - r
+        invalid = (dist > 0) | (dist <= -L) | (i - r - (L - 1) + w < 0)
+        band_bias = self.get_relative_bias(dist.expand(n_blocks, -1, -1), q.dtype)
+        band_bias = band_bias.masked_fill(invalid, float("-inf"))
+        p = torch.arange(N, device=device).view(1, 1, N)
+        prefix_bias = self.get_relative_bias(p - N - i, q.dtype)
+        bias = torch.cat((prefix_bias, band_bias), dim=-1)
+
+        y = self.attend(
+            q.reshape(B, H * n_blocks, L, D),
+            k.reshape(B, H * n_blocks, N + W, D),
+            v.reshape(B, H * n_blocks, N + W, D),
+            bias.expand(H, -1, -1, -1).reshape(1, H * n_blocks, L, N + W),
+        )
+        return y.reshape(B, H, n_blocks * L, D)[..., :T, :]
+
     def forward(
         self,
         Q: torch.Tensor,
         K: torch.Tensor,
         V: torch.Tensor,
         mask: Optional[torch.Tensor] = None,
-    ) -> Tuple[Tensor, Tensor]:
-        # batch size, sequence length, embedding dimensionality (n_embd)
-        B, T, D = Q.size()
-
-        # Add sink tokens to the input
-        Q = torch.cat([self.sink_tokens.expand(B, -1, -1), Q], dim=1)  # Added this line
-        K = torch.cat([self.sink_tokens.expand(B, -1, -1), K], dim=1)  # Added this line
-        V = torch.cat([self.sink_tokens.expand(B, -1, -1), V], dim=1)  # Added this line
-
-        # Update T to include sink tokens
-        T += self.num_sink_tokens  # Added this line
+        need_weights: bool = True,
+        heads: Optional[list[int]] = None,
+        cache: Optional[KVCache] = None,
+    ) -> Tuple[Tensor, Optional[Tensor]]:
+        """
+        The positions of `Q` attend (causally) to the positions of `K`, `V`
+        preceded by the `cache` positions (default: `init_cache`, the sinks).
+        The cache is not updated (see `step`).
 
-        k = self.unstack_heads(self.key(K))
-        q = self.unstack_heads(self.query(Q))
-        v = self.unstack_heads(self.value(V))
+        Arguments:
+            Q, K, V:    (B, T, D)
+            mask:       (1 or B, 1, T, T) optional, 0 for the positions not attended to
 
-        # Adjust the mask to always attend to sink tokens
-        if mask is not None:  # Added this block
-            sink_mask = torch.ones((1, 1, T, self.num_sink_tokens), device=mask.device)
-            mask = torch.cat([sink_mask, mask], dim=-1)
+        Return:
+            y:      (B, T, D)
+            att:    (B, heads, T, N + T) the attention weights (over the N cached
+                    and T new positions) of all heads (or the selected `heads`),
+                    None if not `need_weights`
+        """
+        # batch size, sequence length, embedding dimensionality (n_embd)
+        B, T, D = Q.size()
+        if cache is None:
+            cache = self.init_cache(B)
+        N = len(cache)
+
+        q, k, v = self.project(Q, K, V)
+        k = torch.cat((cache.k, k), dim=-2)
+        v = torch.cat((cache.v, v), dim=-2)
+
+        local = self.max_lookback is not None and T > self.max_lookback
+        if local and self.sdpa and not need_weights and mask is None:
+            y = self.attend_local(q, k, v, N)
+            return self.resid_drop(self.proj(self.merge_heads(y))), None
+
+        # The rows of the new positions (N, ..., N + T - 1)
+        bias = self.get_attn_bias(N + T, q.device, q.dtype)[..., N:, :]
+        if local:
+            lookback_mask = self.get_lookback_mask(T, N, q.device)
+            bias = bias.masked_fill(lookback_mask, float("-inf"))
+        if mask is not None:
+            # the cached positions are always attended to
+            mask = F.pad(mask, (N, 0), value=1)
+            bias = bias.masked_fill(mask == 0, float("-inf"))
+
+        if self.sdpa and (not need_weights or heads is not None):
+            y = self.attend(q, k, v, bias)
+            y = self.resid_drop(self.proj(self.merge_heads(y)))
+            if not need_weights:
+                return y, None
+            # only the weights of the selected heads are materialized
+            if bias.shape[1] > 1:
+                bias = bias[:, heads]
+            att = self.get_scores(q[:, heads], k[:, heads]) * self.scale
+            return y, F.softmax(att + bias.to(att.device), dim=-1)
 
         att = self.get_scores(q, k) * self.scale
-        att = self.mask_scores(att, mask)
-        att = F.softmax(att, dim=-1)
+        att = F.softmax(att + bias.to(att.device), dim=-1)
 
         # Softmax, dropout, values
         y = self.attn_drop(att) @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
 
         # re-assemble all head outputs side by side
-        y = self.stack_heads(y)
+        y = self.merge_heads(y)
 
         # output projection
         y = self.resid_drop(self.proj(y))
+        if heads is not None:
+            att = att[:, heads]
         return y, att
 
+    def init_cache(self, batch_size: int = 1) -> KVCache:
+        """
+        The sinks are always the first positions attended to, so the cache
+        starts out with their keys/values.
+        """
+        if self.sink_layout == "kv":
+            k = self.sink_k.expand(batch_size, -1, -1, -1)
+            v = self.sink_v.expand(batch_size, -1, -1, -1)
+            return KVCache(k, v)
+        sinks = self.sink_tokens.expand(batch_size, -1, -1)
+        k, v = self.project_kv(sinks, sinks)
+        return KVCache(k, v)
+
+    @staticmethod
+    def get_step_positions(
+        n_queries: int,
+        n_keys: int,
+        device: str = "cpu",
+        num_pinned: int = 0,
+        window: Optional[int] = None,
+    ) -> Tuple[Tensor, Tensor]:
+        """
+        The newest `n_queries` positions (the last rows) attending to all
+        `n_keys` cached positions. Positions are the cache slots so that
+        evicted positions (see `KVCache`) do not change the distances.
+
+        Return:
+            dist:       (n_queries, n_keys), key - query position
+            invalid:    (n_queries, n_keys), future or outside of the window
+        """
+        q_pos = torch.arange(n_keys - n_queries, n_keys, device=device).unsqueeze(-1)
+        k_pos = torch.arange(n_keys, device=device)
+        dist = k_pos - q_pos
+        invalid = dist > 0
+        if window is not None:
+            invalid |= (dist <= -window) & (k_pos >= num_pinned)
+        return dist, invalid
+
+    def get_step_mask(
+        self,
+        n_queries: int,
+        n_keys: int,
+        device: str = "cpu",
+        dtype: torch.dtype = torch.float32,
+        num_pinned: int = 0,
+        window: Optional[int] = None,
+    ) -> Tensor:
+        """
+        Additive causal mask for incremental inference, see `get_step_positions`.
+
+        Return:
+            mask:   (1, 1, n_queries, n_keys)
+        """
+        _, invalid = MultiHeadAttention.get_step_positions(
+            n_queries, n_keys, device, num_pinned, window
+        )
+        mask = torch.zeros((n_queries, n_keys), device=device, dtype=dtype)
+        mask.masked_fill_(invalid, float("-inf"))
+        return mask.view(1, 1, n_queries, n_keys)
+
+    def get_cache_mask(
+        self,
+        n_queries: int,
+        cache: KVCache,
+        device: str = "cpu",
+        dtype: torch.dtype = torch.float32,
+    ) -> Tensor:
+        """
+        The step mask (`get_step_mask`) of the cache. Every row of a stacked
+        cache gets the mask of its own length with the left padding masked out.
+
+        Return:
+            mask:   (1 or B, 1 or heads, n_queries, n_keys)
+        """
+        if cache.lengths is None:
+            return self.get_step_mask(
+                n_queries, len(cache), device, dtype, cache.num_pinned, cache.window
+            )
+        n = len(cache)
+        masks = {}
+        for length in set(cache.lengths):
+            mask = self.get_step_mask(
+                n_queries, length, device, dtype, cache.num_pinned, cache.window
+            )
+            masks[length] = F.pad(mask, (n - length, 0), value=float("-inf"))
+        return torch.cat([masks[length] for length in cache.lengths])
+
+    def step(self, Q: Tensor, K: Tensor, V: Tensor, cache: KVCache) -> Tensor:
+        """
+        Incremental forward. The new positions `Q` (B, t, D) attend to all
+        cached positions and to the new keys/values `K`, `V` (B, t, D), which
+        are added to the `cache`.
+
+        Return:
+            y:      (B, t, D)
+        """
+        q, k, v = self.project(Q, K, V)
+        k, v = cache.append(k, v)
+        mask = self.get_cache_mask(q.shape[-2], cache, q.device, q.dtype)
+        if self.sdpa:
+            y = self.attend(q, k, v, mask)
+        else:
+            att = self.get_scores(q, k) * self.scale + mask
+            att = F.softmax(att, dim=-1)
+            y = self.attn_drop(att) @ v
+        cache.evict()
+        y = self.merge_heads(y)
+        return self.resid_drop(self.proj(y))
+
 
 class MultiHeadAttentionAlibi(MultiHeadAttention):
+    """
+    aLiBi attention. The (causal) biases come from the process wide
+    `alibi_bias_cache` unless `cache_bias = False` (e.g. in compiled graphs, see
+    `vap.modules.compiled`) where they are built in the forward pass, a
+    constant of the (static) shape without any python side state.
+    """
+
+    cache_bias: bool = True
+
     def __init__(
-        self, dim: int, num_heads: int, dropout: float, bias: bool = False, num_sink_tokens: int = 2  # Added num_sink_tokens parameter
+        self,
+        dim: int,
+        num_heads: int,
+        dropout: float,
+        bias: bool = False,
+        num_sink_tokens: int = 2,
+        sink_layout: str = "tokens",
+        max_lookback: Optional[int] = None,
     ) -> None:
-        super().__init__(dim, num_heads, dropout, bias, num_sink_tokens)  # Updated to pass num_sink_tokens
+        super().__init__(
+            dim, num_heads, dropout, bias, num_sink_tokens, sink_layout, max_lookback
+        )
         self.register_parameter(
             "m",
             nn.Parameter(torch.tensor(MultiHeadAttentionAlibi.get_slopes(num_heads))),
         )
         self.m.requires_grad_(False)
-        self.mask = None
+
+    @property
+    def slopes(self) -> Tuple[float, ...]:
+        """The key of the process wide `alibi_bias_cache`"""
+        return get_alibi_slopes(self.num_heads)
 
     @staticmethod
     def get_slopes(n: int) -> list[float]:
@@ -209,14 +793,23 @@ class MultiHeadAttentionAlibi(MultiHeadAttention):
         alibi.requires_grad_(False)  # this should not be trained
         return alibi
 
+    def get_relative_bias(self, dist: Tensor, dtype: torch.dtype) -> Tensor:
+        """aLiBi, m * dist: (num_heads, *dist.shape)"""
+        m = self.m.to(device=dist.device, dtype=dtype)
+        return dist.to(dtype) * m.view(-1, *[1] * dist.ndim)
+
+    def get_attn_bias(
+        self, T: int, device: str = "cpu", dtype: torch.dtype = torch.float32
+    ) -> Tensor:
+        """aLiBi + causal mask, (1, num_heads, T, T), from `alibi_bias_cache`"""
+        if not self.cache_bias:
+            return AlibiBiasCache.build(T, self.slopes, device, dtype)
+        return alibi_bias_cache.get(T, self.slopes, device=device, dtype=dtype)
+
     def mask_scores(self, qk: torch.Tensor, mask=None):
         T = qk.size(-1)
         if mask is None:
-            if self.mask is None or self.mask.shape[-1] < T:
-                mask = self.get_alibi_mask(T, device=qk.device, dtype=qk.dtype)
-                self.mask = mask
-            else:
-                mask = self.mask[..., :T, :T]
+            mask = self.get_attn_bias(T, device=qk.device, dtype=qk.dtype)
 
         # add aLiBi-mask to qk (see Figure 3.)
         # Addition/translation does not effect softmax (over each row)
@@ -224,6 +817,39 @@ class MultiHeadAttentionAlibi(MultiHeadAttention):
         qk = qk + mask.to(qk.device)
         return qk
 
+    def get_step_mask(
+        self,
+        n_queries: int,
+        n_keys: int,
+        device: str = "cpu",
+        dtype: torch.dtype = torch.float32,
+        num_pinned: int = 0,
+        window: Optional[int] = None,
+    ) -> Tensor:
+        """
+        aLiBi + causal mask for incremental inference, see `get_step_positions`.
+
+        The bias is relative, m * (j - i), instead of the absolute m * j used by
+        `get_alibi_mask`. They only differ by a constant over each row (which
+        softmax is invariant to) but the relative bias stays small over long
+        streams. With a window the distances are between cache slots, i.e. the
+        pinned sinks are re-based to directly precede the window.
+
+        Return:
+            mask:   (1, num_heads, n_queries, n_keys)
+        """
+        dist, invalid = MultiHeadAttention.get_step_positions(
+            n_queries, n_keys, device, num_pinned, window
+        )
+        alibi = dist.to(dtype) * self.m.to(device=device, dtype=dtype).view(-1, 1, 1)
+        alibi = alibi.masked_fill(invalid, float("-inf"))
+        return alibi.unsqueeze(0)
+
+
+@lru_cache
+def get_alibi_slopes(num_heads: int) -> Tuple[float, ...]:
+    return tuple(MultiHeadAttentionAlibi.get_slopes(num_heads))
+
 
 class TransformerLayer(nn.Module):
     """
@@ -243,6 +869,8 @@ class TransformerLayer(nn.Module):
         dropout: float = 0.1,
         cross_attention: bool = False,
         num_sink_tokens: int = 2,
+        sink_layout: str = "tokens",
+        max_lookback: Optional[int] = None,
     ):
         super().__init__()
         self.dim = dim
@@ -256,7 +884,12 @@ class TransformerLayer(nn.Module):
         self.ln_self_attn = nn.LayerNorm(dim)
         self.ln_ffnetwork = nn.LayerNorm(dim)
         self.mha = MultiHeadAttentionAlibi(
-            dim=dim, num_heads=num_heads, dropout=dropout, num_sink_tokens=num_sink_tokens
+            dim=dim,
+            num_heads=num_heads,
+            dropout=dropout,
+            num_sink_tokens=num_sink_tokens,
+            sink_layout=sink_layout,
+            max_lookback=max_lookback,
         )
         self.ffnetwork = ffn_block(
             dim, ffn_dim, activation=ffn_activation, dropout=dropout
@@ -265,7 +898,12 @@ class TransformerLayer(nn.Module):
         if cross_attention:
             self.ln_src_attn = nn.LayerNorm(dim)
             self.mha_cross = MultiHeadAttentionAlibi(
-                dim=dim, num_heads=num_heads, dropout=dropout, num_sink_tokens=num_sink_tokens
+                dim=dim,
+                num_heads=num_heads,
+                dropout=dropout,
+                num_sink_tokens=num_sink_tokens,
+                sink_layout=sink_layout,
+                max_lookback=max_lookback,
             )
 
     def forward(
@@ -273,28 +911,42 @@ class TransformerLayer(nn.Module):
         x: torch.Tensor,
         src: Optional[torch.Tensor] = None,
         mask: Optional[torch.Tensor] = None,
-    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
-        # Adjust the mask for sink tokens
-        if mask is not None:
-            B, T = mask.shape[:2]
-            sink_mask = torch.ones((B, self.num_sink_tokens), device=mask.device)
-            mask = torch.cat([sink_mask, mask], dim=1)
+        need_weights: bool = True,
+        heads: Optional[list[int]] = None,
+        cache: Optional[Dict[str, KVCache]] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        `cache`: the positions preceding `x` (default: the sinks), see `init_cache`
+        """
+        cache = cache if cache is not None else {}
 
         # Self-attention
         z = self.ln_self_attn(x)
-        self_attn, self_attn_weights = self.mha(Q=z, K=z, V=z, mask=mask)
-
-        # Residual connection (remove sink tokens before adding)
-        x = x + self.dropout(self_attn[:, self.num_sink_tokens:])
+        self_attn, self_attn_weights = self.mha(
+            Q=z,
+            K=z,
+            V=z,
+            mask=mask,
+            need_weights=need_weights,
+            heads=heads,
+            cache=cache.get("self"),
+        )
+        x = x + self.dropout(self_attn)
 
         # Cross-attention
         cross_attn_weights = None
         if self.cross_attention and src is not None:
             z = self.ln_src_attn(x)
             cross_attn, cross_attn_weights = self.mha_cross(
-                Q=z, K=src, V=src, mask=mask
+                Q=z,
+                K=src,
+                V=src,
+                mask=mask,
+                need_weights=need_weights,
+                heads=heads,
+                cache=cache.get("cross"),
             )
-            x = x + self.dropout(cross_attn[:, self.num_sink_tokens:])
+            x = x + self.dropout(cross_attn)
 
         # Feed-forward network
         z = self.ln_ffnetwork(x)
@@ -302,19 +954,96 @@ class TransformerLayer(nn.Module):
 
         return x, self_attn_weights, cross_attn_weights
 
+    def init_cache(self, batch_size: int = 1) -> Dict[str, KVCache]:
+        cache = {"self": self.mha.init_cache(batch_size)}
+        if self.cross_attention:
+            cache["cross"] = self.mha_cross.init_cache(batch_size)
+        return cache
+
+    def step(
+        self,
+        x: torch.Tensor,
+        cache: Dict[str, KVCache],
+        src: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Incremental forward over the new positions `x` (and `src`) given the
+        `cache` of all previous positions (see `init_cache`).
+        """
+        z = self.ln_self_attn(x)
+        x = x + self.dropout(self.mha.step(Q=z, K=z, V=z, cache=cache["self"]))
+
+        if self.cross_attention and src is not None:
+            z = self.ln_src_attn(x)
+            cross_attn = self.mha_cross.step(Q=z, K=src, V=src, cache=cache["cross"])
+            x = x + self.dropout(cross_attn)
+
+        z = self.ln_ffnetwork(x)
+        return x + self.dropout(self.ffnetwork(z))
+
+
+def cat_layer_caches(caches: list) -> Optional[Dict[str, KVCache]]:
+    """The `TransformerLayer` caches of the channels folded into the batch"""
+    if caches[0] is None:
+        return None
+    return {name: KVCache.cat([c[name] for c in caches]) for name in caches[0]}
+
+
 class TransformerStereoLayer(TransformerLayer):
     def forward(
         self,
         x1: torch.Tensor,
         x2: torch.Tensor,
         mask: Optional[torch.Tensor] = None,
+        need_weights: bool = True,
+        heads: Optional[list[int]] = None,
+        cache: Optional[list[Dict[str, KVCache]]] = None,
+        channel_batched: bool = True,
     ):
+        """
+        `channel_batched` runs both channels as a single batch, (2B, T, D),
+        with the other channel as the cross-attention source.
+        """
+        cache = cache if cache is not None else [None, None]
+        if channel_batched:
+            if mask is not None and mask.shape[0] > 1:
+                mask = torch.cat((mask, mask))
+            z, saw, caw = super().forward(
+                x=torch.cat((x1, x2)),
+                src=torch.cat((x2, x1)),
+                mask=mask,
+                need_weights=need_weights,
+                heads=heads,
+                cache=cat_layer_caches(cache),
+            )
+            z1, z2 = z.chunk(2)
+            if saw is None:
+                return z1, z2, [None, None, None, None]
+            sa1w, sa2w = saw.chunk(2)
+            ca1w, ca2w = caw.chunk(2)
+            return z1, z2, [sa1w, ca1w, sa2w, ca2w]
+
+        kwargs = {"mask": mask, "need_weights": need_weights, "heads": heads}
         # sa1w: self-attention-weights 1
         # ca1w: cross-attention-weights 1
-        z1, sa1w, ca1w = super().forward(x=x1, src=x2, mask=mask)
-        z2, sa2w, ca2w = super().forward(x=x2, src=x1, mask=mask)
+        z1, sa1w, ca1w = super().forward(x=x1, src=x2, cache=cache[0], **kwargs)
+        z2, sa2w, ca2w = super().forward(x=x2, src=x1, cache=cache[1], **kwargs)
         return z1, z2, [sa1w, ca1w, sa2w, ca2w]
 
+    def init_cache(self, batch_size: int = 1) -> list[Dict[str, KVCache]]:
+        # One cache for each channel
+        return [super().init_cache(batch_size), super().init_cache(batch_size)]
+
+    def step(
+        self,
+        x1: torch.Tensor,
+        x2: torch.Tensor,
+        cache: list[Dict[str, KVCache]],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        z1 = super().step(x1, cache[0], src=x2)
+        z2 = super().step(x2, cache[1], src=x1)
+        return z1, z2
+
 
 class GPT(nn.Module):
     """
@@ -331,7 +1060,9 @@ class GPT(nn.Module):
         num_heads: int = 4,
         activation: str = "GELU",
         dropout: float = 0.1,
-        num_sink_tokens: int = 2,  # Added num_sink_tokens parameter
+        num_sink_tokens: int = 2,
+        sink_layout: str = "tokens",
+        max_lookback: Optional[int] = None,
     ):
         super().__init__()
         self.dim = dim
@@ -340,7 +1071,9 @@ class GPT(nn.Module):
         self.num_heads = num_heads
         self.activation = activation
         self.dropout = dropout
-        self.num_sink_tokens = num_sink_tokens  # Added this line
+        self.num_sink_tokens = num_sink_tokens
+        self.sink_layout = sink_layout
+        self.max_lookback = max_lookback
 
         self._build_layers()
         self.apply(self._init_weights)
@@ -355,7 +1088,9 @@ class GPT(nn.Module):
                     num_heads=self.num_heads,
                     ffn_activation=self.activation,
                     dropout=self.dropout,
-                    num_sink_tokens=self.num_sink_tokens,  # Added this line
+                    num_sink_tokens=self.num_sink_tokens,
+                    sink_layout=self.sink_layout,
+                    max_lookback=self.max_lookback,
                 )
             )
         self.layers = nn.ModuleList(layers)
@@ -370,23 +1105,52 @@ class GPT(nn.Module):
             torch.nn.init.ones_(module.weight)
 
     def forward(
-        self, x: torch.Tensor, attention: bool = False
+        self,
+        x: torch.Tensor,
+        attention: bool = False,
+        attention_layers: Optional[list[int]] = None,
+        attention_heads: Optional[list[int]] = None,
+        cache: Optional[list] = None,
     ) -> Dict[str, torch.Tensor]:
+        """
+        The attention weights are only computed (and kept) if `attention`,
+        for the `attention_layers` and `attention_heads` (default: all).
+
+        `cache`: the positions preceding `x` (default: the sinks), see `init_cache`
+
+        Return:
+            x:      (B, T, D)
+            attn:   (B, n_layers, n_heads, T, N + T) if `attention`
+        """
         all_attention = []
+        cache = cache if cache is not None else [None] * len(self.layers)
 
-        for layer in self.layers:
-            x, self_attn_weights, _ = layer(x)
-            if attention:
+        for i, (layer, layer_cache) in enumerate(zip(self.layers, cache)):
+            need_weights = attention and (
+                attention_layers is None or i in attention_layers
+            )
+            x, self_attn_weights, _ = layer(
+                x, need_weights=need_weights, heads=attention_heads, cache=layer_cache
+            )
+            if need_weights:
                 all_attention.append(self_attn_weights)
 
         ret = {"x": x}
 
-        if attention:
+        if len(all_attention) > 0:
             self_attn_weights = torch.stack(all_attention, dim=1)
             ret["attn"] = self_attn_weights
 
         return ret
 
+    def init_cache(self, batch_size: int = 1) -> list:
+        return [layer.init_cache(batch_size) for layer in self.layers]
+
+    def step(self, x: torch.Tensor, cache: list) -> Dict[str, torch.Tensor]:
+        for layer, layer_cache in zip(self.layers, cache):
+            x = layer.step(x, layer_cache)
+        return {"x": x}
+
 
 class GPTStereo(GPT):
     def _build_layers(self):
@@ -400,7 +1164,9 @@ class GPTStereo(GPT):
                     ffn_activation=self.activation,
                     dropout=self.dropout,
                     cross_attention=True,
-                    num_sink_tokens=self.num_sink_tokens,  # Added this line
+                    num_sink_tokens=self.num_sink_tokens,
+                    sink_layout=self.sink_layout,
+                    max_lookback=self.max_lookback,
                 )
             )
         self.layers = nn.ModuleList(layers)
@@ -409,26 +1175,46 @@ class GPTStereo(GPT):
         self.combinator = Combinator(dim=self.dim, activation="GELU")
 
     def forward(
-        self, x1: torch.Tensor, x2: torch.Tensor, attention: bool = False
+        self,
+        x1: torch.Tensor,
+        x2: torch.Tensor,
+        attention: bool = False,
+        attention_layers: Optional[list[int]] = None,
+        attention_heads: Optional[list[int]] = None,
+        cache: Optional[list] = None,
+        channel_batched: bool = True,
     ) -> Dict[str, torch.Tensor]:
+        """See `GPT.forward` and `TransformerStereoLayer.forward`"""
 
         self_attn_a = []
         self_attn_b = []
         cross_attn_a = []
         cross_attn_b = []
-        for layer in self.layers:
-            x1, x2, attn_list = layer(x1=x1, x2=x2)
-            if attention:
+        cache = cache if cache is not None else [None] * len(self.layers)
+        for i, (layer, layer_cache) in enumerate(zip(self.layers, cache)):
+            need_weights = attention and (
+                attention_layers is None or i in attention_layers
+            )
+            x1, x2, attn_list = layer(
+                x1=x1,
+                x2=x2,
+                need_weights=need_weights,
+                heads=attention_heads,
+                cache=layer_cache,
+                channel_batched=channel_batched,
+            )
+            if need_weights:
                 # [sa1w, ca1w, sa2w, ca2w] = attn_list
                 self_attn_a.append(attn_list[0])
                 cross_attn_a.append(attn_list[1])
                 self_attn_b.append(attn_list[2])
                 cross_attn_b.append(attn_list[3])
 
-        x = self.combinator(x1, x2)
+        with span("combinator"):
+            x = self.combinator(x1, x2)
         ret = {"x": x, "x1": x1, "x2": x2}
 
-        if attention:
+        if len(self_attn_a) > 0:
             # B, num_layers, num_heads, N, N
             self_attn_a = torch.stack(self_attn_a, dim=1)  # stack on layer dim
             self_attn_b = torch.stack(self_attn_b, dim=1)  # stack on layer dim
@@ -438,6 +1224,15 @@ class GPTStereo(GPT):
             ret["cross_attn"] = torch.stack([cross_attn_a, cross_attn_b], dim=1)
         return ret
 
+    def step(
+        self, x1: torch.Tensor, x2: torch.Tensor, cache: list
+    ) -> Dict[str, torch.Tensor]:
+        for layer, layer_cache in zip(self.layers, cache):
+            x1, x2 = layer.step(x1, x2, layer_cache)
+        with span("combinator"):
+            x = self.combinator(x1, x2)
+        return {"x": x, "x1": x1, "x2": x2}
+
 
 class Combinator(nn.Module):
     """
@@ -480,6 +1275,30 @@ class Combinator(nn.Module):
         return h
 
 class TransformerStereo(nn.Module):
+    """
+    Attention sinks (see `MultiHeadAttention`):
+        sink_layout="kv":       every attention module attends to its own
+                                `num_sink_tokens` learned keys/values.
+        sink_layout="tokens":   (legacy) every attention module attends to its
+                                own `num_sink_tokens` projected sink tokens and
+                                to the `attention_sinks` and the sinks of the
+                                first `ar` layer (added to the input by `VAP`)
+                                which are processed by the towers.
+
+    Both are the initial key/value cache (`init_cache`) of the towers, so the
+    input is never extended by sinks. `convert_sinks_to_kv` turns a "tokens"
+    model into an (in eval mode) identical "kv" model.
+
+    The towers share their weights over the channels, so `forward` runs both
+    channels as a single batch through every layer (cross-attention to the
+    other channel). Set `TransformerStereo.channel_batched = False` to run the
+    channels one after the other.
+    """
+
+    channel_batched: bool = True
+    # modules pickled before the layout was configurable use the legacy sinks
+    sink_layout: str = "tokens"
+
     def __init__(
         self,
         dim: int = 256,
@@ -488,22 +1307,28 @@ class TransformerStereo(nn.Module):
         num_heads: int = 4,
         dff_k: int = 3,
         dropout: float = 0.1,
-        num_sink_tokens: int = 2,  # Added num_sink_tokens parameter
+        num_sink_tokens: int = 2,
+        sink_layout: str = "tokens",
+        max_lookback: Optional[int] = None,
     ) -> None:
         super().__init__()
         assert self_layers > 0, f"Must have at least one self layer. got {self_layers}"
         assert cross_layers > 0, f"Must have at least one cross layer. got {cross_layers}"
-        
+        assert sink_layout in SINK_LAYOUTS, f"sink_layout must be one of {SINK_LAYOUTS}"
+
         self.dim = dim
         self.self_layers = self_layers
         self.cross_layers = cross_layers
         self.num_heads = num_heads
         self.dff_k = dff_k
         self.dropout = dropout
-        self.num_sink_tokens = num_sink_tokens  # Added this line
+        self.num_sink_tokens = num_sink_tokens
+        self.sink_layout = sink_layout
+        self.max_lookback = max_lookback
 
         # Attention sinks
-        self.attention_sinks = nn.Parameter(torch.randn(1, num_sink_tokens, dim))  # Added this line
+        if sink_layout == "tokens":
+            self.attention_sinks = nn.Parameter(torch.randn(1, num_sink_tokens, dim))
 
         # Single channel
         self.ar_channel = GPT(
@@ -512,7 +1337,9 @@ class TransformerStereo(nn.Module):
             num_layers=self_layers,
             num_heads=num_heads,
             dropout=dropout,
-            num_sink_tokens=num_sink_tokens,  # Added this line
+            num_sink_tokens=num_sink_tokens,
+            sink_layout=sink_layout,
+            max_lookback=max_lookback,
         )
 
         # Cross channel
@@ -522,38 +1349,157 @@ class TransformerStereo(nn.Module):
             num_layers=cross_layers,
             num_heads=num_heads,
             dropout=dropout,
-            num_sink_tokens=num_sink_tokens,  # Added this line
+            num_sink_tokens=num_sink_tokens,
+            sink_layout=sink_layout,
+            max_lookback=max_lookback,
         )
 
     def forward(
-        self, x1: Tensor, x2: Tensor, attention: bool = False
+        self,
+        x1: Tensor,
+        x2: Tensor,
+        attention: bool = False,
+        attention_layers: Optional[list[int]] = None,
+        attention_heads: Optional[list[int]] = None,
     ) -> Mapping[str, Tensor]:
-        # Add attention sinks to inputs
-        x1_with_sinks = torch.cat([self.attention_sinks.expand(x1.shape[0], -1, -1), x1], dim=1)  # Added this line
-        x2_with_sinks = torch.cat([self.attention_sinks.expand(x2.shape[0], -1, -1), x2], dim=1)  # Added this line
+        """
+        The attention weights are only computed if `attention`, for the
+        `attention_layers` (default: all), numbered over the entire stack:
+        `ar_channel` layers first (0, ..., self_layers - 1) followed by the `ar`
+        layers, and the `attention_heads` (default: all).
+
+        Return (with attention, the weights over the sinks are omitted):
+            self_attn:          (B, 2, n_layers, n_heads, T, T) `ar_channel`
+            cross_self_attn:    (B, 2, n_layers, n_heads, T, T) `ar` self-attention
+            cross_attn:         (B, 2, n_layers, n_heads, T, T) `ar` cross-attention
+        """
+        channel_layers, ar_layers = None, None
+        if attention_layers is not None:
+            channel_layers = [i for i in attention_layers if i < self.self_layers]
+            ar_layers = [
+                i - self.self_layers for i in attention_layers if i >= self.self_layers
+            ]
+        channel_kwargs = {
+            "attention": attention,
+            "attention_layers": channel_layers,
+            "attention_heads": attention_heads,
+        }
+
+        # The sinks, read (not updated) by every layer
+        cache = self.init_cache(x1.shape[0])
 
         # Self-attention layers
-        o1 = self.ar_channel(x1_with_sinks, attention=attention)  # Updated this line
-        o2 = self.ar_channel(x2_with_sinks, attention=attention)  # Updated this line
+        with span("ar_channel"):
+            if self.channel_batched:
+                channel_cache = [
+                    cat_layer_caches(caches) for caches in zip(*cache["ar_channel"])
+                ]
+                o = self.ar_channel(
+                    torch.cat((x1, x2)), cache=channel_cache, **channel_kwargs
+                )
+                o1, o2 = {}, {}
+                for name, x in o.items():
+                    o1[name], o2[name] = x.chunk(2)
+            else:
+                o1 = self.ar_channel(x1, cache=cache["ar_channel"][0], **channel_kwargs)
+                o2 = self.ar_channel(x2, cache=cache["ar_channel"][1], **channel_kwargs)
 
         # Cross-attention layers
-        out = self.ar(o1["x"], o2["x"], attention=attention)
-
-        # Remove attention sinks from outputs
-        out["x"] = out["x"][:, self.num_sink_tokens:]  # Added this line
-        out["x1"] = out["x1"][:, self.num_sink_tokens:]  # Added this line
-        out["x2"] = out["x2"][:, self.num_sink_tokens:]  # Added this line
+        with span("ar"):
+            out = self.ar(
+                o1["x"],
+                o2["x"],
+                attention=attention,
+                attention_layers=ar_layers,
+                attention_heads=attention_heads,
+                cache=cache["ar"],
+                channel_batched=self.channel_batched,
+            )
 
-        if attention:
-            out["cross_self_attn"] = out["self_attn"]
-            out["self_attn"] = torch.stack([
-                o1["attn"][:, :, self.num_sink_tokens:, self.num_sink_tokens:],  # Updated this line
-                o2["attn"][:, :, self.num_sink_tokens:, self.num_sink_tokens:]  # Updated this line
-            ], dim=1)
-            out["cross_attn"] = out["cross_attn"][:, :, :, self.num_sink_tokens:, self.num_sink_tokens:]  # Updated this line
+        # Remove the sinks from the attention weights (the first key positions)
+        T = x1.shape[1]
+        if "self_attn" in out:
+            out["cross_self_attn"] = out.pop("self_attn")[..., -T:]
+            out["cross_attn"] = out["cross_attn"][..., -T:]
+        if "attn" in o1:
+            out["self_attn"] = torch.stack(
+                [o1["attn"][..., -T:], o2["attn"][..., -T:]], dim=1
+            )
 
         return out
 
+    def set_max_lookback(self, max_lookback: Optional[int]) -> None:
+        """
+        Restrict every attention module (self and cross) to the `max_lookback`
+        most recent frames (see `MultiHeadAttention`), None: the entire input.
+        """
+        assert (
+            max_lookback is None or max_lookback > 0
+        ), f"max_lookback must be > 0, got {max_lookback}"
+        self.max_lookback = max_lookback
+        for m in self.modules():
+            if isinstance(m, MultiHeadAttention):
+                m.max_lookback = max_lookback
+
+    def init_cache(self, batch_size: int = 1) -> dict:
+        """
+        Key/value caches for incremental inference (see `step`), one for each
+        channel in the (shared) `ar_channel` tower and one for `ar`, holding
+        the attention sinks, which are always the first positions. With the
+        legacy "tokens" layout the sink tokens are processed by the towers here.
+        """
+        cache = {
+            "ar_channel": [
+                self.ar_channel.init_cache(batch_size),
+                self.ar_channel.init_cache(batch_size),
+            ],
+            "ar": self.ar.init_cache(batch_size),
+        }
+        if self.sink_layout == "tokens":
+            for sinks in [self.attention_sinks, self.ar.layers[0].mha.sink_tokens]:
+                sinks = sinks.expand(batch_size, -1, -1)
+                self.step(sinks, sinks, cache)
+        return cache
+
+    @torch.no_grad()
+    def convert_sinks_to_kv(self) -> None:
+        """
+        Replace the legacy "tokens" sinks by the keys/values they produce in
+        every attention module (in eval mode), i.e. the "kv" layout with
+        identical (eval) output.
+        """
+        if self.sink_layout == "kv":
+            return
+        training = self.training
+        cache = self.eval().init_cache(1)
+        self.train(training)
+
+        # Both channels hold the same sinks
+        for layer, layer_cache in zip(self.ar_channel.layers, cache["ar_channel"][0]):
+            layer.mha.set_sinks(layer_cache["self"].k, layer_cache["self"].v)
+        for layer, layer_cache in zip(self.ar.layers, cache["ar"]):
+            layer.mha.set_sinks(layer_cache[0]["self"].k, layer_cache[0]["self"].v)
+            layer.mha_cross.set_sinks(
+                layer_cache[0]["cross"].k, layer_cache[0]["cross"].v
+            )
+        del self.attention_sinks
+        num_sink_tokens = len(cache["ar_channel"][0][0]["self"])
+        for m in self.modules():
+            if hasattr(m, "sink_layout"):
+                m.num_sink_tokens = num_sink_tokens
+                m.sink_layout = "kv"
+
+    def step(self, x1: Tensor, x2: Tensor, cache: dict) -> Mapping[str, Tensor]:
+        """
+        Incremental forward over the new frames x1, x2 (B, t, D). Identical to
+        `forward` over the entire sequence but only computes the last t frames.
+        """
+        with span("ar_channel"):
+            o1 = self.ar_channel.step(x1, cache["ar_channel"][0])
+            o2 = self.ar_channel.step(x2, cache["ar_channel"][1])
+        with span("ar"):
+            return self.ar.step(o1["x"], o2["x"], cache["ar"])
+
 
 class Transformer(nn.Module):
     def __init__(
@@ -0,0 +1,305 @@
+import asyncio
+import torch
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from torch import Tensor
+from typing import Optional
+
+from vap.modules.VAP import VAP, PROBS_FRAME_DIM
+from vap.modules.modules import iter_kv_caches, stack_kv_caches, unstack_kv_caches
+from vap.utils.profiling import profiler, span
+
+OUT = dict[str, Tensor]
+
+
+class VAPStreamSession:
+    """
+    Incremental (streaming) inference with a stereo `VAP` model.
+
+    The session keeps the state of the encoder (CPC conv layer tails, GRU
+    hidden state and `CConv1d` buffers, see `EncoderCPC.init_state`) and a key/value
+    cache for every attention layer in the `TransformerStereo` towers, so that
+    each call only processes the newly received audio.
+
+    The output is the same as `model.probs` over the entire audio in a single
+    pass (up to float precision), emitted frame by frame. A frame is emitted
+    once all of its samples are received, which lags the input by 312 samples
+    (the CPC lookahead), and the last frames are returned by `flush`.
+
+    `max_context_frames` bounds the attention context (StreamingLLM style):
+    every layer attends to the attention sinks and the `max_context_frames` most
+    recent frames only, so arbitrarily long streams run in constant memory and
+    with a constant cost per frame. Within the first `max_context_frames` the
+    output is identical to the unbounded session.
+
+    Example:
+        session = VAPStreamSession(model.eval())
+        for chunk in chunks:  # (1, 2, 320) -> 20ms
+            out = session.step(chunk)
+            out["p_now"]  # (1, n_new_frames)
+    """
+
+    def __init__(
+        self,
+        model: VAP,
+        batch_size: int = 1,
+        now_lims: list[int] = [0, 1],
+        future_lims: list[int] = [2, 3],
+        max_context_frames: Optional[int] = None,
+    ):
+        assert hasattr(
+            model.encoder, "init_state"
+        ), f"{model.encoder.__class__.__name__} does not support streaming"
+        self.model = model
+        self.batch_size = batch_size
+        self.now_lims = now_lims
+        self.future_lims = future_lims
+        self.max_context_frames = max_context_frames
+        self.reset()
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    @torch.inference_mode()
+    def reset(self) -> None:
+        """Start a new stream"""
+        self.n_frames = 0
+        self.encoder_states = [
+            self.model.encoder.init_state(self.batch_size),
+            self.model.encoder.init_state(self.batch_size),
+        ]
+        self.cache = self.model.transformer.init_cache(self.batch_size)
+
+        # Pin the sinks, everything after is a rolling window
+        if self.max_context_frames is not None:
+            for cache in iter_kv_caches(self.cache):
+                cache.set_window(self.max_context_frames)
+
+    @torch.inference_mode()
+    def encode_audio(
+        self, waveform: Tensor, flush: bool = False
+    ) -> tuple[Tensor, Tensor]:
+        assert (
+            waveform.shape[1] == 2
+        ), f"audio VAP ENCODER: {waveform.shape} != (B, 2, n_samples)"
+        x1 = self.model.encoder.step(
+            waveform[:, :1], self.encoder_states[0], flush=flush
+        )
+        x2 = self.model.encoder.step(
+            waveform[:, 1:], self.encoder_states[1], flush=flush
+        )
+        return x1, x2
+
+    @torch.inference_mode()
+    def forward(self, waveform: Tensor, flush: bool = False) -> OUT:
+        with span("stream_step"):
+            return self._forward(waveform, flush)
+
+    def _forward(self, waveform: Tensor, flush: bool = False) -> OUT:
+        with self.model.autocast(self.device):
+            with span("encode_audio"):
+                x1, x2 = self.encode_audio(waveform.to(self.device), flush=flush)
+            with span("feature_projection"):
+                x1 = self.model.feature_projection(x1)
+                x2 = self.model.feature_projection(x2)
+            profiler.count("frames", x1.shape[0] * x1.shape[1])
+            out = self.model.transformer.step(x1, x2, self.cache)
+        with span("head"):
+            logits, vad = self.model.head(
+                out["x"].float(), out["x1"].float(), out["x2"].float()
+            )
+        out["logits"] = logits
+        out["vad"] = vad
+        self.n_frames += logits.shape[1]
+        return out
+
+    def probs(self, out: OUT) -> OUT:
+        probs = out["logits"].softmax(dim=-1)
+        ret = {
+            "probs": probs,
+            "vad": out["vad"].sigmoid(),
+            "H": self.model.entropy(probs),
+        }
+        ret.update(
+            self.model.aggregate_probs(probs, self.now_lims, self.future_lims)
+        )
+        return ret
+
+    @torch.inference_mode()
+    def step(self, waveform: Tensor) -> OUT:
+        """
+        Process the next chunk of audio, (B, 2, n_samples), of any length and
+        return the probabilities of the frames completed by it (see `VAP.probs`).
+        """
+        return self.probs(self.forward(waveform))
+
+    @torch.inference_mode()
+    def flush(self) -> OUT:
+        """
+        End the stream and return the last frames (which depend on the right
+        padding of the encoder). `reset` to start a new stream.
+        """
+        p = next(self.model.parameters())
+        empty = torch.zeros((self.batch_size, 2, 0), device=p.device, dtype=p.dtype)
+        return self.probs(self.forward(empty, flush=True))
+
+    @classmethod
+    def stack(cls, sessions: list["VAPStreamSession"]) -> "VAPStreamSession":
+        """
+        A single session over the (batch size 1) `sessions` of the same model.
+        The states are copied back with `unstack`.
+        """
+        model = sessions[0].model
+        for s in sessions:
+            assert s.model is model, "All sessions must use the same model"
+            assert s.batch_size == 1, f"Expects batch size 1, got {s.batch_size}"
+        stacked = cls.__new__(cls)
+        stacked.model = model
+        stacked.batch_size = len(sessions)
+        stacked.now_lims = sessions[0].now_lims
+        stacked.future_lims = sessions[0].future_lims
+        stacked.max_context_frames = sessions[0].max_context_frames
+        stacked.n_frames = 0
+        stacked.encoder_states = [
+            model.encoder.stack_states([s.encoder_states[ch] for s in sessions])
+            for ch in range(2)
+        ]
+        stacked.cache = stack_kv_caches([s.cache for s in sessions])
+        return stacked
+
+    def unstack(self, sessions: list["VAPStreamSession"]) -> None:
+        """Write the states of a `stack`ed session back to the `sessions`"""
+        states = [self.model.encoder.split_state(st) for st in self.encoder_states]
+        unstack_kv_caches(self.cache, [s.cache for s in sessions])
+        for i, s in enumerate(sessions):
+            s.encoder_states = [states[0][i], states[1][i]]
+            s.n_frames += self.n_frames
+
+    def batch_key(self, waveform: Tensor) -> tuple:
+        """Steps with the same key can be batched, see `step_sessions`"""
+        encoder = self.model.encoder
+        return (
+            waveform.shape[-1],
+            encoder.get_state_signature(self.encoder_states[0]),
+            encoder.get_state_signature(self.encoder_states[1]),
+        )
+
+
+@torch.inference_mode()
+def step_sessions(
+    sessions: list[VAPStreamSession], waveforms: list[Tensor]
+) -> list[OUT]:
+    """
+    `VAPStreamSession.step` of several sessions (batch size 1, same model) as
+    a single batched forward. The sessions must have the same `batch_key`,
+    e.g. streams that are fed fixed size chunks, but may differ in length
+    (the key/value caches are left padded and masked).
+
+    Return:
+        the `step` output of every session
+    """
+    stacked = VAPStreamSession.stack(sessions)
+    out = stacked.step(torch.cat(waveforms))
+    stacked.unstack(sessions)
+
+    ret = []
+    for i in range(len(sessions)):
+        o = {}
+        for k, v in out.items():
+            batch_dim = PROBS_FRAME_DIM[k] - 1
+            o[k] = v.narrow(batch_dim, i, 1)
+        ret.append(o)
+    return ret
+
+
+class StreamScheduler:
+    """
+    Dynamic micro-batching of concurrent streaming sessions (asyncio).
+
+    `step` requests are collected until `max_batch_size` are pending or the
+    oldest has waited `max_delay` seconds, then every group of compatible
+    requests (see `VAPStreamSession.batch_key`) runs as a single batched
+    forward (`step_sessions`) and the results are scattered back.
+
+    `max_delay` is the throughput/latency knob: a longer delay collects
+    larger batches (better matmul efficiency) at the cost of added latency.
+    `max_delay=0` batches only the requests that are already pending.
+
+    Example:
+        scheduler = StreamScheduler(max_batch_size=16, max_delay=0.01)
+        out = await scheduler.step(session, chunk)  # in every session task
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = 16,
+        max_delay: float = 0.01,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        assert max_batch_size >= 1, f"max_batch_size must be >= 1, got {max_batch_size}"
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        # The model runs in a single thread (shared with any other model calls)
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.timer = None
+
+        # statistics
+        self.n_batches = 0
+        self.n_steps = 0
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.n_steps / max(self.n_batches, 1)
+
+    async def step(self, session: VAPStreamSession, waveform: Tensor) -> OUT:
+        """`session.step(waveform)`, batched with the steps of other sessions"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((session, waveform, future))
+        if len(self.pending) >= self.max_batch_size:
+            self.dispatch()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.dispatch)
+        return await future
+
+    def dispatch(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, []
+
+        groups = {}
+        for item in pending:
+            session, waveform, _ = item
+            groups.setdefault(session.batch_key(waveform), []).append(item)
+
+        loop = asyncio.get_running_loop()
+        for items in groups.values():
+            for i in range(0, len(items), self.max_batch_size):
+                batch = items[i : i + self.max_batch_size]
+                task = loop.run_in_executor(
+                    self.executor,
+                    step_sessions,
+                    [session for session, _, _ in batch],
+                    [waveform for _, waveform, _ in batch],
+                )
+                task.add_done_callback(partial(self.resolve, batch))
+                self.n_batches += 1
+                self.n_steps += len(batch)
+
+    @staticmethod
+    def resolve(batch: list, task: asyncio.Future) -> None:
+        error = task.exception()
+        if error is not None:
+            outs = [None] * len(batch)
+        else:
+            outs = task.result()
+        for (_, _, future), out in zip(batch, outs):
+            if future.done():  # cancelled, e.g. the client disconnected
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(out)
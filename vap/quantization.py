@@ -0,0 +1,292 @@
+"""
+Post-training int8 quantization of `VAP` for cpu inference.
+
+* dynamic (int8 weights, activations quantized on the fly): every `nn.Linear`
+  (attention, feed forward, combinator, `vap_head`, `va_classifier`) and the
+  CPC `GRU`
+* static (optional, calibrated on `VAPDataset` audio): the CPC conv encoder
+  (`gEncoder`), the channel norms stay in float
+
+The artifact is the state dict of the quantized model (and its config),
+`load_quantized_model` rebuilds the model, which also runs in
+`VAPStreamSession`. The report compares it to the float model
+(see `vap.compare_precision.compare_probs`).
+
+python vap/quantization.py --state_dict example/checkpoints/VAP_state_dict.pt \\
+    --output VAP_int8.pt --csv example/data/sliding_dev.csv --static_encoder
+"""
+import json
+import warnings
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from torch import Tensor
+from torch.ao.quantization import (
+    DeQuantStub,
+    QuantStub,
+    convert,
+    get_default_qconfig,
+    prepare,
+    quantize_dynamic,
+)
+from torch.utils.data import DataLoader
+from typing import Iterable, Optional
+
+from vap.modules.VAP import VAP
+from vap.modules.encoder import EncoderCPC
+from vap.modules.modules import IN_PROJ_ROWS, MultiHeadAttention, TransformerStereo
+
+
+class QuantizedConv1d(nn.Module):
+    """
+    Statically quantized `nn.Conv1d` (after `prepare`/`convert`) with the
+    interface used by `CPCEncoder`. The (zero) padding is added in float so
+    that `forward_valid` is the unpadded conv used by the incremental `step`.
+    """
+
+    def __init__(self, conv: nn.Conv1d) -> None:
+        super().__init__()
+        self.in_channels = conv.in_channels
+        self.out_channels = conv.out_channels
+        self.kernel_size = conv.kernel_size
+        self.stride = conv.stride
+        self.dilation = conv.dilation
+        self.padding = conv.padding
+        self.quant = QuantStub()
+        self.conv = nn.Conv1d(
+            conv.in_channels,
+            conv.out_channels,
+            conv.kernel_size,
+            stride=conv.stride,
+            dilation=conv.dilation,
+            groups=conv.groups,
+            bias=conv.bias is not None,
+        )
+        self.conv.load_state_dict(conv.state_dict())
+        self.dequant = DeQuantStub()
+
+    def forward_valid(self, x: Tensor) -> Tensor:
+        return self.dequant(self.conv(self.quant(x)))
+
+    def forward(self, x: Tensor) -> Tensor:
+        p = self.padding[0]
+        return self.forward_valid(F.pad(x, (p, p)))
+
+
+def split_in_proj(model: nn.Module) -> None:
+    """
+    The rows of the packed `in_proj` (used by cross-attention and the key/value
+    projections) as separate layers, `in_proj_rows`, since the weights of a
+    quantized layer can't be sliced (see `MultiHeadAttention.in_linear`).
+    """
+    for m in model.modules():
+        if not isinstance(m, MultiHeadAttention):
+            continue
+        rows = nn.ModuleDict()
+        w, b = m.in_proj.weight, m.in_proj.bias
+        for name, (start, end) in IN_PROJ_ROWS.items():
+            start, end = start * m.dim, end * m.dim
+            layer = nn.Linear(m.dim, end - start, bias=b is not None)
+            layer.to(device=w.device, dtype=w.dtype)
+            with torch.no_grad():
+                layer.weight.copy_(w[start:end])
+                if b is not None:
+                    layer.bias.copy_(b[start:end])
+            rows[name] = layer
+        m.in_proj_rows = rows
+
+
+def quantize_dynamic_layers(model: VAP) -> VAP:
+    """int8 dynamic quantization of every `nn.Linear` and the CPC `GRU` (in-place)"""
+    split_in_proj(model)
+    quantize_dynamic(model, {nn.Linear, nn.GRU}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+@torch.no_grad()
+def quantize_static_encoder(
+    model: VAP, calibration: Iterable[Tensor], backend: str = "fbgemm"
+) -> VAP:
+    """
+    int8 static quantization of the CPC conv layers (in-place). The activation
+    ranges are calibrated on the (B, 2, n_samples) `calibration` waveforms.
+    """
+    torch.backends.quantized.engine = backend
+    encoder = model.encoder.encoder.gEncoder
+    names = [f"conv{i}" for i in range(len(encoder.get_layers()))]
+    for name in names:
+        conv = QuantizedConv1d(getattr(encoder, name))
+        conv.qconfig = get_default_qconfig(backend)
+        setattr(encoder, name, conv)
+    prepare(encoder, inplace=True)
+    for waveform in calibration:
+        model.encode_audio(waveform)
+    convert(encoder, inplace=True)
+    return model
+
+
+def quantize_model(
+    model: VAP,
+    calibration: Optional[Iterable[Tensor]] = None,
+    backend: str = "fbgemm",
+) -> VAP:
+    """
+    int8 (cpu) model: dynamic quantization of the linear layers and the GRU,
+    and static quantization of the CPC conv encoder if `calibration` (waveforms)
+    is given. The model is quantized in-place.
+    """
+    model = model.cpu().eval()
+    if calibration is not None:
+        quantize_static_encoder(model, calibration, backend)
+    model = quantize_dynamic_layers(model)
+    if hasattr(model.encoder, "silence_cache"):
+        model.encoder.silence_cache.clear()  # the float (calibration) output
+    return model
+
+
+# The `TransformerStereo` arguments, to rebuild the model in `load_quantized_model`
+TRANSFORMER_CONFIG = [
+    "dim",
+    "self_layers",
+    "cross_layers",
+    "num_heads",
+    "dff_k",
+    "dropout",
+    "num_sink_tokens",
+    "sink_layout",
+    "max_lookback",
+]
+
+
+def save_quantized_model(model: VAP, path: str) -> None:
+    """
+    The state dict of the quantized `model` and what is needed to rebuild its
+    structure (the transformer config and the static encoder), see
+    `load_quantized_model`.
+    """
+    encoder = model.encoder.encoder.gEncoder
+    config = {k: getattr(model.transformer, k) for k in TRANSFORMER_CONFIG}
+    torch.save(
+        {
+            "transformer": config,
+            "static_encoder": isinstance(encoder.conv0, QuantizedConv1d),
+            "backend": torch.backends.quantized.engine,
+            "state_dict": model.state_dict(),
+        },
+        path,
+    )
+
+
+def load_quantized_model(path: str) -> VAP:
+    """
+    The model saved by `save_quantized_model`. A float model is quantized
+    (the static encoder without calibration) to the same structure, and then
+    loads the quantized weights and activation ranges of the state dict.
+    """
+    # the packed (quantized GRU) params are script objects, not plain tensors
+    q = torch.load(path, map_location="cpu", weights_only=False)
+    transformer = TransformerStereo(**q["transformer"])
+    model = VAP(EncoderCPC(load_pretrained=False), transformer).eval()
+    if q["static_encoder"]:
+        with warnings.catch_warnings():
+            # the observers have not seen data, the ranges are in the state dict
+            warnings.filterwarnings("ignore", message=".*must run observer.*")
+            quantize_static_encoder(model, [], backend=q["backend"])
+    model = quantize_dynamic_layers(model)
+    model.load_state_dict(q["state_dict"])
+    return model
+
+
+def get_args():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-sd", "--state_dict", type=str, default=None)
+    parser.add_argument("-c", "--checkpoint", type=str, default=None)
+    parser.add_argument(
+        "-o", "--output", type=str, required=True, help="Quantized model (.pt)"
+    )
+    parser.add_argument(
+        "--static_encoder",
+        action="store_true",
+        help="Static int8 quantization of the CPC conv encoder (calibrated on --calibration_csv)",
+    )
+    parser.add_argument(
+        "--calibration_csv",
+        type=str,
+        default=None,
+        help="Dataset csv (see VAPDataset) for calibration (default: --csv)",
+    )
+    parser.add_argument("--n_calibration", type=int, default=32)
+    parser.add_argument(
+        "--csv", type=str, default=None, help="Dataset csv for the accuracy report"
+    )
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--max_batches", type=int, default=None)
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch cpu threads (latency)"
+    )
+    parser.add_argument(
+        "--report", type=str, default=None, help="Save the report (json)"
+    )
+    args = parser.parse_args()
+    assert (
+        args.state_dict is not None or args.checkpoint is not None
+    ), "Must provide state_dict or checkpoint"
+    if args.static_encoder:
+        assert (
+            args.calibration_csv is not None or args.csv is not None
+        ), "--static_encoder requires --calibration_csv (or --csv)"
+    return args
+
+
+if __name__ == "__main__":
+    import copy
+    from vap.compare_precision import compare_probs, format_report
+    from vap.data.datamodule import VAPDataset
+    from vap.infer import load_vap_model
+
+    args = get_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    model = load_vap_model(args.state_dict, args.checkpoint).cpu().eval()
+
+    def get_dloader(path: str) -> DataLoader:
+        dset = VAPDataset(path, sample_rate=model.sample_rate, frame_hz=model.frame_hz)
+        return DataLoader(
+            dset,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            shuffle=False,
+        )
+
+    calibration = None
+    if args.static_encoder:
+        dloader = get_dloader(args.calibration_csv or args.csv)
+        n_batches = -(-args.n_calibration // args.batch_size)
+        calibration = (
+            batch["waveform"] for _, batch in zip(range(n_batches), dloader)
+        )
+
+    qmodel = quantize_model(copy.deepcopy(model), calibration)
+    save_quantized_model(qmodel, args.output)
+    print(f"Saved int8 model -> {args.output}")
+
+    if args.csv is not None:
+        report = compare_probs(
+            model.probs,
+            qmodel.probs,
+            get_dloader(args.csv),
+            names=("fp32", "int8"),
+            max_batches=args.max_batches,
+            sample_rate=model.sample_rate,
+        )
+        report["static_encoder"] = args.static_encoder
+        print(format_report(report))
+        if args.report is not None:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Saved report -> {args.report}")
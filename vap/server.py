@@ -0,0 +1,256 @@
+"""
+A local streaming server for turn-taking probabilities (asyncio, raw TCP).
+
+Every connection is a session with its own `VAPStreamSession` (encoder state
+and key/value caches).
+
+Client -> server:
+    interleaved stereo 16-bit little endian PCM at the model sample rate
+    (16kHz): [L0, R0, L1, R1, ...], sent in chunks of any size.
+    Closing the write side (EOF) ends the stream: the last frames are flushed
+    and the server closes the connection.
+
+Server -> client:
+    one json object per line for every (decimated) output frame
+    {"frame": 12, "time": 0.24, "p_now": 0.41, "p_future": 0.37, "vad": [0.9, 0.02]}
+    `time` is the end time of the frame (seconds) in the input stream.
+
+python vap/server.py --state_dict example/checkpoints/VAP_state_dict.pt --port 8765
+"""
+import asyncio
+import json
+import numpy as np
+import torch
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from vap.modules.VAP import VAP
+from vap.modules.streaming import StreamScheduler, VAPStreamSession
+from vap.utils.profiling import profiler
+
+
+BYTES_PER_SAMPLE = 2 * 2  # int16 x 2 channels
+DEFAULT_FIELDS = ["p_now", "p_future", "vad"]
+
+
+def pcm_to_waveform(data: bytes) -> torch.Tensor:
+    """Interleaved stereo int16 pcm -> (1, 2, n_samples) float32 in [-1, 1]"""
+    x = np.frombuffer(data, dtype="<i2").reshape(-1, 2)
+    x = torch.from_numpy(x.T.astype(np.float32) / 32768.0)
+    return x.unsqueeze(0)
+
+
+class VAPServer:
+    """
+    Arguments:
+        model:              the `VAP` model, shared by all sessions
+        fields:             the output fields sent to the client
+        decimation:         send every `decimation`th frame (50Hz / decimation)
+        min_chunk_time:     audio (seconds) buffered before a model step
+        max_context_frames: attention context of the sessions (see `VAPStreamSession`)
+        max_batch_size:     > 1 batches the steps of concurrent sessions (see `StreamScheduler`)
+        max_delay:          the longest a step waits for a batch (seconds)
+    """
+
+    def __init__(
+        self,
+        model: VAP,
+        fields: list[str] = DEFAULT_FIELDS,
+        decimation: int = 1,
+        min_chunk_time: float = 0.02,
+        max_context_frames: Optional[int] = None,
+        max_batch_size: int = 1,
+        max_delay: float = 0.01,
+    ) -> None:
+        assert decimation >= 1, f"decimation must be >= 1, got {decimation}"
+        self.model = model
+        self.fields = fields
+        self.decimation = decimation
+        self.min_chunk_bytes = (
+            int(min_chunk_time * model.sample_rate) * BYTES_PER_SAMPLE
+        )
+        self.max_context_frames = max_context_frames
+
+        # The model runs in a single thread, sessions are interleaved at step level
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.scheduler = None
+        if max_batch_size > 1:
+            self.scheduler = StreamScheduler(
+                max_batch_size, max_delay, executor=self.executor
+            )
+        self.n_sessions = 0
+
+    def create_session(self) -> VAPStreamSession:
+        return VAPStreamSession(
+            self.model, max_context_frames=self.max_context_frames
+        )
+
+    def format_output(self, out: dict[str, torch.Tensor], start_frame: int) -> bytes:
+        """The decimated output frames as json lines"""
+        n = out["p_now"].shape[-1]
+        fields = {}
+        for name in self.fields:
+            x = out[name][:, 0].t() if name == "p" else out[name][0]
+            fields[name] = x.tolist()
+        lines = []
+        for i in range(n):
+            frame = start_frame + i
+            if frame % self.decimation != 0:
+                continue
+            d = {"frame": frame, "time": (frame + 1) / self.model.frame_hz}
+            for name, values in fields.items():
+                d[name] = values[i]
+            lines.append(json.dumps(d))
+        if len(lines) == 0:
+            return b""
+        return ("\n".join(lines) + "\n").encode()
+
+    async def run_step(
+        self, session: VAPStreamSession, data: Optional[bytes]
+    ) -> bytes:
+        """A model step on `data` (or the flush at the end of the stream)"""
+        loop = asyncio.get_running_loop()
+        start_frame = session.n_frames
+        if data is None:
+            out = await loop.run_in_executor(self.executor, session.flush)
+        else:
+            waveform = pcm_to_waveform(data)
+            if self.scheduler is not None:
+                out = await self.scheduler.step(session, waveform)
+            else:
+                out = await loop.run_in_executor(
+                    self.executor, session.step, waveform
+                )
+        return self.format_output(out, start_frame)
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        peer = writer.get_extra_info("peername")
+        self.n_sessions += 1
+        print(f"[{peer}] session start (active: {self.n_sessions})")
+        session = self.create_session()
+        buffer = b""
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buffer += data
+                if len(buffer) < self.min_chunk_bytes:
+                    continue
+                # only whole (stereo) samples, and whole chunks when batching so
+                # that the steps of concurrent sessions have the same size
+                if self.scheduler is not None:
+                    n = len(buffer) - len(buffer) % self.min_chunk_bytes
+                else:
+                    n = len(buffer) - len(buffer) % BYTES_PER_SAMPLE
+                chunk, buffer = buffer[:n], buffer[n:]
+                writer.write(await self.run_step(session, chunk))
+                await writer.drain()
+
+            # End of stream: remaining audio and the flushed frames
+            n = len(buffer) - len(buffer) % BYTES_PER_SAMPLE
+            if n > 0:
+                writer.write(await self.run_step(session, buffer[:n]))
+            writer.write(await self.run_step(session, None))
+            await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.n_sessions -= 1
+            print(f"[{peer}] session end ({session.n_frames} frames)")
+            if profiler.enabled:
+                print(profiler.format_report())
+            del session
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionResetError, BrokenPipeError):
+                pass
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"VAP server on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+def get_args():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-sd", "--state_dict", type=str, default=None)
+    parser.add_argument("-c", "--checkpoint", type=str, default=None)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--fields",
+        type=str,
+        nargs="+",
+        default=DEFAULT_FIELDS,
+        help="Output fields sent to the client",
+    )
+    parser.add_argument(
+        "--decimation",
+        type=int,
+        default=1,
+        help="Send every n:th frame (1 -> 50Hz, 5 -> 10Hz)",
+    )
+    parser.add_argument(
+        "--min_chunk_time",
+        type=float,
+        default=0.02,
+        help="Audio (seconds) buffered before a model step",
+    )
+    parser.add_argument(
+        "--max_context_frames",
+        type=int,
+        default=None,
+        help="Bound the attention context of each session (frames)",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=1,
+        help="Batch the steps of up to n concurrent sessions (1: no batching)",
+    )
+    parser.add_argument(
+        "--max_delay",
+        type=float,
+        default=0.01,
+        help="Longest (seconds) a step waits for other sessions when batching",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the per-stage latency of the model steps at the end of every session",
+    )
+    args = parser.parse_args()
+    assert (
+        args.state_dict is not None or args.checkpoint is not None
+    ), "Must provide state_dict or checkpoint"
+    return args
+
+
+if __name__ == "__main__":
+    from vap.infer import load_vap_model
+
+    args = get_args()
+    model = load_vap_model(args.state_dict, args.checkpoint).eval()
+    if args.profile:
+        profiler.enable(cuda_events=model.device.type == "cuda")
+    server = VAPServer(
+        model,
+        fields=args.fields,
+        decimation=args.decimation,
+        min_chunk_time=args.min_chunk_time,
+        max_context_frames=args.max_context_frames,
+        max_batch_size=args.max_batch_size,
+        max_delay=args.max_delay,
+    )
+    asyncio.run(server.serve(args.host, args.port))
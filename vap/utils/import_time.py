@@ -0,0 +1,86 @@
+"""
+Import time report of (the inference path of) the repo.
+
+Every module is imported in a fresh interpreter (`python -X importtime`), i.e.
+the cold import cost of a short-lived worker, and the heavy (training,
+plotting) dependencies it pulls in are listed.
+
+    python vap/utils/import_time.py vap.modules.VAP vap.infer --top 10
+    python vap/utils/import_time.py --check  # exit 1 if inference imports HEAVY
+"""
+import json
+import subprocess
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from typing import Iterable
+
+
+# Dependencies that the inference path (see INFERENCE) should not import
+HEAVY = ["lightning", "torchmetrics", "hydra", "matplotlib", "x_transformers"]
+INFERENCE = [
+    "vap.modules.VAP",
+    "vap.modules.encoder",
+    "vap.modules.streaming",
+    "vap.infer",
+]
+
+
+def import_time(module: str) -> dict:
+    """
+    Import `module` in a new interpreter.
+
+    Return:
+        total:      the import time (seconds) of `module` (and its imports)
+        imports:    [(name, self, cumulative)] seconds of every imported module
+        heavy:      the HEAVY packages that were imported
+    """
+    code = f"import {module}, sys, json; print(json.dumps(sorted(sys.modules)))"
+    cmd = [sys.executable, "-X", "importtime", "-c", code]
+    p = subprocess.run(cmd, capture_output=True, text=True)
+    assert p.returncode == 0, f"import {module} failed:\n{p.stderr}"
+
+    imports = []
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        imports.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    total = next(c for name, _, c in reversed(imports) if name == module)
+    loaded = json.loads(p.stdout.splitlines()[-1])
+    heavy = [h for h in HEAVY if h in loaded]
+    return {"total": total, "imports": imports, "heavy": heavy}
+
+
+def format_report(reports: dict[str, dict], top: int = 10) -> str:
+    lines = []
+    for module, r in reports.items():
+        lines.append(f"{module}: {r['total']:.3f}s")
+        imports = sorted(r["imports"], key=lambda x: x[2], reverse=True)
+        for name, self_s, cumulative in imports[1 : top + 1]:
+            lines.append(f"  {cumulative:8.3f}s {self_s:8.3f}s  {name}")
+        if r["heavy"]:
+            lines.append(f"  heavy imports: {', '.join(r['heavy'])}")
+    return "\n".join(lines)
+
+
+def check_imports(modules: Iterable[str] = INFERENCE) -> dict[str, list[str]]:
+    """The HEAVY imports of every module (that has any)"""
+    heavy = {m: import_time(m)["heavy"] for m in modules}
+    return {m: h for m, h in heavy.items() if h}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawDescriptionHelpFormatter
+    )
+    parser.add_argument("modules", type=str, nargs="*", default=INFERENCE)
+    parser.add_argument("--top", type=int, default=10, help="The slowest imports")
+    parser.add_argument(
+        "--check", action="store_true", help="Exit 1 if any module imports HEAVY"
+    )
+    args = parser.parse_args()
+
+    reports = {m: import_time(m) for m in args.modules}
+    print(format_report(reports, top=args.top))
+    if args.check and any(r["heavy"] for r in reports.values()):
+        sys.exit(1)
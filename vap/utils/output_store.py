@@ -0,0 +1,144 @@
+"""
+Compact binary storage of the `VAP.probs` output of a single session.
+
+A session is a directory with one `.npy` file per field, stored frame-major
+(n_frames, ...) so that time slices are contiguous, and a `meta.json`.
+Fields are stored as float16 or quantized to uint8 (linearly between the
+minimum and maximum of the field) and read through memory maps, so slicing a
+time region only reads that region from disk.
+
+    write_output_store(out, "output/session", fields=["p_now", "p_future", "vad"])
+    reader = OutputStoreReader("output/session")
+    p_now = reader.get("p_now", start_time=10, end_time=20)  # (500,)
+"""
+import os
+import shutil
+import numpy as np
+import torch
+from torch import Tensor
+from pathlib import Path
+from typing import Optional, Union
+
+from vap.utils.utils import read_json, write_json
+
+
+DTYPES = ["float16", "float32", "uint8"]
+FIELDS = ["probs", "vad", "H", "p_now", "p_future", "p_all", "p"]
+
+
+def to_frame_major(name: str, x: Tensor) -> np.ndarray:
+    """
+    The `VAP.probs` output (batch size 1) -> (n_frames, ...)
+
+    probs:  (1, n_frames, n_classes) -> (n_frames, n_classes)
+    vad:    (1, n_frames, 2) -> (n_frames, 2)
+    p:      (n_bins, 1, n_frames) -> (n_frames, n_bins)
+    p_now:  (1, n_frames) -> (n_frames,)
+    """
+    if name == "p":
+        assert x.shape[1] == 1, f"Expects a single session (batch size 1) got {x.shape}"
+        x = x[:, 0].transpose(0, 1)
+    else:
+        assert x.shape[0] == 1, f"Expects a single session (batch size 1) got {x.shape}"
+        x = x[0]
+    return x.detach().float().cpu().contiguous().numpy()
+
+
+def write_output_store(
+    out: dict[str, Tensor],
+    path: Union[str, Path],
+    fields: Optional[list[str]] = None,
+    dtype: str = "float16",
+    frame_hz: int = 50,
+) -> None:
+    assert dtype in DTYPES, f"dtype must be one of {DTYPES}, got {dtype}"
+    fields = fields if fields is not None else [f for f in FIELDS if f in out]
+
+    # Write to a temporary directory first so that a partial output is never 'done'
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+
+    meta = {"frame_hz": frame_hz, "dtype": dtype, "n_frames": None, "fields": {}}
+    for name in fields:
+        x = to_frame_major(name, out[name])
+        field_meta = {"shape": list(x.shape)}
+        if dtype == "uint8":
+            vmin, vmax = float(x.min(initial=0.0)), float(x.max(initial=1.0))
+            scale = (vmax - vmin) / 255 if vmax > vmin else 1.0
+            x = np.round((x - vmin) / scale).clip(0, 255).astype(np.uint8)
+            field_meta.update({"offset": vmin, "scale": scale})
+        else:
+            x = x.astype(dtype)
+        np.save(tmp / f"{name}.npy", x)
+        meta["fields"][name] = field_meta
+        meta["n_frames"] = x.shape[0]
+    write_json(meta, tmp / "meta.json")
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+class OutputStoreReader:
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self.meta = read_json(self.path / "meta.json")
+        self._arrays = {}
+
+    def __repr__(self) -> str:
+        s = f"{self.__class__.__name__}({self.path})"
+        s += f"\n\tframe_hz: {self.frame_hz}"
+        s += f"\n\tn_frames: {self.n_frames}"
+        s += f"\n\tdtype: {self.meta['dtype']}"
+        s += f"\n\tfields: {self.fields}"
+        return s
+
+    @property
+    def fields(self) -> list[str]:
+        return list(self.meta["fields"].keys())
+
+    @property
+    def frame_hz(self) -> int:
+        return self.meta["frame_hz"]
+
+    @property
+    def n_frames(self) -> int:
+        return self.meta["n_frames"]
+
+    @property
+    def duration(self) -> float:
+        return self.n_frames / self.frame_hz
+
+    def array(self, name: str) -> np.ndarray:
+        """The raw (memory mapped) array as stored"""
+        assert name in self.meta["fields"], f"{name} not in {self.fields}"
+        if name not in self._arrays:
+            self._arrays[name] = np.load(self.path / f"{name}.npy", mmap_mode="r")
+        return self._arrays[name]
+
+    def get_frames(
+        self, name: str, start: Optional[int] = None, end: Optional[int] = None
+    ) -> Tensor:
+        """Frames [start, end) as float32"""
+        x = np.asarray(self.array(name)[start:end]).astype(np.float32)
+        field_meta = self.meta["fields"][name]
+        if "scale" in field_meta:
+            x = x * field_meta["scale"] + field_meta["offset"]
+        return torch.from_numpy(x)
+
+    def get(
+        self,
+        name: str,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+    ) -> Tensor:
+        """The region [start_time, end_time) (seconds) as float32"""
+        start = int(start_time * self.frame_hz) if start_time is not None else None
+        end = int(end_time * self.frame_hz) if end_time is not None else None
+        return self.get_frames(name, start, end)
+
+    def __getitem__(self, name: str) -> Tensor:
+        return self.get_frames(name)
@@ -0,0 +1,153 @@
+"""
+Opt-in per-stage latency instrumentation.
+
+The model code marks its stages with `span(name)` (e.g. `encode_audio`,
+`feature_projection`, `ar_channel`, `ar`, `combinator`, `head`). Disabled (the
+default) `span` returns a shared no-op context, so the instrumentation costs a
+single attribute lookup per stage.
+
+Spans nest, the outermost span of a call (e.g. `VAP.forward`) closes the call:
+the durations of all (summed per name) spans in it are the per-call report
+(`profiler.last_call`) and are added to the rolling windows used for the
+percentile report.
+
+    from vap.utils.profiling import profiler
+
+    profiler.enable()  # profiler.enable(cuda_events=True) on the gpu
+    out = model.probs(waveform)
+    print(profiler.last_call)  # {'forward': 12.1, 'encode_audio': 7.3, ...} ms
+    print(profiler.format_report())  # count, mean, p50, p90, p99 per stage
+"""
+import time
+import torch
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from typing import Optional
+
+
+NULL_SPAN = nullcontext()
+
+
+class Span:
+    __slots__ = ("profiler", "name", "start", "end")
+
+    def __init__(self, profiler: "Profiler", name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self) -> "Span":
+        self.profiler.depth += 1
+        if self.profiler.cuda_events:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.end = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.profiler.cuda_events:
+            self.end.record()
+        else:
+            self.end = time.perf_counter()
+        self.profiler.close(self)
+
+    def elapsed_ms(self) -> float:
+        if isinstance(self.start, float):
+            return (self.end - self.start) * 1000
+        return self.start.elapsed_time(self.end)
+
+
+class Profiler:
+    """
+    Arguments:
+        window:         number of calls in the rolling percentile report
+    """
+
+    def __init__(self, window: int = 1000) -> None:
+        self.enabled = False
+        self.cuda_events = False
+        self.window = window
+        self.reset()
+
+    def reset(self) -> None:
+        self.depth = 0
+        self.spans = []
+        self.last_call = {}
+        self.history = defaultdict(lambda: deque(maxlen=self.window))
+        self.counters = defaultdict(int)
+
+    def enable(self, cuda_events: bool = False, window: Optional[int] = None) -> None:
+        """`cuda_events` times the (asynchronous) gpu work instead of wall time"""
+        if cuda_events:
+            assert torch.cuda.is_available(), "cuda_events requires cuda"
+        self.enabled = True
+        self.cuda_events = cuda_events
+        if window is not None:
+            self.window = window
+        self.reset()
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def span(self, name: str):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.enabled:
+            self.counters[name] += n
+
+    def close(self, span: Span) -> None:
+        self.depth -= 1
+        self.spans.append(span)
+        if self.depth > 0:
+            return
+
+        # The outermost span: the end of a call
+        if self.cuda_events:
+            torch.cuda.synchronize()
+        call = defaultdict(float)
+        for s in self.spans:
+            call[s.name] += s.elapsed_ms()
+        self.spans = []
+        self.last_call = dict(call)
+        for name, ms in call.items():
+            self.history[name].append(ms)
+
+    def report(self) -> dict[str, dict[str, float]]:
+        """Count, mean and percentiles (ms) of every span over the rolling window"""
+        ret = {}
+        for name, values in self.history.items():
+            x = torch.tensor(list(values), dtype=torch.float64)
+            q = torch.quantile(x, torch.tensor([0.5, 0.9, 0.99], dtype=torch.float64))
+            ret[name] = {
+                "count": len(values),
+                "mean": x.mean().item(),
+                "p50": q[0].item(),
+                "p90": q[1].item(),
+                "p99": q[2].item(),
+            }
+        return ret
+
+    def format_report(self) -> str:
+        s = f"{'stage':<20}{'count':>8}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}"
+        for name, r in self.report().items():
+            s += f"\n{name:<20}{r['count']:>8}"
+            for k in ["mean", "p50", "p90", "p99"]:
+                s += f"{r[k]:>10.2f}"
+        for name, n in self.counters.items():
+            s += f"\n{name}: {n}"
+        return s
+
+
+# The process wide profiler used by the model code
+profiler = Profiler()
+
+
+def span(name: str):
+    """A timing span of the process wide `profiler` (a no-op when disabled)"""
+    if not profiler.enabled:
+        return NULL_SPAN
+    return Span(profiler, name)